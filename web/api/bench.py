@@ -0,0 +1,546 @@
+# Offline throughput benchmark.
+#
+#     python -m web.api.bench --csv this_is_seedhe_maut.csv --repeat 100
+#
+# Replays a Spotify CSV export (repeated `--repeat` times with unique URIs)
+# through run_download_job and through the HTTP API, with YouTube replaced by
+# a fake extractor (synthetic search results, a generated audio file per
+# download) and album art served by a local HTTP server. Everything runs in a
+# scratch directory, so the real index, caches and downloads are untouched.
+#
+# Reports tracks/min, p50/p99 per-track latency, index I/O time and peak RSS,
+# plus (scenario `startup`) the cold import time and baseline RSS of a fresh
+# API process and of the download path, and writes them as JSON; pass --compare with an earlier file to see the
+# change between commits. Needs ffmpeg (to generate the sample audio).
+import os
+import io
+import csv
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_CSV = 'this_is_seedhe_maut.csv'
+
+# Budgets high enough that the token buckets never throttle the fake upstreams
+UNTHROTTLED = {
+    'OFFLINEIFY_SEARCH_RATE': '10000', 'OFFLINEIFY_SEARCH_BURST': '10000',
+    'OFFLINEIFY_MEDIA_RATE': '10000', 'OFFLINEIFY_MEDIA_BURST': '10000',
+    'OFFLINEIFY_COVER_RATE': '10000', 'OFFLINEIFY_COVER_BURST': '10000',
+}
+
+
+# ---------------------------------------------------------------------------
+# Fake upstreams
+# ---------------------------------------------------------------------------
+
+class FakeYoutubeDL:
+    """
+    Stands in for yt_dlp.YoutubeDL. Searches return synthetic entries whose
+    top hit matches the track's real duration (so the matcher behaves as it
+    would on a clean result); downloads copy a pre-generated audio file.
+    """
+    catalog = {}  # "artist - name" -> duration in seconds
+    videos = {}   # video id -> info dict
+    sample_path = None
+    search_latency = 0.0
+    media_latency = 0.0
+    counters = {'search': 0, 'download': 0}
+    lock = threading.Lock()
+
+    def __init__(self, params):
+        self.params = dict(params)
+        outtmpl = self.params.get('outtmpl') or '%(title)s [%(id)s].%(ext)s'
+        self.params['outtmpl'] = outtmpl if isinstance(outtmpl, dict) else {'default': outtmpl}
+
+    @property
+    def cookiejar(self):
+        return {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def _entry(self, query, rank):
+        base = query
+        for suffix in (' audio', ' lyrics'):
+            if base.endswith(suffix):
+                base = base[:-len(suffix)]
+        duration = self.catalog.get(base, 200)
+        artist, _, name = base.partition(' - ')
+        video_id = hashlib.sha1(f"{query}|{rank}".encode('utf-8')).hexdigest()[:11]
+        first_artist = artist.split(',')[0].split(';')[0].strip()
+        info = {
+            'id': video_id,
+            'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+            'title': f"{first_artist} - {name}" + (" (Official Audio)" if rank == 0 else f" (Lyrics {rank})"),
+            'duration': duration + (0 if rank == 0 else 15 * rank),
+            'channel': f"{first_artist} - Topic" if rank == 0 else "Lyrics Channel",
+            'thumbnail': None,
+            'ext': 'm4a',
+            'acodec': 'mp4a.40.2',
+        }
+        with self.lock:
+            self.videos[video_id] = info
+        return info
+
+    def extract_info(self, url, download=False):
+        if url.startswith('ytsearch'):
+            count, _, query = url[len('ytsearch'):].partition(':')
+            time.sleep(self.search_latency)
+            with self.lock:
+                self.counters['search'] += 1
+            return {'entries': [self._entry(query, rank) for rank in range(int(count or 1))]}
+
+        time.sleep(self.media_latency)
+        with self.lock:
+            info = dict(self.videos[url.rsplit('=', 1)[-1]])
+            self.counters['download'] += 1
+            # Replayed rows resolve to the same video; keep their files apart
+            info['title'] = f"{info['title']} {self.counters['download']}"
+        if download:
+            target = self.prepare_filename(info)
+            os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+            shutil.copyfile(self.sample_path, target)
+        return info
+
+    def prepare_filename(self, info):
+        fields = {'title': info['title'].replace('/', '_'), 'ext': info['ext'], 'id': info['id'], 'artist': 'NA'}
+        return self.params['outtmpl']['default'] % fields
+
+
+class CoverHandler(BaseHTTPRequestHandler):
+    """Serves a generated 640x640 JPEG per path, like an image CDN."""
+    images = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            data = self.images.get(self.path)
+        if data is None:
+            from PIL import Image
+            seed = hashlib.sha1(self.path.encode('utf-8')).digest()
+            buf = io.BytesIO()
+            Image.new('RGB', (640, 640), tuple(seed[:3])).save(buf, format='JPEG', quality=90)
+            data = buf.getvalue()
+            with self.lock:
+                self.images[self.path] = data
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_cover_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CoverHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_sample_audio(path, seconds):
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+           '-codec:a', 'aac', '-b:a', '128k', path]
+    subprocess.run(cmd, check=True)
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+class Probe:
+    """Per-scenario counters filled in by the wrappers installed by instrument()."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.io = {}
+
+    def add_latency(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def add_io(self, name, seconds):
+        with self.lock:
+            calls, total = self.io.get(name, (0, 0.0))
+            self.io[name] = (calls + 1, total + seconds)
+
+
+def _timed(probe_ref, name, fn):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            probe_ref[0].add_io(name, time.perf_counter() - started)
+    return wrapper
+
+
+def instrument(api, downloader, index_db, media_store, probe_ref):
+    """Wrap the index/store calls and the first/last pipeline steps to time each track."""
+    for name in ('get_track', 'find_by_isrc', 'upsert_track'):
+        setattr(index_db, name, _timed(probe_ref, f"index_db.{name}", getattr(index_db, name)))
+    for name in ('ingest', 'link'):
+        setattr(media_store, name, _timed(probe_ref, f"media_store.{name}", getattr(media_store, name)))
+
+    new_track_context = downloader.new_track_context
+
+    def stamped_context(*args, **kwargs):
+        ctx = new_track_context(*args, **kwargs)
+        ctx['bench_started'] = time.perf_counter()
+        return ctx
+    downloader.new_track_context = stamped_context
+
+    for index, (name, stage) in enumerate(downloader.TRACK_STAGES):
+        if name == 'tag':
+            def timed_tag(ctx, stage=stage):
+                ctx = stage(ctx)
+                if 'bench_started' in ctx:
+                    probe_ref[0].add_latency(time.perf_counter() - ctx['bench_started'])
+                return ctx
+            downloader.TRACK_STAGES[index] = (name, timed_tag)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def peak_rss_mb():
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024  # bytes on macOS, KiB elsewhere
+    return {
+        'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6, 1),
+        'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 1e6, 1),
+    }
+
+
+def summarize(probe, tracks, elapsed, counts, extra=None):
+    latencies_ms = [s * 1000 for s in probe.latencies]
+    io = {name: {'calls': calls, 'seconds': round(total, 3)} for name, (calls, total) in sorted(probe.io.items())}
+    result = {
+        'tracks': tracks,
+        'counts': counts,
+        'elapsed_seconds': round(elapsed, 2),
+        'tracks_per_minute': round(tracks * 60 / elapsed, 1) if elapsed > 0 else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies_ms, 50), 1),
+            'p90': round(percentile(latencies_ms, 90), 1),
+            'p99': round(percentile(latencies_ms, 99), 1),
+            'max': round(max(latencies_ms), 1) if latencies_ms else 0.0,
+        },
+        'index_io_seconds': round(sum(v['seconds'] for k, v in io.items() if k.startswith('index_db.')), 3),
+        'store_io_seconds': round(sum(v['seconds'] for k, v in io.items() if k.startswith('media_store.')), 3),
+        'io': io,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    result.update(extra or {})
+    return result
+
+
+# ---------------------------------------------------------------------------
+# Workload
+# ---------------------------------------------------------------------------
+
+def load_rows(csv_path, repeat, scenario, cover_base, cold):
+    """The CSV's rows `repeat` times over, with URIs unique per copy and covers pointing at the local server."""
+    with open(csv_path, 'r', encoding='utf-8-sig', newline='') as f:
+        reader = csv.DictReader(f)
+        header = reader.fieldnames
+        rows = list(reader)
+    out = []
+    for copy in range(repeat):
+        for row in rows:
+            row = dict(row)
+            row['Track URI'] = f"{row['Track URI']}:{scenario}:{copy}"
+            if cold:
+                # Distinct names miss the search cache too
+                row['Track Name'] = f"{row['Track Name']} {scenario} {copy}"
+                row['ISRC'] = ''
+            if row.get('Album Image URL'):
+                digest = hashlib.sha1(row['Album Image URL'].encode('utf-8')).hexdigest()[:16]
+                row['Album Image URL'] = f"{cover_base}/cover/{digest}.jpg"
+            out.append(row)
+    return header, out
+
+
+def register_catalog(rows):
+    from .csv_ingest import parse_row
+    for row in rows:
+        track = parse_row(row)
+        FakeYoutubeDL.catalog[f"{track['artist']} - {track['name']}"] = (track.get('duration_ms') or 200000) / 1000.0
+
+
+def run_job_scenario(api, jobqueue, probe_ref, rows, args):
+    from .csv_ingest import parse_row
+    probe_ref[0] = probe = Probe()
+    user_id = 'bench-job'
+    # One playlist per replayed copy, like a user syncing many playlists
+    per_copy = len(rows) // args.repeat
+    playlists = [
+        api.PlaylistBatch(name=f"Bench {copy}", tracks=[api.Track(**parse_row(r)) for r in rows[copy * per_copy:(copy + 1) * per_copy]])
+        for copy in range(args.repeat)
+    ]
+
+    started = time.perf_counter()
+    api.run_download_job(user_id, playlists, args.quality, workers=args.workers)
+    elapsed = time.perf_counter() - started
+
+    state = api.get_job_state(user_id)
+    counts = jobqueue.job_counts(jobqueue.latest_job(user_id)['id'])
+    return summarize(probe, len(rows), elapsed, counts, {'job_stats': state.stats})
+
+
+def run_api_scenario(api, jobqueue, probe_ref, header, rows, args):
+    from fastapi.testclient import TestClient
+    probe_ref[0] = probe = Probe()
+    user_id = 'bench-api'
+    client = TestClient(api.app)
+
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=header)
+    writer.writeheader()
+    writer.writerows(rows)
+    payload = buf.getvalue().encode('utf-8')
+
+    # /api/status latency while the job runs (TestClient runs the background task inside the POST)
+    status_times = []
+    done = threading.Event()
+
+    def poll_status():
+        while not done.is_set():
+            t0 = time.perf_counter()
+            client.get('/api/status', params={'user_id': user_id})
+            status_times.append((time.perf_counter() - t0) * 1000)
+            done.wait(0.2)
+
+    poller = threading.Thread(target=poll_status, daemon=True)
+    poller.start()
+    started = time.perf_counter()
+    response = client.post('/api/csv-download', files={'file': ('bench.csv', payload, 'text/csv')},
+                           data={'user_id': user_id, 'quality': args.quality})
+    response.raise_for_status()
+    while api.get_job_state(user_id).status == 'working':
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    done.set()
+    poller.join()
+
+    t0 = time.perf_counter()
+    zipped = 0
+    with client.stream('GET', '/api/zip', params={'user_id': user_id}) as resp:
+        for chunk in resp.iter_bytes():
+            zipped += len(chunk)
+    zip_seconds = time.perf_counter() - t0
+
+    counts = jobqueue.job_counts(jobqueue.latest_job(user_id)['id'])
+    return summarize(probe, len(rows), elapsed, counts, {
+        'job_stats': api.get_job_state(user_id).stats,
+        'status_latency_ms': {'p50': round(percentile(status_times, 50), 2), 'p99': round(percentile(status_times, 99), 2)},
+        'zip': {'bytes': zipped, 'seconds': round(zip_seconds, 3),
+                'mb_per_second': round(zipped / 1e6 / zip_seconds, 1) if zip_seconds > 0 else 0.0},
+    })
+
+
+# Modules that make a cold start slow; the API process shouldn't load any of them
+HEAVY_MODULES = ('yt_dlp', 'pandas', 'mutagen', 'PIL', 'requests')
+# What each startup target imports: the API app, then the download path on top of it
+STARTUP_TARGETS = (
+    ('api', 'from web.api import main'),
+    ('download_path', 'from web.api import main, downloader'),
+)
+STARTUP_PROBE = '''
+import sys, time, json, resource
+started = time.perf_counter()
+{imports}
+seconds = time.perf_counter() - started
+scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+print(json.dumps({{
+    'seconds': seconds,
+    'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6,
+    'heavy_modules': [m for m in {heavy!r} if m in sys.modules],
+}}))
+'''
+
+
+def run_startup_scenario(args):
+    """Import time and baseline RSS of fresh interpreters (median of --startup-runs), per STARTUP_TARGETS."""
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    result = {}
+    for name, imports in STARTUP_TARGETS:
+        code = STARTUP_PROBE.format(imports=imports, heavy=HEAVY_MODULES)
+        runs = []
+        for _ in range(max(1, args.startup_runs)):
+            out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True)
+            if out.returncode != 0:
+                raise RuntimeError(f"import of {name} failed: {out.stderr.strip()[-500:]}")
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        result[name] = {
+            'import_seconds': round(percentile([r['seconds'] for r in runs], 50), 3),
+            'rss_mb': round(percentile([r['rss_mb'] for r in runs], 50), 1),
+            'heavy_modules': runs[-1]['heavy_modules'],
+        }
+    return result
+
+
+# ---------------------------------------------------------------------------
+# Results
+# ---------------------------------------------------------------------------
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+COMPARED_METRICS = (
+    ('tracks_per_minute', True),
+    ('latency_ms.p50', False),
+    ('latency_ms.p99', False),
+    ('index_io_seconds', False),
+    ('peak_rss_mb.self', False),
+    ('api.import_seconds', False),
+    ('api.rss_mb', False),
+    ('download_path.import_seconds', False),
+)
+
+
+def _metric(result, path):
+    for part in path.split('.'):
+        result = (result or {}).get(part)
+    return result
+
+
+def compare(previous, current):
+    """Print each headline metric as old -> new, flagging regressions."""
+    print(f"Comparing {previous.get('commit')} -> {current.get('commit')}")
+    for scenario, result in current['scenarios'].items():
+        old = previous.get('scenarios', {}).get(scenario)
+        if not old:
+            continue
+        print(f"  {scenario}:")
+        for path, higher_is_better in COMPARED_METRICS:
+            before, after = _metric(old, path), _metric(result, path)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            worse = change < 0 if higher_is_better else change > 0
+            flag = '  <- regression' if worse and abs(change) >= 5 else ''
+            print(f"    {path:20} {before:>10} -> {after:<10} ({change:+.1f}%){flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline Offlineify throughput benchmark")
+    parser.add_argument('--csv', default=DEFAULT_CSV, help="Spotify CSV export to replay")
+    parser.add_argument('--repeat', type=int, default=100, help="times the CSV is replayed")
+    parser.add_argument('--scenarios', default='job,api', help="comma-separated: job (run_download_job), api (HTTP endpoints), startup (cold import time and RSS)")
+    parser.add_argument('--workers', type=int, default=None, help="tracks in flight per job")
+    parser.add_argument('--quality', default='320')
+    parser.add_argument('--search-latency', type=float, default=0.05, help="seconds per fake search call")
+    parser.add_argument('--media-latency', type=float, default=0.2, help="seconds per fake download")
+    parser.add_argument('--audio-seconds', type=int, default=5, help="length of the generated audio file")
+    parser.add_argument('--startup-runs', type=int, default=5, help="fresh interpreters per startup measurement")
+    parser.add_argument('--cold', action='store_true', help="make every track miss the search cache")
+    parser.add_argument('--output', default=None, help="results JSON (default bench_results/<time>-<commit>.json)")
+    parser.add_argument('--compare', default=None, help="earlier results JSON to compare against")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directory")
+    args = parser.parse_args()
+
+    csv_path = os.path.abspath(args.csv)
+    commit = git_commit()
+    output = os.path.abspath(args.output or os.path.join(
+        'bench_results', f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{commit or 'nogit'}.json"))
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    # Scratch directory: every relative default (downloads/, *.db, cover_cache/) lands here
+    workdir = tempfile.mkdtemp(prefix='offlineify-bench-')
+    os.chdir(workdir)
+    for key, value in UNTHROTTLED.items():
+        os.environ.setdefault(key, value)
+    os.environ['OFFLINEIFY_QUEUE_MODE'] = 'inline'
+
+    # Imported only now, so module-level settings pick up the environment above
+    from . import main as api
+    from . import downloader, index_db, jobqueue, media_store, ydl_pool
+
+    FakeYoutubeDL.sample_path = os.path.join(workdir, 'sample.m4a')
+    FakeYoutubeDL.search_latency = args.search_latency
+    FakeYoutubeDL.media_latency = args.media_latency
+    make_sample_audio(FakeYoutubeDL.sample_path, args.audio_seconds)
+    ydl_pool.use_factory(FakeYoutubeDL)
+
+    server = start_cover_server()
+    cover_base = f"http://127.0.0.1:{server.server_address[1]}"
+    probe_ref = [Probe()]
+    instrument(api, downloader, index_db, media_store, probe_ref)
+
+    results = {}
+    try:
+        for scenario in [s.strip() for s in args.scenarios.split(',') if s.strip()]:
+            if scenario == 'startup':
+                print("Running 'startup'...")
+                results[scenario] = result = run_startup_scenario(args)
+                for name, target in result.items():
+                    print(f"  {name}: {target['import_seconds']} s import, {target['rss_mb']} MB RSS, "
+                          f"heavy modules: {', '.join(target['heavy_modules']) or 'none'}")
+                continue
+            header, rows = load_rows(csv_path, args.repeat, scenario, cover_base, args.cold)
+            register_catalog(rows)
+            FakeYoutubeDL.counters.update(search=0, download=0)
+            print(f"Running '{scenario}' with {len(rows)} tracks...")
+            if scenario == 'job':
+                result = run_job_scenario(api, jobqueue, probe_ref, rows, args)
+            elif scenario == 'api':
+                result = run_api_scenario(api, jobqueue, probe_ref, header, rows, args)
+            else:
+                print(f"Unknown scenario: {scenario}")
+                continue
+            result['upstream_calls'] = dict(FakeYoutubeDL.counters)
+            result['ydl_pool'] = ydl_pool.stats()
+            results[scenario] = result
+            print(f"  {result['tracks_per_minute']} tracks/min, p50 {result['latency_ms']['p50']} ms, "
+                  f"p99 {result['latency_ms']['p99']} ms, index I/O {result['index_io_seconds']} s")
+    finally:
+        server.shutdown()
+        if not args.keep:
+            os.chdir('/')
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'commit': commit,
+        'created_at': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'cpu_count': os.cpu_count(),
+        'config': vars(args),
+        'scenarios': results,
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if previous:
+        compare(previous, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import os
+import io
+import hashlib
+import threading
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+from . import retry
+
+# Cache of ready-to-embed cover JPEGs, keyed by (url, crop mode).
+# Playlists repeat the same album art for every track of an album, so each
+# cover is downloaded, decoded, cropped and re-encoded once per deployment:
+#   memory (LRU) -> disk (COVER_CACHE_DIR) -> network (pooled session)
+COVER_CACHE_DIR = os.environ.get('OFFLINEIFY_COVER_CACHE_DIR', 'cover_cache')
+COVER_MEMORY_ITEMS = int(os.environ.get('OFFLINEIFY_COVER_MEMORY_ITEMS', '256'))
+COVER_TIMEOUT = (5, 15)  # (connect, read) seconds
+
+_memory = OrderedDict()
+_memory_lock = threading.Lock()
+
+# url+mode -> Event for fetches in progress, so concurrent tracks of the
+# same album wait for one download instead of starting their own.
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Shared keep-alive session for cover hosts."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def cache_key(url, square_crop):
+    mode = 'square' if square_crop else 'original'
+    return hashlib.sha256(f"{url}|{mode}".encode('utf-8')).hexdigest()
+
+
+def process_image(data, square_crop):
+    """Decode, optionally center-crop to a square, and re-encode as JPEG."""
+    img = Image.open(io.BytesIO(data))
+
+    # Square Crop (Only if NOT from Spotify)
+    # Spotify images are 640x640 (Square) already.
+    if square_crop:
+        width, height = img.size
+        min_dim = min(width, height)
+        left = (width - min_dim) / 2
+        top = (height - min_dim) / 2
+        right = (width + min_dim) / 2
+        bottom = (height + min_dim) / 2
+        img = img.crop((left, top, right, bottom))
+
+    output_io = io.BytesIO()
+    img.convert('RGB').save(output_io, format='JPEG')
+    return output_io.getvalue()
+
+
+def _memory_get(key):
+    with _memory_lock:
+        data = _memory.get(key)
+        if data is not None:
+            _memory.move_to_end(key)
+        return data
+
+
+def _memory_put(key, data):
+    with _memory_lock:
+        _memory[key] = data
+        _memory.move_to_end(key)
+        while len(_memory) > COVER_MEMORY_ITEMS:
+            _memory.popitem(last=False)
+
+
+def _disk_path(key):
+    return os.path.join(COVER_CACHE_DIR, key[:2], f"{key}.jpg")
+
+
+def _disk_get(key):
+    try:
+        with open(_disk_path(key), 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _disk_put(key, data):
+    path = _disk_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Cover cache write error: {e}")
+
+
+def _lookup(key):
+    data = _memory_get(key)
+    if data is None:
+        data = _disk_get(key)
+        if data is not None:
+            _memory_put(key, data)
+    return data
+
+
+def cached_cover_jpeg(url, square_crop=False):
+    """The processed cover if it is already cached (memory or disk), without touching the network."""
+    if not url:
+        return None
+    return _lookup(cache_key(url, square_crop))
+
+
+def get_cover_jpeg(url, square_crop=False):
+    """
+    Return JPEG bytes ready for an APIC frame, or None if the cover can't be fetched.
+    Only one thread per (url, crop mode) ever hits the network.
+    """
+    if not url:
+        return None
+    key = cache_key(url, square_crop)
+
+    while True:
+        data = _lookup(key)
+        if data is not None:
+            return data
+
+        with _inflight_lock:
+            event = _inflight.get(key)
+            if event is None:
+                event = _inflight[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            # Someone else is fetching it: wait, then re-check the cache.
+            # If their fetch failed the cache is still empty and we try ourselves.
+            event.wait()
+            data = _lookup(key)
+            if data is not None:
+                return data
+            continue
+
+        try:
+            def fetch():
+                resp = get_session().get(url, timeout=COVER_TIMEOUT)
+                resp.raise_for_status()
+                return resp
+
+            resp = retry.call('cover', fetch, attempts=2)
+            data = process_image(resp.content, square_crop)
+            _memory_put(key, data)
+            _disk_put(key, data)
+            return data
+        except Exception as e:
+            print(f"Cover art error: {e}")
+            return None
+        finally:
+            with _inflight_lock:
+                _inflight.pop(key, None)
+            event.set()
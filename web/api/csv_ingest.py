@@ -0,0 +1,119 @@
+import os
+import csv
+import tempfile
+
+# Streaming parser for Spotify playlist CSV exports (Exportify format).
+# The upload is copied to a temp file in fixed-size chunks, then read back
+# row by row with the csv module, so memory stays flat for 10k+ row files
+# and the job can start downloading while later rows are still unparsed.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+REQUIRED_COLUMNS = ('Track URI', 'Track Name', 'Artist Name(s)')
+
+
+async def save_upload(upload, suffix='.csv'):
+    """Copy an UploadFile to a temp file chunk by chunk. Returns the path (caller deletes it)."""
+    fd, path = tempfile.mkstemp(prefix='offlineify_', suffix=suffix)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+def open_csv(path):
+    # utf-8-sig strips the BOM Excel likes to add
+    return open(path, 'r', encoding='utf-8-sig', newline='')
+
+
+def _utf8_lines(f):
+    # Decoding line by line (not in read-ahead chunks) fails at the bad line itself
+    for number, line in enumerate(f):
+        yield line.decode('utf-8-sig' if number == 0 else 'utf-8')
+
+
+def check_header(path):
+    """Read only the header row; raise ValueError if required columns are missing."""
+    with open_csv(path) as f:
+        header = next(csv.reader(f), None)
+    if not header:
+        raise ValueError("CSV file is empty")
+    missing = [c for c in REQUIRED_COLUMNS if c not in header]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+    return header
+
+
+def _text(row, column):
+    value = (row.get(column) or '').strip()
+    return value or None
+
+
+def _int(row, column):
+    value = _text(row, column)
+    if value is None:
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
+
+
+def parse_row(row):
+    """Map one CSV row to Track fields. Raises ValueError for rows that can't be downloaded."""
+    uri = _text(row, 'Track URI')
+    name = _text(row, 'Track Name')
+    artist = _text(row, 'Artist Name(s)')
+    if not uri or not name or not artist:
+        raise ValueError("missing Track URI, Track Name or Artist Name(s)")
+
+    explicit = (_text(row, 'Explicit') or 'false').lower() == 'true'
+    isrc = _text(row, 'ISRC')
+    return {
+        'uri': uri,
+        'name': name,
+        'artist': artist,
+        'album': _text(row, 'Album Name') or '',
+        'cover_url': _text(row, 'Album Image URL'),
+        'release_date': _text(row, 'Album Release Date'),
+        'track_number': _int(row, 'Track Number'),
+        'disc_number': _int(row, 'Disc Number'),
+        'duration_ms': _int(row, 'Track Duration (ms)'),
+        'isrc': isrc.upper() if isrc else None,
+        'explicit': explicit,
+    }
+
+
+def iter_csv_tracks(path, on_invalid=None):
+    """
+    Yield Track field dicts one row at a time.
+    Invalid rows are skipped; on_invalid(line_number, reason) is called for each.
+    A line that isn't UTF-8 or valid CSV ends the stream (only the header is
+    checked up front): the rows before it are kept, on_invalid reports the rest.
+    """
+    with open(path, 'rb') as f:
+        reader = csv.DictReader(_utf8_lines(f))
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except UnicodeDecodeError as e:
+                if on_invalid:
+                    on_invalid(reader.line_num + 1, f"not UTF-8, rest of the file skipped ({e})")
+                return
+            except csv.Error as e:
+                if on_invalid:
+                    on_invalid(reader.line_num, f"unreadable, rest of the file skipped ({e})")
+                return
+            try:
+                yield parse_row(row)
+            except ValueError as e:
+                if on_invalid:
+                    on_invalid(reader.line_num, str(e))
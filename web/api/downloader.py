@@ -1,221 +1,640 @@
-import yt_dlp
 import os
-import json
-import pandas as pd
-import requests
-from PIL import Image
-import io
+import time
+import base64
+import threading
+import subprocess
+from datetime import datetime
+import mutagen
 from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, APIC, TALB, TPE1, TIT2, TDRC, TRCK, TXXX, error
+from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
+from mutagen.flac import Picture
+from mutagen.id3 import ID3, APIC, TALB, TPE1, TIT2, TDRC, TPOS, TRCK, TSRC, TXXX, error
+from . import retry
+from . import index_db
+from . import search_cache
+from . import cover_cache
+from . import media_store
+from . import ydl_pool
+from . import matcher
+from . import identity
+from . import metrics
 
-DOWNLOAD_INDEX_FILE = 'downloaded_songs.json'
 DOWNLOAD_DIR = 'downloads'
 
-def load_download_index():
-    if os.path.exists(DOWNLOAD_INDEX_FILE):
-        try:
-            with open(DOWNLOAD_INDEX_FILE, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"Error loading index file: {e}")
-            return {}
-    return {}
+# 'dual' = "audio" search, then "lyrics" + a wider flat search only while no candidate is confident
+# 'flat' = one metadata-only search returning SEARCH_FLAT_RESULTS candidates
+SEARCH_MODE = os.environ.get('OFFLINEIFY_SEARCH_MODE', 'dual')
+SEARCH_FLAT_RESULTS = int(os.environ.get('OFFLINEIFY_SEARCH_FLAT_RESULTS', '5'))
 
-def save_download_index(index):
-    try:
-        with open(DOWNLOAD_INDEX_FILE, 'w') as f:
-            json.dump(index, f, indent=4)
-    except Exception as e:
-        print(f"Error saving index file: {e}")
+# Output format policy:
+# 'mp3'    = encode every track to MP3 at the job's quality (default)
+# 'native' = keep the downloaded codec, no re-encode: AAC as .m4a, Opus as .opus, Vorbis as .ogg
+# 'm4a'    = like 'native', but prefer AAC streams when YouTube offers them
+OUTPUT_FORMAT = os.environ.get('OFFLINEIFY_OUTPUT_FORMAT', 'mp3')
+# acodec prefix -> extension a stream is kept as in native mode
+NATIVE_EXTENSIONS = (('mp4a', '.m4a'), ('aac', '.m4a'), ('opus', '.opus'), ('vorbis', '.ogg'), ('mp3', '.mp3'))
 
-def process_track(track, ydl_opts=None):
-    """
-    Downloads a single track using the logic:
-    1. Check Index (Deduplication)
-    2. Smart Selection (3-way Comparison)
-    3. Download
-    4. Embed Square-Crop Art
-    5. Update Index
-    """
-    if not os.path.exists(DOWNLOAD_DIR):
-        os.makedirs(DOWNLOAD_DIR)
+# ffmpeg processes running at once across all jobs in this process: one per core
+FFMPEG_PROCESSES = int(os.environ.get('OFFLINEIFY_FFMPEG_PROCESSES', str(os.cpu_count() or 2)))
+_ffmpeg_slots = threading.BoundedSemaphore(max(1, FFMPEG_PROCESSES))
 
-    download_index = load_download_index()
-    
-    track_uri = track.get('uri')
-    track_name = track.get('name')
-    artist_name = track.get('artist')
-    
-    # Use provided output_dir or default
+def default_ydl_opts(output_dir=DOWNLOAD_DIR, quality='320'):
+    return {
+        'format': 'bestaudio/best',
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'mp3',
+            'preferredquality': quality,
+        }],
+        'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
+        'quiet': True,
+        'no_warnings': True,
+        'ignoreerrors': True,
+    }
+
+def job_ydl_opts(base_output_path, quality='320'):
+    """Options for a download job; run_download_job/workers override outtmpl per playlist."""
+    return {
+        'format': 'bestaudio[ext=m4a]/bestaudio/best' if OUTPUT_FORMAT == 'm4a' else 'bestaudio/best',
+        'output_format': OUTPUT_FORMAT,
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'mp3',
+            'preferredquality': quality,
+        }],
+        'outtmpl': f'{base_output_path}/%(artist)s - %(title)s.%(ext)s',
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,
+        'cookiesfrombrowser': ('chrome',), # Use Chrome cookies to bypass bot detection
+    }
+
+def preferred_quality(ydl_opts):
+    """Read the MP3 quality out of the FFmpegExtractAudio postprocessor entry."""
+    for pp in ydl_opts.get('postprocessors', []):
+        if pp.get('key') == 'FFmpegExtractAudio':
+            return str(pp.get('preferredquality', '320'))
+    return '320'
+
+def output_extension(ydl_opts, acodec):
+    """Extension the finished file gets for a stream with codec `acodec` under the job's format policy."""
+    if ydl_opts.get('output_format', 'mp3') != 'mp3':
+        codec = (acodec or '').lower()
+        for prefix, extension in NATIVE_EXTENSIONS:
+            if codec.startswith(prefix):
+                return extension
+    return '.mp3'
+
+# ---------------------------------------------------------------------------
+# Pipeline stages
+#
+# Each stage takes and returns a context dict ("ctx") for one track. A stage
+# that finishes the track early (skip / error) sets ctx['result'], and the
+# pipeline hands it straight to the job instead of the next stage.
+#
+#   resolve   -> index check + YouTube search + Smart Selection   (network)
+#   fetch     -> download the raw audio stream, no postprocessing (network)
+#   transcode -> ffmpeg to MP3, or remux/keep the native stream    (CPU)
+#   tag       -> cover art + ID3 tags + index update               (network + disk)
+# ---------------------------------------------------------------------------
+
+def new_track_context(track, ydl_opts=None):
     output_dir = ydl_opts.get('output_dir', DOWNLOAD_DIR) if ydl_opts else DOWNLOAD_DIR
-    
-    # 1. Deduplication (Check actual file existence too?)
-    # For now, we stick to the index check, but maybe we should check the new folder?
-    # Let's keep index check global for simplicity.
-    # 1. Deduplication (Enhanced for Custom Paths)
-    if track_uri in download_index:
-        recorded_filename = download_index[track_uri].get('filename')
-        if recorded_filename:
-            # Check if it exists in the CURRENT output directory
-            expected_path = os.path.join(output_dir, recorded_filename)
-            if os.path.exists(expected_path):
-                 return {"status": "skipped", "message": "Already downloaded", "filename": recorded_filename}
 
     # Default options if not provided
     if ydl_opts is None:
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '320',
-            }],
-            'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
-            'quiet': True,
-            'no_warnings': True,
-            'ignoreerrors': True,
-        }
+        ydl_opts = default_ydl_opts(output_dir)
     else:
+        ydl_opts = dict(ydl_opts)
         # Ensure outtmpl uses the correct directory
         if 'output_dir' in ydl_opts:
              ydl_opts['outtmpl'] = os.path.join(ydl_opts['output_dir'], '%(title)s.%(ext)s')
-             # Ensure dir exists
-             if not os.path.exists(ydl_opts['output_dir']):
-                 os.makedirs(ydl_opts['output_dir'])
 
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+    return {
+        'track': track,
+        'ydl_opts': ydl_opts,
+        'output_dir': output_dir,
+        'result': None,
+    }
+
+def resolve_stage(ctx):
+    """1. Check Index (Deduplication) 2. Search Cache 3. Smart Selection (3-way Comparison)"""
+    track = ctx['track']
+    output_dir = ctx['output_dir']
+
+    # 1. Deduplication (Enhanced for Custom Paths) - single indexed lookup
+    track_uri = track.get('uri')
+    with metrics.span('index_lookup', ctx):
+        entry = index_db.get_track(track_uri)
+    if entry:
+        recorded_filename = entry.get('filename')
+        if recorded_filename:
+            # Check if it exists in the CURRENT output directory
+            expected_path = os.path.join(output_dir, recorded_filename)
+            if os.path.exists(expected_path):
+                 ctx['result'] = {"status": "skipped", "message": "Already downloaded", "filename": recorded_filename}
+                 return ctx
+            # Downloaded before for another playlist/user: link the stored blob instead
+            if media_store.has_blob(entry.get('content_hash')):
+                 if media_store.link(entry['content_hash'], expected_path):
+                     ctx['result'] = {"status": "skipped", "message": "Linked from media store", "filename": recorded_filename}
+                     return ctx
+
+    # 1b. Same recording under another URI (single / album / deluxe edition):
+    # reuse that audio, tag_stage re-tags it for this release
+    with metrics.span('identity_lookup', ctx):
+        recording = identity.find_recording(track, ctx['ydl_opts'].get('output_format', 'mp3'))
+    if recording:
+        if os.path.exists(os.path.join(output_dir, recording['filename'])):
+            # Both releases are in this playlist: they share the file. Index this
+            # URI at it too, so syncs count it as present (the library row lists both URIs)
+            if track_uri:
+                index_db.upsert_track(
+                    track_uri,
+                    name=track.get('name'),
+                    artist=track.get('artist'),
+                    isrc=track.get('isrc'),
+                    filename=recording['filename'],
+                    output_path=os.path.join(output_dir, recording['filename']),
+                    content_hash=recording.get('content_hash'),
+                    title_key=identity.title_key(track),
+                    duration_ms=track.get('duration_ms'),
+                )
+            ctx['result'] = {"status": "skipped", "message": "Same recording already in folder", "filename": recording['filename'],
+                             "reused_from": recording['uri']}
+            return ctx
+        file_path = identity.reuse(recording, output_dir)
+        if file_path:
+            ctx['file_path'] = file_path
+            ctx['final_filename'] = recording['filename']
+            ctx['reused_from'] = recording['uri']
+            return ctx
+
+    # 2. Cached selection from an earlier run -> no search round trips at all
+    with metrics.span('search_cache', ctx):
+        cached = search_cache.get(track)
+    if cached and cached.get('selected_url'):
+        ctx['webpage_url'] = cached['selected_url']
+        ctx['thumbnail'] = cached.get('thumbnail')
+        ctx['search_cached'] = True
+        return ctx
+
+    return search_track(ctx)
+
+def search_track(ctx):
+    """Search for the track, pick the best candidate and cache the choice (sets webpage_url/thumbnail, or an error result)."""
+    track = ctx['track']
+    with metrics.span('search', ctx):
+        if SEARCH_MODE == 'flat':
+            info_official, candidates = search_candidates_flat(track, ctx['ydl_opts'])
+        else:
+            info_official, candidates = search_candidates(track, ctx['ydl_opts'])
+
+    if not candidates:
+         ctx['result'] = {"status": "error", "message": "No results found", "error_class": retry.NOT_FOUND}
+         return ctx
+
+    selected_info = select_candidate(track, candidates)
+    official = search_cache.candidate_summary(info_official or candidates[0])
+
+    ctx['webpage_url'] = search_cache.candidate_summary(selected_info)['webpage_url']
+    ctx['thumbnail'] = official['thumbnail']
+    search_cache.put(track, candidates, ctx['webpage_url'], ctx['thumbnail'])
+    return ctx
+
+def search_candidates(track, ydl_opts):
+    """
+    Staged search, stopping as soon as a candidate is confident (see matcher.py):
+    1. top "audio" hit  2. top 2 "lyrics" hits  3. SEARCH_FLAT_RESULTS metadata-only hits
+    """
+    track_name = track.get('name')
+    artist_name = track.get('artist')
+    candidates = []
+
+    with ydl_pool.session(ydl_opts) as ydl:
+        # 1. "Official" search - usually enough when the duration agrees with Spotify
+        info_official = retry.call('search', lambda: ydl.extract_info(f"ytsearch1:{artist_name} - {track_name} audio", download=False))
+        if info_official and 'entries' in info_official:
+            info_official = (info_official['entries'] or [None])[0]
+        if info_official:
+            candidates.append(info_official)
+            if matcher.confident(track, info_official):
+                return info_official, candidates
+
+        # 2. "Lyrics" search (Top 2)
+        info_lyrics_results = retry.call('search', lambda: ydl.extract_info(f"ytsearch2:{artist_name} - {track_name} lyrics", download=False))
+        candidates += [e for e in (info_lyrics_results or {}).get('entries') or [] if e]
+        if any(matcher.confident(track, c) for c in candidates):
+            return info_official, candidates
+
+    # 3. Still unsure: widen with a cheap metadata-only search (only useful when durations can be checked)
+    if not track.get('duration_ms'):
+        return info_official, candidates
+    _, wider = search_candidates_flat(track, ydl_opts)
+    seen = {c.get('id') for c in candidates}
+    candidates += [c for c in wider if c.get('id') not in seen]
+    return info_official, candidates
+
+def search_candidates_flat(track, ydl_opts):
+    """
+    Single round trip: one metadata-only (flat) search for the top
+    SEARCH_FLAT_RESULTS videos. The first hit plays the role of "Official".
+    """
+    with ydl_pool.session(ydl_opts, extract_flat='in_playlist') as ydl:
+        results = retry.call('search', lambda: ydl.extract_info(
+            f"ytsearch{SEARCH_FLAT_RESULTS}:{track.get('artist')} - {track.get('name')}", download=False
+        ))
+
+    candidates = [e for e in ((results or {}).get('entries') or []) if e]
+    if not candidates:
+        return None, []
+    return candidates[0], candidates
+
+def select_candidate(track, candidates):
+    """Smart Selection V3: highest matcher score (duration, ISRC, title/artist tokens, channel)."""
+    if not track.get('duration_ms'):
+        return select_candidate_by_spread(candidates)
+    selected, score = matcher.best_match(track, candidates)
+    if not matcher.confident(track, selected, score):
+        print(f"Low-confidence match ({score:.2f}) for {track.get('artist')} - {track.get('name')}: {selected.get('title')}")
+    return selected
+
+def select_candidate_by_spread(candidates):
+    """Smart Selection V2, for tracks without a known duration: if durations disagree by more than 2s, prefer the shortest (>30s) one."""
+    valid_candidates = [c for c in candidates if (c.get('duration') or 0) > 30]
+    if not valid_candidates:
+         valid_candidates = candidates
+
+    shortest_candidate = min(valid_candidates, key=lambda x: x.get('duration') or 0)
+    durations = [c.get('duration') or 0 for c in valid_candidates]
+    if max(durations) - min(durations) > 2:
+        return shortest_candidate
+    return candidates[0]
+
+def download_media(ctx):
+    """Download ctx['webpage_url'] (sets ctx['source_path']). Returns the video's info dict."""
+    # Pooled instance: postprocessors are never set on it (see ydl_pool.IGNORED_OPTIONS)
+    with metrics.span('media_download', ctx), ydl_pool.session(ctx['ydl_opts']) as ydl:
+        result = retry.call('media', lambda: ydl.extract_info(ctx['webpage_url'], download=True))
+        if 'entries' in result:
+            video_info = result['entries'][0]
+        else:
+            video_info = result
+        ctx['source_path'] = ydl.prepare_filename(video_info)
+    return video_info
+
+def fetch_stage(ctx):
+    """3. Download the best audio stream as-is (conversion happens in transcode_stage)."""
+    if ctx.get('reused_from'):
+        return ctx
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            # search queries
-            query_official = f"{artist_name} - {track_name} audio"
-            query_lyrics = f"{artist_name} - {track_name} lyrics"
-            
-            # 1. Fetch metadata for "Official" search
-            info_official = ydl.extract_info(f"ytsearch1:{query_official}", download=False)
-            if 'entries' in info_official:
-                info_official = info_official['entries'][0]
-            
-            # 2. Fetch metadata for "Lyrics" search (Top 2)
-            info_lyrics_results = ydl.extract_info(f"ytsearch2:{query_lyrics}", download=False)
-            lyrics_candidates = []
-            if 'entries' in info_lyrics_results:
-                 for entry in info_lyrics_results['entries']:
-                     lyrics_candidates.append(entry)
-            
-            # 3. Smart Selection V2
-            candidates = [info_official] + lyrics_candidates
-            candidates = [c for c in candidates if c]
-
-            if not candidates:
-                 return {"status": "error", "message": "No results found"}
-
-            official_duration = info_official.get('duration', 0)
-            valid_candidates = [c for c in candidates if c.get('duration', 0) > 30]
-            if not valid_candidates:
-                 valid_candidates = candidates
-
-            shortest_candidate = min(valid_candidates, key=lambda x: x.get('duration', 0))
-            
-            # Logic: If max diff > 2s, pick shortest. Else Official.
-            max_diff = 0
-            if valid_candidates:
-                durations = [c.get('duration', 0) for c in valid_candidates]
-                max_diff = max(durations) - min(durations)
-
-            selected_info = info_official
-            if max_diff > 2:
-                selected_info = shortest_candidate
-
-            # 4. Download
-            result = ydl.extract_info(selected_info['webpage_url'], download=True)
-            if 'entries' in result:
-                video_info = result['entries'][0]
-            else:
-                video_info = result
-
-            original_filename = ydl.prepare_filename(video_info)
-            base_name = os.path.splitext(os.path.basename(original_filename))[0]
-            final_filename = f"{base_name}.mp3"
-            
-            # Fix: Use output_dir for the tagging path, NOT the default DOWNLOAD_DIR
-            file_path = os.path.join(output_dir, final_filename)
-            
-            # 5. Embed Cover Art (Force Official Thumbnail + Square Crop)
-            # Priority: Provided Spotify URL > Official YouTube Thumbnail
-            cover_url = track.get('cover_url') or info_official.get('thumbnail')
-            is_spotify_image = bool(track.get('cover_url'))
-            
-            if cover_url:
-                try:
-                    resp = requests.get(cover_url)
-                    img = Image.open(io.BytesIO(resp.content))
-                    
-                    # Square Crop (Only if NOT from Spotify)
-                    # Spotify images are 640x640 (Square) already.
-                    if not is_spotify_image:
-                        width, height = img.size
-                        min_dim = min(width, height)
-                        left = (width - min_dim) / 2
-                        top = (height - min_dim) / 2
-                        right = (width + min_dim) / 2
-                        bottom = (height + min_dim) / 2
-                        img_cropped = img.crop((left, top, right, bottom))
-                    else:
-                        img_cropped = img # No crop needed
-                    
-                    output_io = io.BytesIO()
-                    img_cropped.convert('RGB').save(output_io, format='JPEG')
-                    processed_data = output_io.getvalue()
-                    
-                    audio = MP3(file_path, ID3=ID3)
-                    try: audio.add_tags()
-                    except error: pass
-
-                    audio.tags.add(
-                        APIC(
-                            encoding=3,
-                            mime='image/jpeg',
-                            type=3,
-                            desc=u'Cover',
-                            data=processed_data
-                        )
-                    )
-                    
-                    # Add Standard Metadata
-                    audio.tags.add(TIT2(encoding=3, text=track_name))
-                    audio.tags.add(TPE1(encoding=3, text=artist_name))
-                    
-                    if track.get('album'):
-                        audio.tags.add(TALB(encoding=3, text=track['album']))
-                        
-                    if track.get('release_date'):
-                         audio.tags.add(TDRC(encoding=3, text=track['release_date']))
-                         
-                    if track.get('track_number'):
-                        # TRCK format: "current/total" or just "current"
-                        trck_val = str(track['track_number'])
-                        if track.get('total_tracks'):
-                            trck_val += f"/{track['total_tracks']}"
-                        audio.tags.add(TRCK(encoding=3, text=trck_val))
-                        
-                    # Explicit Tag (iTunes proprietary but standard)
-                    # 1 = Explicit, 0 = Clean, 2 = Clean version of explicit
-                    if track.get('explicit') is not None:
-                        flag = '1' if track['explicit'] else '0'
-                        audio.tags.add(TXXX(encoding=3, desc='ITUNESADVISORY', text=flag))
-
-                    audio.save()
-                except Exception as e:
-                    print(f"Cover art error: {e}")
-
-            # Update index
-            download_index[track_uri] = {
-                'name': track_name,
-                'artist': artist_name,
-                'filename': final_filename,
-                'downloaded_at': pd.Timestamp.now().isoformat()
-            }
-            save_download_index(download_index)
-            return {"status": "success", "filename": final_filename}
+        video_info = download_media(ctx)
+    except Exception as e:
+        if not ctx.get('search_cached') or retry.classify_error(e) != retry.NOT_FOUND:
+            raise
+        # The cached video was taken down since: forget it and search again
+        print(f"Cached video unavailable, searching again: {ctx['track'].get('name')}")
+        search_cache.invalidate(ctx['track'])
+        ctx['search_cached'] = False
+        search_track(ctx)
+        if ctx['result'] is not None:
+            return ctx
+        video_info = download_media(ctx)
 
+    base_name = os.path.splitext(os.path.basename(ctx['source_path']))[0]
+    ctx['final_filename'] = base_name + output_extension(ctx['ydl_opts'], video_info.get('acodec'))
+    # Fix: Use output_dir for the tagging path, NOT the default DOWNLOAD_DIR
+    ctx['file_path'] = os.path.join(ctx['output_dir'], ctx['final_filename'])
+    return ctx
+
+def run_ffmpeg(args):
+    """
+    Run ffmpeg with `args` once a process slot is free (FFMPEG_PROCESSES).
+    Returns the CPU seconds the ffmpeg process used (0.0 where unavailable).
+    """
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error'] + args
+    with _ffmpeg_slots:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        stderr = proc.stderr.read()
+        proc.stderr.close()
+        cpu_seconds = 0.0
+        if hasattr(os, 'wait4'):
+            # wait4 reports this child's own rusage, unlike RUSAGE_CHILDREN with parallel encodes
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            cpu_seconds = usage.ru_utime + usage.ru_stime
+        else:
+            proc.wait()
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {stderr.decode('utf-8', 'replace').strip()[-300:]}")
+    return cpu_seconds
+
+def run_ffmpeg_to(args, target_path):
+    """
+    run_ffmpeg writing `target_path` through a temp file next to it. An
+    existing file there may be a hardlink into the media store: it is
+    replaced, never truncated and rewritten in place (`-y`) under every link.
+    """
+    base, ext = os.path.splitext(target_path)
+    tmp_path = f"{base}.ffmpeg{ext}"  # Same extension: ffmpeg picks the muxer from it
+    try:
+        cpu_seconds = run_ffmpeg(args + [tmp_path])
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return cpu_seconds
+
+def transcode_audio(source_path, target_path, quality='320'):
+    """
+    Convert `source_path` to MP3 at `target_path` and remove the source.
+    Same quality semantics as yt-dlp's FFmpegExtractAudio: values <= 10 are
+    VBR levels, anything larger is a bitrate in kbit/s.
+    Returns ffmpeg's CPU seconds.
+    """
+    if os.path.abspath(source_path) == os.path.abspath(target_path):
+        # Already MP3: re-encode from a temp copy so ffmpeg doesn't read and write one file
+        tmp_path = f"{source_path}.src"
+        os.replace(source_path, tmp_path)
+        source_path = tmp_path
+
+    if int(quality) <= 10:
+        quality_args = ['-q:a', str(quality)]
+    else:
+        quality_args = ['-b:a', f'{quality}k']
+
+    cpu_seconds = run_ffmpeg_to(['-i', source_path, '-vn', '-codec:a', 'libmp3lame'] + quality_args, target_path)
+    os.remove(source_path)
+    return cpu_seconds
+
+def remux_audio(source_path, target_path):
+    """Copy the audio stream into the container `target_path` implies (no re-encode). Returns ffmpeg's CPU seconds."""
+    cpu_seconds = run_ffmpeg_to(['-i', source_path, '-vn', '-map', '0:a:0', '-codec:a', 'copy'], target_path)
+    os.remove(source_path)
+    return cpu_seconds
+
+def transcode_stage(ctx):
+    """4. Convert to MP3, or keep the native stream (OUTPUT_FORMAT). Encodes share the ffmpeg process slots."""
+    if ctx.get('reused_from'):
+        return ctx
+    source_path, file_path = ctx['source_path'], ctx['file_path']
+    source_ext = os.path.splitext(source_path)[1]
+    target_ext = os.path.splitext(file_path)[1]
+    cpu_seconds = 0.0
+    with metrics.span('ffmpeg', ctx):
+        if ctx['ydl_opts'].get('output_format', 'mp3') == 'mp3' or (target_ext == '.mp3' and source_ext != '.mp3'):
+            cpu_seconds = transcode_audio(source_path, file_path, preferred_quality(ctx['ydl_opts']))
+        elif source_ext != target_ext:
+            cpu_seconds = remux_audio(source_path, file_path)
+        elif os.path.abspath(source_path) != os.path.abspath(file_path):
+            os.replace(source_path, file_path)
+    ctx['cpu_seconds'] = ctx.get('cpu_seconds', 0.0) + cpu_seconds
+    return ctx
+
+def tag_stage(ctx):
+    """5. Embed Square-Crop Art 6. Store Blob + Update Index"""
+    track = ctx['track']
+    track_uri = track.get('uri')
+    track_name = track.get('name')
+    artist_name = track.get('artist')
+    file_path = ctx['file_path']
+    final_filename = ctx['final_filename']
+
+    # 5. Embed Cover Art (Force Official Thumbnail + Square Crop)
+    # Priority: Provided Spotify URL > Official YouTube Thumbnail
+    cover_url = track.get('cover_url') or ctx.get('thumbnail')
+    is_spotify_image = bool(track.get('cover_url'))
+
+    # Cached per (url, crop mode): an album's cover is fetched and encoded once
+    with metrics.span('cover_fetch', ctx):
+        cover_data = cover_cache.get_cover_jpeg(cover_url, square_crop=not is_spotify_image)
+
+    with metrics.span('tag_write', ctx):
+        try:
+            write_tags(file_path, track, cover_data, replace=bool(ctx.get('reused_from')))
+        except Exception as e:
+            print(f"Tagging error: {e}")
+
+    # Hand the finished file to the content-addressed store (dedups identical bytes)
+    content_hash = None
+    with metrics.span('media_store', ctx):
+        try:
+            content_hash = media_store.ingest(file_path)
+        except Exception as e:
+            print(f"Media store error: {e}")
+
+    # Update index (row-level upsert, safe with concurrent writers)
+    with metrics.span('index_save', ctx):
+        index_db.upsert_track(
+            track_uri,
+            name=track_name,
+            artist=artist_name,
+            isrc=track.get('isrc'),
+            filename=final_filename,
+            output_path=file_path,
+            downloaded_at=datetime.now().isoformat(),
+            content_hash=content_hash,
+            title_key=identity.title_key(track),
+            duration_ms=track.get('duration_ms'),
+        )
+
+    ctx['result'] = {"status": "success", "filename": final_filename}
+    if ctx.get('reused_from'):
+        ctx['result'].update(message=f"Reused audio of {ctx['reused_from']}", reused_from=ctx['reused_from'])
+    return ctx
+
+def write_tags(file_path, track, cover_data=None, replace=False):
+    """
+    Write metadata (and the cover, if any) for `track` in the tag format of the file's container.
+    replace=True drops existing tags first (re-tagging audio reused from another release).
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == '.m4a':
+        write_mp4_tags(file_path, track, cover_data, replace)
+    elif extension in ('.opus', '.ogg'):
+        write_vorbis_tags(file_path, track, cover_data, replace)
+    else:
+        write_id3_tags(file_path, track, cover_data, replace)
+
+def write_id3_tags(file_path, track, cover_data=None, replace=False):
+    """Write ID3 metadata (and the cover, if any) for `track` into an MP3."""
+    audio = MP3(file_path, ID3=ID3)
+    try: audio.add_tags()
+    except error: pass
+    if replace:
+        audio.tags.clear()
+
+    if cover_data:
+        audio.tags.add(
+            APIC(
+                encoding=3,
+                mime='image/jpeg',
+                type=3,
+                desc=u'Cover',
+                data=cover_data
+            )
+        )
+
+    # Add Standard Metadata
+    audio.tags.add(TIT2(encoding=3, text=track.get('name')))
+    audio.tags.add(TPE1(encoding=3, text=track.get('artist')))
+
+    if track.get('album'):
+        audio.tags.add(TALB(encoding=3, text=track['album']))
+
+    if track.get('release_date'):
+         audio.tags.add(TDRC(encoding=3, text=track['release_date']))
+
+    if track.get('track_number'):
+        # TRCK format: "current/total" or just "current"
+        trck_val = str(track['track_number'])
+        if track.get('total_tracks'):
+            trck_val += f"/{track['total_tracks']}"
+        audio.tags.add(TRCK(encoding=3, text=trck_val))
+
+    if track.get('disc_number'):
+        audio.tags.add(TPOS(encoding=3, text=str(track['disc_number'])))
+
+    if track.get('isrc'):
+        audio.tags.add(TSRC(encoding=3, text=track['isrc']))
+
+    # Explicit Tag (iTunes proprietary but standard)
+    # 1 = Explicit, 0 = Clean, 2 = Clean version of explicit
+    if track.get('explicit') is not None:
+        flag = '1' if track['explicit'] else '0'
+        audio.tags.add(TXXX(encoding=3, desc='ITUNESADVISORY', text=flag))
+
+    audio.save()
+
+def write_mp4_tags(file_path, track, cover_data=None, replace=False):
+    """Same metadata as write_id3_tags, as iTunes atoms in an .m4a."""
+    audio = MP4(file_path)
+    if audio.tags is None:
+        audio.add_tags()
+    if replace:
+        audio.tags.clear()
+
+    if cover_data:
+        audio['covr'] = [MP4Cover(cover_data, imageformat=MP4Cover.FORMAT_JPEG)]
+    audio['\xa9nam'] = [track.get('name') or '']
+    audio['\xa9ART'] = [track.get('artist') or '']
+    if track.get('album'):
+        audio['\xa9alb'] = [track['album']]
+    if track.get('release_date'):
+        audio['\xa9day'] = [track['release_date']]
+    if track.get('track_number'):
+        audio['trkn'] = [(track['track_number'], track.get('total_tracks') or 0)]
+    if track.get('disc_number'):
+        audio['disk'] = [(track['disc_number'], 0)]
+    if track.get('isrc'):
+        audio['----:com.apple.iTunes:ISRC'] = [MP4FreeForm(track['isrc'].encode('utf-8'))]
+    # iTunes advisory: 1 = Explicit, 2 = Clean
+    if track.get('explicit') is not None:
+        audio['rtng'] = [1 if track['explicit'] else 2]
+    audio.save()
+
+def write_vorbis_tags(file_path, track, cover_data=None, replace=False):
+    """Same metadata as write_id3_tags, as Vorbis comments in an .opus/.ogg."""
+    audio = mutagen.File(file_path)
+    if audio is None:
+        raise ValueError(f"Unsupported audio file: {file_path}")
+    if audio.tags is None:
+        audio.add_tags()
+    if replace:
+        audio.tags.clear()
+
+    if cover_data:
+        picture = Picture()
+        picture.type = 3
+        picture.mime = 'image/jpeg'
+        picture.desc = 'Cover'
+        picture.data = cover_data
+        audio['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
+    audio['title'] = [track.get('name') or '']
+    audio['artist'] = [track.get('artist') or '']
+    if track.get('album'):
+        audio['album'] = [track['album']]
+    if track.get('release_date'):
+        audio['date'] = [track['release_date']]
+    if track.get('track_number'):
+        audio['tracknumber'] = [str(track['track_number'])]
+        if track.get('total_tracks'):
+            audio['tracktotal'] = [str(track['total_tracks'])]
+    if track.get('disc_number'):
+        audio['discnumber'] = [str(track['disc_number'])]
+    if track.get('isrc'):
+        audio['isrc'] = [track['isrc']]
+    if track.get('explicit') is not None:
+        audio['itunesadvisory'] = ['1' if track['explicit'] else '0']
+    audio.save()
+
+# Stage order used by both process_track and the job pipeline in main.py
+TRACK_STAGES = [
+    ('resolve', resolve_stage),
+    ('fetch', fetch_stage),
+    ('transcode', transcode_stage),
+    ('tag', tag_stage),
+]
+
+def warm_up(instances=1):
+    """
+    Pay the download path's one-time costs before the first track: this
+    module's imports (yt-dlp, mutagen, Pillow, requests), the index DB
+    connection, the cover session, `instances` pooled YoutubeDLs (cookies and
+    extractors loaded) and the ffmpeg binary. Returns seconds per step.
+    """
+    timings = {}
+
+    def step(name, fn):
+        started = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            print(f"Warm-up {name} failed: {e}")
+        timings[name] = round(time.perf_counter() - started, 3)
+
+    step('index_db', index_db.connect)
+    step('cover_session', cover_cache.get_session)
+    # The output path isn't part of the pool key, so these match any job's options
+    step('ydl_pool', lambda: ydl_pool.prewarm(job_ydl_opts(DOWNLOAD_DIR), instances))
+    step('ffmpeg', lambda: subprocess.run(['ffmpeg', '-version'], stdout=subprocess.DEVNULL,
+                                          stderr=subprocess.DEVNULL, check=True))
+    print(f"Warm-up done: {timings}")
+    return timings
+
+def process_track(track, ydl_opts=None):
+    """
+    Downloads a single track by running every pipeline stage inline:
+    1. Check Index (Deduplication)
+    2. Smart Selection (3-way Comparison)
+    3. Download
+    4. Convert to MP3 (or keep the native stream)
+    5. Embed Square-Crop Art
+    6. Update Index
+    The result carries the track's CPU seconds (this thread + ffmpeg) and
+    its stage/phase timings.
+    """
+    if not os.path.exists(DOWNLOAD_DIR):
+        os.makedirs(DOWNLOAD_DIR)
+
+    ctx = new_track_context(track, ydl_opts)
+    started = time.thread_time()
+    try:
+        for name, stage in TRACK_STAGES:
+            stage_started = time.perf_counter()
+            try:
+                ctx = stage(ctx)
+            finally:
+                metrics.observe_stage(ctx, name, time.perf_counter() - stage_started)
+            if ctx['result'] is not None:
+                break
     except Exception as e:
-        return {"status": "error", "message": str(e)}
+        ctx['result'] = retry.error_result(e)
+    result = ctx['result'] or {"status": "error", "message": "Pipeline produced no result"}
+    result['cpu_seconds'] = ctx.get('cpu_seconds', 0.0) + time.thread_time() - started
+    result['timings'] = ctx.get('timings', {})
+    return result
@@ -0,0 +1,40 @@
+import threading
+from collections import deque
+
+# Per-user job event log for the push channel (/api/events).
+# Each event gets a monotonically increasing sequence number; clients pass
+# the last one they saw as a cursor and receive only what came after it.
+# Only the newest `capacity` events are kept, so memory per job is bounded
+# no matter how long the job runs.
+EVENT_RING_SIZE = 500
+
+
+class EventLog:
+    def __init__(self, capacity=EVENT_RING_SIZE):
+        self.events = deque(maxlen=capacity)
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def append(self, event_type, data):
+        with self.lock:
+            self.seq += 1
+            self.events.append({"id": self.seq, "type": event_type, "data": data})
+            return self.seq
+
+    def since(self, cursor=0):
+        """
+        (events with id > cursor, missed, new cursor). `missed` tells the
+        client that some events between its cursor and the oldest buffered
+        one were dropped (it should re-sync from /api/status); the new cursor
+        is where it continues from.
+        """
+        with self.lock:
+            if cursor == self.seq:
+                return [], False, cursor
+            if cursor > self.seq:
+                # Cursor from before a server restart: replay what we have and continue from here
+                return list(self.events), True, self.seq
+            oldest = self.events[0]["id"] if self.events else self.seq + 1
+            missed = cursor + 1 < oldest
+            events = [e for e in self.events if e["id"] > cursor]
+            return events, missed, events[-1]["id"] if events else cursor
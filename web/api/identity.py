@@ -0,0 +1,84 @@
+import os
+import shutil
+from . import index_db
+from . import media_store
+from .matcher import MATCH_DURATION_TOLERANCE, VARIANT_WORDS, artist_names, core_title, tokens
+
+# Recording identity across Spotify URIs. The same recording released as a
+# single, on an album and on a deluxe edition has a different URI each time,
+# but the same ISRC, and the same artist / title / length. resolve_stage asks
+# find_recording() before searching: a hit means the audio we already have is
+# linked into the playlist folder and only re-tagged for the new release.
+
+
+def title_key(track):
+    """
+    Normalized "artist|title" of a track: main artist and core title tokens,
+    sorted, plus any variant words (live, remix...) so those stay distinct.
+    """
+    artists = artist_names(track)
+    name = track.get('name') or ''
+    title_tokens = tokens(core_title(name)) | (tokens(name) & VARIANT_WORDS)
+    if not artists or not title_tokens:
+        return None
+    return f"{' '.join(sorted(tokens(artists[0])))}|{' '.join(sorted(title_tokens))}"
+
+
+def _audio_available(entry):
+    if media_store.has_blob(entry.get('content_hash')):
+        return True
+    return bool(entry.get('output_path')) and os.path.exists(entry['output_path'])
+
+
+def _same_length(track, entry):
+    if not track.get('duration_ms') or not entry.get('duration_ms'):
+        return False
+    return abs(track['duration_ms'] - entry['duration_ms']) <= MATCH_DURATION_TOLERANCE * 1000
+
+
+def find_recording(track, output_format='mp3'):
+    """
+    An index entry for the same recording under another URI whose audio is
+    still around, or None. ISRC decides when both sides have one; otherwise
+    the normalized title key must match and the lengths agree.
+    `output_format`: with 'mp3' only MP3 files qualify (others would need a transcode).
+    """
+    uri = track.get('uri')
+    isrc = (track.get('isrc') or '').upper()
+    candidates = [e for e in index_db.find_by_isrc(isrc) if e['uri'] != uri] if isrc else []
+    for entry in index_db.find_by_title_key(title_key(track)):
+        if entry['uri'] == uri or not _same_length(track, entry):
+            continue
+        # Different ISRCs mean different recordings, even with the same title
+        if isrc and entry.get('isrc') and entry['isrc'].upper() != isrc:
+            continue
+        candidates.append(entry)
+
+    for entry in candidates:
+        if not entry.get('filename'):
+            continue
+        if output_format == 'mp3' and not entry['filename'].lower().endswith('.mp3'):
+            continue
+        if _audio_available(entry):
+            return entry
+    return None
+
+
+def reuse(entry, output_dir):
+    """
+    Put a private copy of `entry`'s audio at output_dir/<its filename>, ready
+    to be re-tagged (a hardlink would rewrite the other release's tags too).
+    Returns the path, or None if the audio is gone.
+    """
+    if media_store.has_blob(entry.get('content_hash')):
+        source = media_store.blob_path(entry['content_hash'])
+    else:
+        # Downloaded before the media store existed
+        source = entry.get('output_path')
+    if not source or not os.path.exists(source):
+        return None
+    path = os.path.join(output_dir, entry['filename'])
+    tmp = f"{path}.copy.tmp"
+    shutil.copy2(source, tmp)
+    os.replace(tmp, path)
+    return path
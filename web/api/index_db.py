@@ -0,0 +1,244 @@
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+# SQLite download index (replaces downloaded_songs.json).
+# WAL mode lets many readers run alongside one writer, and busy_timeout makes
+# concurrent writers (other workers, other jobs, other processes) wait their
+# turn instead of failing. Every write is a single-row upsert.
+INDEX_DB_FILE = os.environ.get('OFFLINEIFY_INDEX_DB', 'downloaded_songs.db')
+LEGACY_INDEX_FILE = 'downloaded_songs.json'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    uri TEXT PRIMARY KEY,
+    name TEXT,
+    artist TEXT,
+    isrc TEXT,
+    filename TEXT,
+    output_path TEXT,
+    downloaded_at TEXT,
+    content_hash TEXT,
+    title_key TEXT,
+    duration_ms INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_tracks_isrc ON tracks(isrc);
+CREATE INDEX IF NOT EXISTS idx_tracks_output_path ON tracks(output_path);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    size INTEGER,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT
+);
+CREATE TABLE IF NOT EXISTS blob_links (
+    path TEXT PRIMARY KEY,
+    hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_blob_links_hash ON blob_links(hash);
+CREATE TABLE IF NOT EXISTS file_access (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    last_access REAL
+);
+CREATE INDEX IF NOT EXISTS idx_file_access_dir ON file_access(dir, last_access);
+CREATE TABLE IF NOT EXISTS library (
+    user_id TEXT NOT NULL,
+    playlist TEXT NOT NULL,
+    path TEXT NOT NULL,
+    position INTEGER,
+    uri TEXT,
+    name TEXT,
+    artist TEXT,
+    album TEXT,
+    release_date TEXT,
+    track_number INTEGER,
+    duration_ms INTEGER,
+    isrc TEXT,
+    filename TEXT,
+    size INTEGER,
+    updated_at REAL,
+    PRIMARY KEY (user_id, path)
+);
+CREATE INDEX IF NOT EXISTS idx_library_playlist ON library(user_id, playlist, position);
+CREATE INDEX IF NOT EXISTS idx_library_artist ON library(user_id, artist);
+CREATE TABLE IF NOT EXISTS library_versions (
+    user_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+
+TRACK_COLUMNS = ('uri', 'name', 'artist', 'isrc', 'filename', 'output_path', 'downloaded_at', 'content_hash',
+                 'title_key', 'duration_ms')
+
+# Columns added after the first release: (table, column, type).
+# CREATE TABLE IF NOT EXISTS won't add them to an existing database.
+ADDED_COLUMNS = [
+    ('tracks', 'content_hash', 'TEXT'),
+    ('tracks', 'title_key', 'TEXT'),
+    ('tracks', 'duration_ms', 'INTEGER'),
+    ('library', 'track', 'TEXT'),
+    ('blobs', 'ext', 'TEXT'),
+    ('library', 'uris', 'TEXT'),
+]
+# Indexes on added columns, created once the columns exist
+POST_MIGRATION = """
+CREATE INDEX IF NOT EXISTS idx_tracks_title_key ON tracks(title_key);
+"""
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized = set()
+
+
+def open_connection(db_path):
+    """Open an autocommit SQLite connection with the pragmas every store here uses."""
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+
+def connect(db_path=None):
+    """Return this thread's connection to the index (created and migrated on first use)."""
+    db_path = db_path or INDEX_DB_FILE
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(db_path)
+    if conn is None:
+        conn = open_connection(db_path)
+        conns[db_path] = conn
+        with _init_lock:
+            if db_path not in _initialized:
+                conn.executescript(SCHEMA)
+                ensure_columns(conn)
+                conn.executescript(POST_MIGRATION)
+                migrate_legacy_index(conn)
+                _initialized.add(db_path)
+    return conn
+
+
+def ensure_columns(conn, columns=ADDED_COLUMNS):
+    for table, column, col_type in columns:
+        existing = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in existing:
+            try:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_type}")
+            except sqlite3.OperationalError:
+                pass  # Another process added it first
+
+
+def like_prefix(path):
+    """LIKE pattern (with ESCAPE '\\') matching everything under the folder `path`."""
+    return path.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + os.sep + '%'
+
+
+def migrate_legacy_index(conn, json_path=LEGACY_INDEX_FILE):
+    """One-time import of downloaded_songs.json. Safe to call repeatedly and from several processes."""
+    if not os.path.exists(json_path):
+        return 0
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'legacy_json_migrated'").fetchone()
+        if row is not None:
+            conn.execute("COMMIT")
+            return 0
+
+        try:
+            with open(json_path, 'r') as f:
+                legacy = json.load(f)
+        except Exception as e:
+            print(f"Error loading legacy index file: {e}")
+            legacy = {}
+
+        count = 0
+        for uri, entry in legacy.items():
+            if not isinstance(entry, dict):
+                continue
+            # Existing rows win: they were written after the JSON file stopped being used
+            conn.execute(
+                "INSERT OR IGNORE INTO tracks (uri, name, artist, filename, downloaded_at) VALUES (?, ?, ?, ?, ?)",
+                (uri, entry.get('name'), entry.get('artist'), entry.get('filename'), entry.get('downloaded_at')),
+            )
+            count += 1
+
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('legacy_json_migrated', ?)",
+            (datetime.now().isoformat(),),
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    print(f"Migrated {count} entries from {json_path} to {INDEX_DB_FILE}")
+    return count
+
+
+def get_track(uri, db_path=None):
+    row = connect(db_path).execute("SELECT * FROM tracks WHERE uri = ?", (uri,)).fetchone()
+    return dict(row) if row else None
+
+
+def get_tracks(uris, db_path=None):
+    """{uri: row} for the given URIs, looked up in batches (one query per 500)."""
+    uris = [u for u in dict.fromkeys(uris) if u]
+    conn = connect(db_path)
+    found = {}
+    for start in range(0, len(uris), 500):
+        chunk = uris[start:start + 500]
+        rows = conn.execute(
+            f"SELECT * FROM tracks WHERE uri IN ({', '.join('?' for _ in chunk)})", chunk
+        ).fetchall()
+        found.update((r['uri'], dict(r)) for r in rows)
+    return found
+
+
+def find_by_isrc(isrc, db_path=None):
+    if not isrc:
+        return []
+    rows = connect(db_path).execute("SELECT * FROM tracks WHERE isrc = ?", (isrc,)).fetchall()
+    return [dict(r) for r in rows]
+
+
+def find_by_title_key(title_key, db_path=None):
+    if not title_key:
+        return []
+    rows = connect(db_path).execute("SELECT * FROM tracks WHERE title_key = ?", (title_key,)).fetchall()
+    return [dict(r) for r in rows]
+
+
+def find_by_output_path(output_path, db_path=None):
+    row = connect(db_path).execute("SELECT * FROM tracks WHERE output_path = ?", (output_path,)).fetchone()
+    return dict(row) if row else None
+
+
+def upsert_track(uri, db_path=None, **fields):
+    """Insert or update one row. Only the given columns are overwritten."""
+    fields = {k: v for k, v in fields.items() if k in TRACK_COLUMNS and k != 'uri'}
+    insert_fields = dict(fields)
+    insert_fields.setdefault('downloaded_at', datetime.now().isoformat())
+    columns = ['uri'] + list(insert_fields)
+    placeholders = ", ".join("?" for _ in columns)
+    if fields:
+        conflict = "DO UPDATE SET " + ", ".join(f"{c} = excluded.{c}" for c in fields)
+    else:
+        conflict = "DO NOTHING"
+    connect(db_path).execute(
+        f"INSERT INTO tracks ({', '.join(columns)}) VALUES ({placeholders}) "
+        f"ON CONFLICT(uri) {conflict}",
+        [uri] + list(insert_fields.values()),
+    )
+
+
+def delete_track(uri, db_path=None):
+    connect(db_path).execute("DELETE FROM tracks WHERE uri = ?", (uri,))
@@ -0,0 +1,589 @@
+import os
+import json
+import time
+import uuid
+import threading
+from .index_db import ensure_columns, open_connection
+from .paths import completed_file_path, safe_playlist_name, user_output_path
+from .metrics import timing_summary
+
+# Persistent job queue for out-of-process workers (OFFLINEIFY_QUEUE_MODE=external).
+# The API enqueues one row per track; `python -m web.api.worker` processes
+# claim them. Claims rotate between users (least recently served first), so
+# one huge upload can't starve everyone else. Claimed tasks carry a lease: if a
+# worker dies, its tasks go back to the queue when the lease runs out.
+# Job progress and events live here too, so any API process can answer
+# /api/status and /api/events, and state survives restarts. The DB is SQLite
+# in WAL mode: the API and its workers must run on one host (WAL doesn't work
+# over network filesystems).
+QUEUE_DB = os.environ.get('OFFLINEIFY_QUEUE_DB', 'jobs.db')
+TASK_LEASE_SECONDS = int(os.environ.get('OFFLINEIFY_TASK_LEASE', '1800'))
+MAX_TASK_ATTEMPTS = 3
+EVENT_RING_SIZE = 500
+LOG_LINES = int(os.environ.get('OFFLINEIFY_LOG_LINES', '200'))
+
+ACTIVE_JOB_STATUSES = ('queued', 'working')
+# A job whose track list is still being appended (streaming CSV upload)
+LOADING_STATUS = 'loading'
+FINAL_TASK_STATUSES = ('success', 'skipped', 'error', 'cancelled')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    quality TEXT,
+    output_path TEXT,
+    total INTEGER,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    first_event_id INTEGER NOT NULL DEFAULT 0,
+    created_at REAL,
+    updated_at REAL,
+    started_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs(user_id, created_at);
+CREATE TABLE IF NOT EXISTS job_playlists (
+    job_id TEXT NOT NULL,
+    playlist_index INTEGER NOT NULL,
+    name TEXT,
+    playlist_dir TEXT,
+    PRIMARY KEY (job_id, playlist_index)
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    playlist_index INTEGER NOT NULL,
+    track_index INTEGER NOT NULL,
+    track TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    filename TEXT,
+    message TEXT,
+    worker_id TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL,
+    cpu_seconds REAL,
+    error_class TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_status_user ON tasks(status, user_id, id);
+CREATE INDEX IF NOT EXISTS idx_tasks_job ON tasks(job_id, playlist_index, track_index);
+CREATE INDEX IF NOT EXISTS idx_tasks_job_status ON tasks(job_id, status);
+CREATE TABLE IF NOT EXISTS user_turns (
+    user_id TEXT PRIMARY KEY,
+    last_served REAL
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_events_user ON events(user_id, id);
+CREATE TABLE IF NOT EXISTS job_timings (
+    job_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    seconds REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (job_id, kind, name)
+);
+CREATE TABLE IF NOT EXISTS event_trim (
+    user_id TEXT PRIMARY KEY,
+    trimmed_upto INTEGER NOT NULL
+);
+"""
+
+# Columns added after the first release (existing queue DBs get them via ALTER TABLE)
+ADDED_COLUMNS = [
+    ('jobs', 'started_at', 'REAL'),
+    ('tasks', 'cpu_seconds', 'REAL'),
+    ('tasks', 'error_class', 'TEXT'),
+]
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+_event_writes = 0
+
+
+def connect():
+    global _schema_ready
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = open_connection(QUEUE_DB)
+        with _schema_lock:
+            if not _schema_ready:
+                conn.executescript(SCHEMA)
+                ensure_columns(conn, ADDED_COLUMNS)
+                _schema_ready = True
+    return conn
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK on this thread's connection."""
+
+    def __enter__(self):
+        self.conn = connect()
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def transaction():
+    return _Transaction()
+
+
+# ---------------------------------------------------------------------------
+# Jobs
+# ---------------------------------------------------------------------------
+
+def get_job(job_id):
+    row = connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def active_job(user_id):
+    row = connect().execute(
+        "SELECT * FROM jobs WHERE user_id = ? AND status IN ('loading', 'queued', 'working') ORDER BY created_at DESC LIMIT 1",
+        (user_id,),
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def count_active_jobs():
+    """Jobs loading, queued or being worked on, across all users (for the active jobs gauge)."""
+    return connect().execute(
+        "SELECT COUNT(*) FROM jobs WHERE status IN ('loading', 'queued', 'working')"
+    ).fetchone()[0]
+
+
+def latest_job(user_id):
+    row = connect().execute(
+        "SELECT * FROM jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT 1", (user_id,)
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def enqueue_job(user_id, playlists, quality='320', output_path='downloads', inline=False, loading=False, done=None):
+    """
+    Persist a job and one task per track. `playlists` is a list of
+    {"name": str, "tracks": [track dict, ...]}. Returns the job id.
+    inline=True records the plan of a job the API process runs itself:
+    its tasks are 'planned' rather than 'queued', so workers never claim them.
+    loading=True keeps a queued job from being finalized while more tracks
+    are still being added with append_tasks (see finish_loading).
+    done maps (playlist_index, track_index) -> filename for tracks that are
+    already in the library (see sync.py); they are recorded as skipped.
+    """
+    job_id = uuid.uuid4().hex
+    task_status = 'planned' if inline else 'queued'
+    job_status = 'working' if inline else 'queued'
+    if loading and not inline:
+        job_status = LOADING_STATUS
+    now = time.time()
+    base_output_path = user_output_path(user_id, output_path)
+    total = sum(len(p['tracks']) for p in playlists)
+    done = done or {}
+
+    with transaction() as conn:
+        first_event_id = (conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]) + 1
+        conn.execute(
+            "INSERT INTO jobs (id, user_id, status, quality, output_path, total, first_event_id, created_at, updated_at, started_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, user_id, job_status, quality, output_path, total, first_event_id, now, now, now),
+        )
+        for playlist_index, playlist in enumerate(playlists):
+            playlist_dir = os.path.join(base_output_path, safe_playlist_name(playlist['name']))
+            conn.execute(
+                "INSERT INTO job_playlists (job_id, playlist_index, name, playlist_dir) VALUES (?, ?, ?, ?)",
+                (job_id, playlist_index, playlist['name'], playlist_dir),
+            )
+            rows = []
+            for track_index, track in enumerate(playlist['tracks']):
+                filename = done.get((playlist_index, track_index))
+                if filename:
+                    rows.append((job_id, user_id, playlist_index, track_index, json.dumps(track), 'skipped', filename, "In library", now))
+                else:
+                    rows.append((job_id, user_id, playlist_index, track_index, json.dumps(track), task_status, None, None, now))
+            conn.executemany(
+                "INSERT INTO tasks (job_id, user_id, playlist_index, track_index, track, status, filename, message, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    if not inline:
+        add_event(user_id, "progress", {"status": "queued", "total": total, "completed": len(done), "current_track": ""})
+        if len(done) == total and not loading:
+            finalize_job(job_id)  # nothing left for the workers
+    return job_id
+
+
+def cancel_job(user_id):
+    """Flag the user's active job and drop its queued tasks. Running tasks finish on their own."""
+    job = active_job(user_id)
+    if job is None:
+        return None
+    with transaction() as conn:
+        conn.execute("UPDATE jobs SET cancel_requested = 1, updated_at = ? WHERE id = ?", (time.time(), job['id']))
+        conn.execute(
+            "UPDATE tasks SET status = 'cancelled', updated_at = ? WHERE job_id = ? AND status = 'queued'",
+            (time.time(), job['id']),
+        )
+    finalize_job(job['id'])
+    return job['id']
+
+
+def append_tasks(job_id, playlist_index, start_index, tracks, inline=False):
+    """Add tracks to the end of a playlist of an existing job. Returns the new task ids in order."""
+    task_status = 'planned' if inline else 'queued'
+    now = time.time()
+    ids = []
+    with transaction() as conn:
+        job = conn.execute("SELECT user_id FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        for offset, track in enumerate(tracks):
+            cur = conn.execute(
+                "INSERT INTO tasks (job_id, user_id, playlist_index, track_index, track, status, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, job['user_id'], playlist_index, start_index + offset, json.dumps(track), task_status, now),
+            )
+            ids.append(cur.lastrowid)
+        conn.execute("UPDATE jobs SET total = total + ?, updated_at = ? WHERE id = ?", (len(tracks), now, job_id))
+    return ids
+
+
+def finish_loading(job_id):
+    """All tracks of a loading job are in: let it run to completion normally."""
+    connect().execute(
+        "UPDATE jobs SET status = 'working', updated_at = ? WHERE id = ? AND status = ?",
+        (time.time(), job_id, LOADING_STATUS),
+    )
+    return finalize_job(job_id)
+
+
+def set_job_status(job_id, status):
+    connect().execute("UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?", (status, time.time(), job_id))
+
+
+def job_plan(job_id):
+    """Rebuild the job's playlists ([{"name", "tracks"}]) from its tasks, in original order."""
+    conn = connect()
+    playlists = [
+        {"name": row['name'], "tracks": []}
+        for row in conn.execute(
+            "SELECT name FROM job_playlists WHERE job_id = ? ORDER BY playlist_index", (job_id,)
+        )
+    ]
+    for row in conn.execute(
+        "SELECT playlist_index, track FROM tasks WHERE job_id = ? ORDER BY playlist_index, track_index", (job_id,)
+    ):
+        playlists[row['playlist_index']]['tracks'].append(json.loads(row['track']))
+    return playlists
+
+
+def job_tasks(job_id):
+    """{(playlist_index, track_index): {"id", "status", "filename"}} for every task of a job."""
+    rows = connect().execute(
+        "SELECT id, playlist_index, track_index, status, filename FROM tasks WHERE job_id = ?", (job_id,)
+    ).fetchall()
+    return {
+        (r['playlist_index'], r['track_index']): {"id": r['id'], "status": r['status'], "filename": r['filename']}
+        for r in rows
+    }
+
+
+def resumable_job(user_id):
+    """The user's latest job if it still has tracks that didn't succeed or get skipped."""
+    job = latest_job(user_id)
+    if job is None:
+        return None
+    unfinished = connect().execute(
+        "SELECT COUNT(*) FROM tasks WHERE job_id = ? AND status NOT IN ('success', 'skipped')", (job['id'],)
+    ).fetchone()[0]
+    return job if unfinished else None
+
+
+def reset_unfinished(job_id, inline=False):
+    """
+    Put every task that didn't succeed or get skipped (errors, cancelled,
+    or interrupted mid-run) back in line, and reopen the job.
+    """
+    task_status = 'planned' if inline else 'queued'
+    job_status = 'working' if inline else 'queued'
+    now = time.time()
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE tasks SET status = ?, worker_id = NULL, lease_until = NULL, attempts = 0, message = NULL, "
+            "cpu_seconds = NULL, error_class = NULL, updated_at = ? WHERE job_id = ? AND status NOT IN ('success', 'skipped')",
+            (task_status, now, job_id),
+        )
+        conn.execute(
+            "UPDATE jobs SET status = ?, cancel_requested = 0, updated_at = ?, started_at = ? WHERE id = ?",
+            (job_status, now, now, job_id),
+        )
+        # Timings are per run, like JobState.stats
+        conn.execute("DELETE FROM job_timings WHERE job_id = ?", (job_id,))
+
+
+def job_counts(job_id):
+    rows = connect().execute(
+        "SELECT status, COUNT(*) AS n FROM tasks WHERE job_id = ? GROUP BY status", (job_id,)
+    ).fetchall()
+    return {row['status']: row['n'] for row in rows}
+
+
+def finalize_job(job_id):
+    """
+    Mark the job done/cancelled once no task is queued or running. Returns the final status or None.
+    A loading job only ends here when cancelled (its loader may be gone, e.g. after a restart).
+    """
+    with transaction() as conn:
+        job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None or job['status'] not in ACTIVE_JOB_STATUSES + (LOADING_STATUS,):
+            return None
+        if job['status'] == LOADING_STATUS and not job['cancel_requested']:
+            return None
+        pending = conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE job_id = ? AND status IN ('planned', 'queued', 'running')", (job_id,)
+        ).fetchone()[0]
+        if pending:
+            return None
+        status = 'cancelled' if job['cancel_requested'] else 'done'
+        conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?", (status, time.time(), job_id))
+    return status
+
+
+def job_state(user_id):
+    """The user's latest job in the same shape as main.JobState."""
+    job = latest_job(user_id)
+    if job is None:
+        return {}
+    conn = connect()
+    counts = job_counts(job['id'])
+    completed = sum(counts.get(s, 0) for s in FINAL_TASK_STATUSES if s != 'cancelled')
+
+    current = conn.execute(
+        "SELECT t.track, p.name FROM tasks t JOIN job_playlists p "
+        "ON p.job_id = t.job_id AND p.playlist_index = t.playlist_index "
+        "WHERE t.job_id = ? AND t.status = 'running' ORDER BY t.updated_at DESC LIMIT 1",
+        (job['id'],),
+    ).fetchone()
+    current_track = f"[{current['name']}] {json.loads(current['track']).get('name')}" if current else ""
+
+    files = conn.execute(
+        "SELECT t.track, t.filename, p.name FROM tasks t JOIN job_playlists p "
+        "ON p.job_id = t.job_id AND p.playlist_index = t.playlist_index "
+        "WHERE t.job_id = ? AND t.filename IS NOT NULL ORDER BY t.updated_at",
+        (job['id'],),
+    ).fetchall()
+    completed_files = [
+        {"name": json.loads(r['track']).get('name'), "path": completed_file_path(user_id, r['name'], r['filename'])}
+        for r in files
+    ]
+
+    logs = conn.execute(
+        "SELECT data FROM events WHERE user_id = ? AND type = 'log' AND id >= ? ORDER BY id DESC LIMIT ?",
+        (user_id, job['first_event_id'], LOG_LINES),
+    ).fetchall()
+
+    # Throughput of the current run (a resumed job starts counting again)
+    started_at = job['started_at'] or job['created_at']
+    run = conn.execute(
+        "SELECT COUNT(*) AS n, COALESCE(SUM(cpu_seconds), 0) AS cpu, MAX(updated_at) AS last FROM tasks "
+        "WHERE job_id = ? AND cpu_seconds IS NOT NULL AND updated_at >= ?",
+        (job['id'], started_at),
+    ).fetchone()
+    errors = conn.execute(
+        "SELECT COALESCE(error_class, 'failed') AS error_class, COUNT(*) AS n FROM tasks "
+        "WHERE job_id = ? AND status = 'error' GROUP BY 1",
+        (job['id'],),
+    ).fetchall()
+    end = time.time() if job['status'] in ACTIVE_JOB_STATUSES + (LOADING_STATUS,) else (run['last'] or started_at)
+
+    return {
+        "status": job['status'],
+        "total": job['total'],
+        "completed": completed,
+        "current_track": current_track,
+        "logs": [json.loads(r['data']) for r in reversed(logs)],
+        "completed_files": completed_files,
+        "cancel_requested": bool(job['cancel_requested']),
+        "stats": throughput(run['n'], run['cpu'], end - started_at),
+        "errors": {r['error_class']: r['n'] for r in errors},
+        "timings": job_timings(job['id']),
+    }
+
+
+def job_timings(job_id):
+    """Per-job stage/phase breakdown in the shape of metrics.timing_summary."""
+    rows = connect().execute("SELECT kind, name, count, seconds FROM job_timings WHERE job_id = ?", (job_id,)).fetchall()
+    totals = {}
+    for r in rows:
+        totals.setdefault(r['kind'], {})[r['name']] = [r['count'], r['seconds']]
+    return timing_summary(totals)
+
+
+def throughput(processed, cpu_seconds, elapsed_seconds):
+    """JobState.stats: CPU cost per track and tracks per minute for `processed` tracks."""
+    return {
+        "processed": processed,
+        "elapsed_seconds": round(elapsed_seconds, 1),
+        "cpu_seconds": round(cpu_seconds, 2),
+        "cpu_seconds_per_track": round(cpu_seconds / processed, 2) if processed else 0.0,
+        "tracks_per_minute": round(processed * 60 / elapsed_seconds, 2) if elapsed_seconds > 0 else 0.0,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Tasks
+# ---------------------------------------------------------------------------
+
+def claim_task(worker_id):
+    """
+    Lease the next task for `worker_id`, or return None if the queue is empty.
+    Picks the user served longest ago, then that user's oldest task.
+    """
+    now = time.time()
+    with transaction() as conn:
+        # Reclaim work from workers that died mid-task
+        conn.execute(
+            "UPDATE tasks SET status = 'queued', worker_id = NULL WHERE status = 'running' AND lease_until < ? AND attempts < ?",
+            (now, MAX_TASK_ATTEMPTS),
+        )
+        conn.execute(
+            "UPDATE tasks SET status = 'error', message = 'Worker lease expired too many times' "
+            "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+            (now, MAX_TASK_ATTEMPTS),
+        )
+
+        row = conn.execute(
+            "SELECT q.user_id FROM (SELECT DISTINCT user_id FROM tasks WHERE status = 'queued') q "
+            "LEFT JOIN user_turns u ON u.user_id = q.user_id "
+            "ORDER BY COALESCE(u.last_served, 0) LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        user_id = row['user_id']
+
+        task = conn.execute(
+            "SELECT * FROM tasks WHERE status = 'queued' AND user_id = ? ORDER BY id LIMIT 1", (user_id,)
+        ).fetchone()
+        conn.execute(
+            "UPDATE tasks SET status = 'running', worker_id = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? "
+            "WHERE id = ?",
+            (worker_id, now + TASK_LEASE_SECONDS, now, task['id']),
+        )
+        conn.execute(
+            "INSERT INTO user_turns (user_id, last_served) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET last_served = excluded.last_served",
+            (user_id, now),
+        )
+        job = conn.execute("SELECT * FROM jobs WHERE id = ?", (task['job_id'],)).fetchone()
+        if job['status'] == 'queued':
+            conn.execute("UPDATE jobs SET status = 'working', updated_at = ? WHERE id = ?", (now, job['id']))
+        playlist = conn.execute(
+            "SELECT * FROM job_playlists WHERE job_id = ? AND playlist_index = ?",
+            (task['job_id'], task['playlist_index']),
+        ).fetchone()
+
+    claimed = dict(task)
+    claimed['track'] = json.loads(task['track'])
+    claimed['quality'] = job['quality']
+    claimed['output_path'] = job['output_path']
+    claimed['cancel_requested'] = bool(job['cancel_requested'])
+    claimed['playlist_name'] = playlist['name']
+    claimed['playlist_dir'] = playlist['playlist_dir']
+    return claimed
+
+
+def complete_task(task_id, result):
+    """
+    Record a task's outcome. Returns True when this was the last unfinished
+    task of its playlist (the caller then writes the M3U8).
+    """
+    status = result.get('status', 'error')
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE tasks SET status = ?, filename = ?, message = ?, error_class = ?, cpu_seconds = ?, lease_until = NULL, updated_at = ? "
+            "WHERE id = ?",
+            (status, result.get('filename'), result.get('message'), result.get('error_class'), result.get('cpu_seconds'),
+             time.time(), task_id),
+        )
+        task = conn.execute("SELECT job_id, playlist_index FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        for kind, values in (result.get('timings') or {}).items():
+            conn.executemany(
+                "INSERT INTO job_timings (job_id, kind, name, count, seconds) VALUES (?, ?, ?, 1, ?) "
+                "ON CONFLICT(job_id, kind, name) DO UPDATE SET count = count + 1, seconds = seconds + excluded.seconds",
+                [(task['job_id'], kind, name, seconds) for name, seconds in values.items()],
+            )
+        remaining = conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE job_id = ? AND playlist_index = ? AND status IN ('planned', 'queued', 'running')",
+            (task['job_id'], task['playlist_index']),
+        ).fetchone()[0]
+        # More tracks may still be appended to a loading job's playlist
+        loading = conn.execute("SELECT status FROM jobs WHERE id = ?", (task['job_id'],)).fetchone()[0] == LOADING_STATUS
+    return remaining == 0 and not loading
+
+
+def playlist_entries(job_id, playlist_index):
+    """[(artist, name, filename_or_None)] in playlist order, for write_m3u."""
+    rows = connect().execute(
+        "SELECT track, filename FROM tasks WHERE job_id = ? AND playlist_index = ? ORDER BY track_index",
+        (job_id, playlist_index),
+    ).fetchall()
+    entries = []
+    for row in rows:
+        track = json.loads(row['track'])
+        entries.append((track.get('artist'), track.get('name'), row['filename']))
+    return entries
+
+
+# ---------------------------------------------------------------------------
+# Events (same shape as events.EventLog, shared by all processes)
+# ---------------------------------------------------------------------------
+
+def add_event(user_id, event_type, data):
+    global _event_writes
+    conn = connect()
+    cur = conn.execute("INSERT INTO events (user_id, type, data) VALUES (?, ?, ?)", (user_id, event_type, json.dumps(data)))
+    _event_writes += 1
+    if _event_writes % 100 == 0:
+        # Keep only the newest EVENT_RING_SIZE events per user
+        cutoff = conn.execute(
+            "SELECT id FROM events WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?", (user_id, EVENT_RING_SIZE)
+        ).fetchone()
+        if cutoff is not None:
+            with transaction() as tx:
+                tx.execute("DELETE FROM events WHERE user_id = ? AND id <= ?", (user_id, cutoff['id']))
+                tx.execute(
+                    "INSERT INTO event_trim (user_id, trimmed_upto) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET trimmed_upto = excluded.trimmed_upto",
+                    (user_id, cutoff['id']),
+                )
+    return cur.lastrowid
+
+
+class QueueEventLog:
+    """Read side of the events table with the EventLog.since() interface."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    def since(self, cursor=0):
+        conn = connect()
+        rows = conn.execute(
+            "SELECT id, type, data FROM events WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?",
+            (self.user_id, cursor, EVENT_RING_SIZE),
+        ).fetchall()
+        events = [{"id": r['id'], "type": r['type'], "data": json.loads(r['data'])} for r in rows]
+        if events:
+            trim = conn.execute("SELECT trimmed_upto FROM event_trim WHERE user_id = ?", (self.user_id,)).fetchone()
+            return events, trim is not None and cursor < trim['trimmed_upto'], events[-1]['id']
+        head = conn.execute("SELECT MAX(id) FROM events WHERE user_id = ?", (self.user_id,)).fetchone()[0] or 0
+        if cursor > head:
+            # Cursor from another queue DB (reset or moved): continue from this one's newest event
+            return [], True, head
+        return [], False, cursor
@@ -0,0 +1,247 @@
+import os
+import json
+import time
+from . import index_db
+from .paths import DOWNLOADS_ROOT, completed_file_path, safe_user_id
+
+# Per-user library: one row per track file in a playlist folder, with the
+# tag metadata it was written with, its size and its /api/file path. Rows are
+# written as tracks finish (run_download_job, workers, sync) and dropped when
+# files are evicted or pruned, so /api/library is an indexed query instead of
+# a directory walk plus tag reads. Each user has a version number that goes up
+# on every change; it is the listing's ETag. The full track dict is kept too
+# (`track`, JSON), so maintenance.py can re-tag a file without its job; rows
+# rebuilt from old folders have none, since the download index only knows a
+# few fields.
+# A file can stand for several URIs (the same recording on a single and an
+# album, see identity.py). Its row keeps the metadata of the URI recorded
+# first and lists every URI in `uris` (JSON); the others don't overwrite it.
+MAX_PAGE_SIZE = 1000
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.opus', '.ogg', '.flac')
+
+_FIELDS = ('uri', 'name', 'artist', 'album', 'release_date', 'track_number', 'duration_ms', 'isrc')
+
+
+def _bump(conn, user_id):
+    conn.execute(
+        "INSERT INTO library_versions (user_id, version) VALUES (?, 1) "
+        "ON CONFLICT(user_id) DO UPDATE SET version = version + 1",
+        (user_id,),
+    )
+
+
+def version(user_id):
+    row = index_db.connect().execute("SELECT version FROM library_versions WHERE user_id = ?", (safe_user_id(user_id),)).fetchone()
+    return row['version'] if row else 0
+
+
+def _rows(user_id, entries, keep_track=True):
+    user = safe_user_id(user_id)
+    now = time.time()
+    rows = []
+    for playlist_name, position, track, filename, file_path in entries:
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            size = None
+        rows.append((user, playlist_name, completed_file_path(user_id, playlist_name, filename), position,
+                     *[track.get(f) for f in _FIELDS], os.path.basename(filename), size, now,
+                     json.dumps(track) if keep_track else None, json.dumps([track['uri']] if track.get('uri') else [])))
+    return rows
+
+
+def _upsert(conn, rows):
+    conn.executemany(
+        "INSERT INTO library (user_id, playlist, path, position, uri, name, artist, album, release_date, "
+        "track_number, duration_ms, isrc, filename, size, updated_at, track, uris) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(user_id, path) DO UPDATE SET playlist = excluded.playlist, position = excluded.position, "
+        "uri = excluded.uri, name = excluded.name, artist = excluded.artist, album = excluded.album, "
+        "release_date = excluded.release_date, track_number = excluded.track_number, "
+        "duration_ms = excluded.duration_ms, isrc = excluded.isrc, size = excluded.size, updated_at = excluded.updated_at, "
+        "track = excluded.track",
+        rows,
+    )
+
+
+def _split_aliases(conn, rows):
+    """
+    Split rows into (rows to upsert, [(uris JSON, user_id, path)]): a row for a
+    path already held by another URI only adds its URI to that row's `uris`.
+    """
+    held = {}
+    paths = list({row[2] for row in rows})
+    for i in range(0, len(paths), 500):
+        chunk = paths[i:i + 500]
+        for row in conn.execute(
+            f"SELECT path, uri, uris FROM library WHERE user_id = ? AND path IN ({', '.join('?' for _ in chunk)})",
+            [rows[0][0]] + chunk,
+        ):
+            held[row['path']] = (row['uri'], json.loads(row['uris']) if row['uris'] else [u for u in [row['uri']] if u])
+
+    upserts, aliases = [], {}
+    for row in rows:
+        path, uri = row[2], row[4]
+        current = held.get(path)
+        if current is None or not current[0] or not uri or current[0] == uri:
+            if current is None or not current[0]:
+                held[path] = (uri, json.loads(row[-1]))
+            upserts.append(row)
+        elif uri not in current[1]:
+            current[1].append(uri)
+            aliases[path] = current[1]
+    return upserts, [(json.dumps(uris), rows[0][0], path) for path, uris in aliases.items()]
+
+
+def record_tracks(user_id, entries):
+    """
+    Add or update finished tracks. entries: [(playlist_name, position, track dict, filename, file_path)],
+    file_path being where the file is on disk (for its size).
+    """
+    rows = _rows(user_id, entries)
+    if not rows:
+        return
+    conn = index_db.connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows, aliases = _split_aliases(conn, rows)
+        _upsert(conn, rows)
+        conn.executemany("UPDATE library SET uris = ? WHERE user_id = ? AND path = ?", aliases)
+        _bump(conn, safe_user_id(user_id))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def record_track(user_id, playlist_name, position, track, filename, file_path):
+    record_tracks(user_id, [(playlist_name, position, track, filename, file_path)])
+
+
+def forget(disk_path):
+    """Drop the rows of a file, or of every file under a folder, given its path on disk."""
+    rel = os.path.relpath(os.path.abspath(disk_path), os.path.abspath(DOWNLOADS_ROOT))
+    if rel.startswith('..'):
+        return
+    parts = rel.split(os.sep)
+    user = parts[0]
+    conn = index_db.connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cur = conn.execute(
+            "DELETE FROM library WHERE user_id = ? AND (path = ? OR path LIKE ? ESCAPE '\\')",
+            (user, rel, index_db.like_prefix(rel)),
+        )
+        if cur.rowcount:
+            _bump(conn, user)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def list_tracks(user_id, playlist=None, artist=None, album=None, q=None, offset=0, limit=100):
+    """
+    One page of the user's tracks in playlist order: {"total", "offset", "limit", "items"}.
+    Each item has `uris`: every URI the file stands for, its own `uri` first.
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    offset = max(0, int(offset))
+    where = ["user_id = ?"]
+    params = [safe_user_id(user_id)]
+    for column, value in (('playlist', playlist), ('artist', artist), ('album', album)):
+        if value:
+            where.append(f"{column} = ?")
+            params.append(value)
+    if q:
+        where.append("(name LIKE ? OR artist LIKE ? OR album LIKE ?)")
+        params += [f"%{q}%"] * 3
+    clause = " AND ".join(where)
+
+    conn = index_db.connect()
+    total = conn.execute(f"SELECT COUNT(*) FROM library WHERE {clause}", params).fetchone()[0]
+    rows = conn.execute(
+        f"SELECT playlist, position, path, filename, size, uris, {', '.join(_FIELDS)} FROM library "
+        f"WHERE {clause} ORDER BY playlist, position, path LIMIT ? OFFSET ?",
+        params + [limit, offset],
+    ).fetchall()
+    items = []
+    for row in rows:
+        item = dict(row)
+        item['uris'] = json.loads(row['uris']) if row['uris'] else [u for u in [row['uri']] if u]
+        items.append(item)
+    return {"total": total, "offset": offset, "limit": limit, "items": items}
+
+
+def entries(user_id=None, playlist=None):
+    """
+    Every row (of one user, or all users; optionally one playlist) as
+    {"user_id", "playlist", "position", "path", "track", "complete"}, in playlist order.
+    `track` is the dict the file was tagged with; `complete` is False for rows
+    made by rebuild(), whose `track` only has what the download index knows.
+    """
+    where, params = [], []
+    if user_id is not None:
+        where.append("user_id = ?")
+        params.append(safe_user_id(user_id))
+    if playlist:
+        where.append("playlist = ?")
+        params.append(playlist)
+    clause = f"WHERE {' AND '.join(where)}" if where else ""
+    rows = index_db.connect().execute(
+        f"SELECT user_id, playlist, position, path, track, {', '.join(_FIELDS)} FROM library {clause} "
+        f"ORDER BY user_id, playlist, position, path",
+        params,
+    ).fetchall()
+    result = []
+    for row in rows:
+        track = json.loads(row['track']) if row['track'] else {f: row[f] for f in _FIELDS if row[f] is not None}
+        result.append({"user_id": row['user_id'], "playlist": row['playlist'], "position": row['position'],
+                       # Every download request carries an album; rebuilt rows never do
+                       "path": row['path'], "track": track, "complete": row['track'] is not None and 'album' in track})
+    return result
+
+
+def list_playlists(user_id):
+    rows = index_db.connect().execute(
+        "SELECT playlist AS name, COUNT(*) AS tracks, COALESCE(SUM(size), 0) AS bytes, MAX(updated_at) AS updated_at "
+        "FROM library WHERE user_id = ? GROUP BY playlist ORDER BY playlist",
+        (safe_user_id(user_id),),
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def rebuild(user_id):
+    """
+    Re-create a user's rows from their folder (for downloads made before the
+    library existed). Metadata comes from the download index, not from tags,
+    so these rows don't count as complete (see entries()). Returns the number of tracks found.
+    """
+    user = safe_user_id(user_id)
+    user_dir = os.path.join(DOWNLOADS_ROOT, user)
+    entries = []
+    if os.path.isdir(user_dir):
+        for playlist_name in sorted(os.listdir(user_dir)):
+            playlist_dir = os.path.join(user_dir, playlist_name)
+            if playlist_name.startswith('.') or not os.path.isdir(playlist_dir):
+                continue
+            filenames = sorted(f for f in os.listdir(playlist_dir) if f.lower().endswith(AUDIO_EXTENSIONS))
+            for position, filename in enumerate(filenames):
+                file_path = os.path.join(playlist_dir, filename)
+                track = index_db.find_by_output_path(file_path) or {}
+                if not track.get('name'):
+                    track = dict(track, name=os.path.splitext(filename)[0])
+                entries.append((playlist_name, position, track, filename, file_path))
+
+    rows = _rows(user_id, entries, keep_track=False)
+    conn = index_db.connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM library WHERE user_id = ?", (user,))
+        _upsert(conn, rows)
+        _bump(conn, user)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return len(rows)
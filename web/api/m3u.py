@@ -0,0 +1,32 @@
+import os
+
+# While a playlist is in progress its M3U8 is rewritten at most this often,
+# so a crash or cancel leaves a playlist file covering everything finished so far.
+M3U_FLUSH_SECONDS = 5.0
+
+
+def m3u_path(playlist_dir, playlist_name):
+    return os.path.join(playlist_dir, f"{playlist_name}.m3u8")
+
+
+def write_m3u(playlist_dir, playlist_name, entries):
+    """
+    Write `{playlist_name}.m3u8` in playlist order.
+    entries: [(artist, track_name, filename_or_None)]; tracks without a file are left out.
+    Returns the playlist file path, or None if there was nothing to write.
+    """
+    m3u_content = ["#EXTM3U"]
+    for artist, track_name, filename in entries:
+        if filename:
+            m3u_content.append(f"#EXTINF:-1,{artist} - {track_name}")
+            m3u_content.append(filename)
+    if len(m3u_content) == 1:
+        return None
+
+    playlist_file = m3u_path(playlist_dir, playlist_name)
+    # Write to a temp file first so readers never see a half-written playlist
+    tmp_file = f"{playlist_file}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        f.write("\n".join(m3u_content))
+    os.replace(tmp_file, playlist_file)
+    return playlist_file
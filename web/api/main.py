@@ -1,18 +1,35 @@
-from fastapi import FastAPI, BackgroundTasks, HTTPException, Header, Query, UploadFile
+from fastapi import FastAPI, BackgroundTasks, Form, HTTPException, Header, Query, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict
+from typing import Iterator, List, Optional, Dict
 import os
-import shutil
-import uuid
-import yt_dlp
-import random
+import json
+import asyncio
+import threading
 import time
-from .downloader import process_track
+from .pipeline import Pipeline, Stage
+from .zipstream import ZipStream, collect_entries
+from .events import EventLog
+from . import jobqueue
+from . import library
+from . import media_store
+from . import ydl_pool
+from . import metrics
+from . import retry
+from . import storage
+from .profiler import StackSampler, profile_path
+from .m3u import M3U_FLUSH_SECONDS, write_m3u
+from .paths import completed_file_path, safe_playlist_name, safe_user_id, user_output_path
+from .csv_ingest import check_header, iter_csv_tracks, save_upload
+from .sync import sync_playlists
 
 app = FastAPI()
 
+@app.on_event("startup")
+def start_storage_manager():
+    storage.start_manager()
+
 # Allow CORS for local development
 app.add_middleware(
     CORSMiddleware,
@@ -32,6 +49,9 @@ class Track(BaseModel):
     release_date: Optional[str] = None
     track_number: Optional[int] = None
     total_tracks: Optional[int] = None
+    disc_number: Optional[int] = None
+    duration_ms: Optional[int] = None
+    isrc: Optional[str] = None
     explicit: Optional[bool] = False
 
 class PlaylistBatch(BaseModel):
@@ -42,6 +62,10 @@ class DownloadRequest(BaseModel):
     playlists: List[PlaylistBatch]
     quality: str = "320"
     output_path: str = "downloads" # Legacy param, effectively ignored/overridden by multi-user logic
+    workers: Optional[int] = None # Tracks in flight per job (defaults to OFFLINEIFY_JOB_WORKERS)
+    profile: bool = False # Sample the job's threads and write a flame graph profile (see profiler.py)
+    sync: bool = False # Only queue tracks not already in the playlist folder (see sync.py)
+    prune: bool = False # With sync: delete files of tracks removed from the playlist
 
 class JobState(BaseModel):
     status: str = "idle"
@@ -51,18 +75,128 @@ class JobState(BaseModel):
     logs: List[str] = []
     completed_files: List[dict] = [] # {name: str, path: str}
     cancel_requested: bool = False
+    pipeline: Dict[str, dict] = {} # stage -> {queued, active, workers, processed}
+    stats: Dict[str, float] = {} # processed, elapsed_seconds, cpu_seconds, cpu_seconds_per_track, tracks_per_minute
+    timings: Dict[str, Dict[str, dict]] = {} # stages|phases -> name -> {count, seconds, avg_ms}
+    errors: Dict[str, int] = {} # error_class -> failed tracks (see retry.py)
+
+# Per-job worker pool size. Upstream request rates are bounded separately
+# by the shared token buckets in ratelimit.py, so more workers never means
+# more traffic than the configured budgets allow.
+JOB_WORKERS = int(os.environ.get("OFFLINEIFY_JOB_WORKERS", "4"))
+MAX_JOB_WORKERS = 16
+# ffmpeg is CPU bound: one transcode worker per core unless overridden
+TRANSCODE_WORKERS = int(os.environ.get("OFFLINEIFY_TRANSCODE_WORKERS", str(os.cpu_count() or 2)))
+TAG_WORKERS = 2
+
+# "inline": jobs run as BackgroundTasks inside this process (default, single instance).
+# "external": jobs go to the persistent queue in jobqueue.py and are processed
+# by `python -m web.api.worker` processes; this process only serves the API.
+QUEUE_MODE = os.environ.get("OFFLINEIFY_QUEUE_MODE", "inline")
+
+# The download path (downloader.py: yt-dlp, mutagen, Pillow, requests) is
+# imported by the first job, so a process that only serves status, files and
+# the library starts fast and stays small. OFFLINEIFY_PREWARM=1 loads it in
+# the background at startup instead, so the first job doesn't wait for it.
+PREWARM = os.environ.get("OFFLINEIFY_PREWARM", "0") == "1"
+
+@app.on_event("startup")
+def start_prewarm():
+    if PREWARM and QUEUE_MODE != "external":
+        def prewarm():
+            from .downloader import warm_up
+            warm_up(JOB_WORKERS)
+        threading.Thread(target=prewarm, name="prewarm", daemon=True).start()
 
 # Global State: Map user_id (email) -> JobState
 job_states: Dict[str, JobState] = {}
+# user_id -> running Pipeline, so /api/status can report live queue depths
+active_pipelines: Dict[str, Pipeline] = {}
+# user_id -> bounded event log backing /api/events
+job_events: Dict[str, EventLog] = {}
+# JobState.logs keeps only this many recent lines (full history isn't needed to render the UI)
+LOG_RING_SIZE = int(os.environ.get("OFFLINEIFY_LOG_LINES", "200"))
+# Streamed tracks (CSV uploads) are checkpointed and submitted in batches of this many rows
+STREAM_BATCH_SIZE = 200
 
 def get_job_state(user_id: str) -> JobState:
     if user_id not in job_states:
         job_states[user_id] = JobState()
     return job_states[user_id]
 
-def run_download_job(user_id: str, playlists: List[PlaylistBatch], quality: str, output_path: str = "downloads"):
+def claim_job(state: JobState):
+    """
+    Take the user's slot when a job is accepted, before its background task
+    starts: a /api/cancel arriving in between must still stop it.
+    """
+    state.status = "working"
+    state.cancel_requested = False
+
+def get_event_log(user_id: str) -> EventLog:
+    if user_id not in job_events:
+        job_events[user_id] = EventLog()
+    return job_events[user_id]
+
+def add_log(user_id: str, state: JobState, msg: str):
+    """Append a log line, keeping only the newest LOG_RING_SIZE in JobState.logs."""
+    state.logs.append(msg)
+    if len(state.logs) > LOG_RING_SIZE:
+        del state.logs[:-LOG_RING_SIZE]
+    get_event_log(user_id).append("log", msg)
+
+def count_active_jobs() -> int:
+    if QUEUE_MODE == "external":
+        return jobqueue.count_active_jobs()
+    return sum(1 for state in job_states.values() if state.status == "working")
+
+def queued_per_stage() -> Dict[tuple, int]:
+    queued = {}
+    for pipeline in list(active_pipelines.values()):
+        for stage, stats in pipeline.stats().items():
+            queued[(stage,)] = queued.get((stage,), 0) + stats["queued"]
+    return queued
+
+# Read at scrape time by /metrics
+metrics.ACTIVE_JOBS.set_function(count_active_jobs)
+metrics.STAGE_QUEUED.set_function(queued_per_stage)
+
+def emit_progress(user_id: str, state: JobState):
+    get_event_log(user_id).append("progress", {
+        "status": state.status,
+        "total": state.total,
+        "completed": state.completed,
+        "current_track": state.current_track,
+    })
+
+def resolve_worker_count(workers: Optional[int] = None) -> int:
+    """Clamp a requested per-job worker count to [1, MAX_JOB_WORKERS]."""
+    if not workers:
+        workers = JOB_WORKERS
+    return max(1, min(int(workers), MAX_JOB_WORKERS))
+
+def run_download_job(user_id: str, playlists: List[PlaylistBatch], quality: str, output_path: str = "downloads", workers: Optional[int] = None, job_id: Optional[str] = None, track_stream: Optional[Iterator[Track]] = None, profile: bool = False, sync: bool = False, prune: bool = False):
+    """
+    Run a job through the track pipeline. `track_stream`, if given, keeps
+    appending tracks to the last playlist while earlier ones download, so a
+    large CSV never has to be parsed into memory before the job starts.
+    `profile` samples the job's threads and writes profiles/<job_id>.folded.
+    `sync` diffs a new job against the library first, so tracks already in
+    their playlist folder are never submitted (see sync.py).
+    """
+    from . import downloader  # Heavy imports, only on the download path
     state = get_job_state(user_id)
     state.status = "working"
+
+    # Checkpoint: the plan and every track's outcome are persisted in the job
+    # DB as they happen. Passing job_id resumes that job: tracks that already
+    # succeeded or were skipped are carried over, only the rest is processed.
+    if job_id is None:
+        plan = [{"name": p.name, "tracks": [t.model_dump() for t in p.tracks]} for p in playlists]
+        done = sync_playlists(user_id, output_path, plan, prune=prune) if sync else None
+        job_id = jobqueue.enqueue_job(user_id, plan, quality, output_path, inline=True, done=done)
+    else:
+        jobqueue.reset_unfinished(job_id, inline=True)
+    tasks = jobqueue.job_tasks(job_id)
     
     # Calculate total first
     total_tracks = sum(len(p.tracks) for p in playlists)
@@ -70,133 +204,363 @@ def run_download_job(user_id: str, playlists: List[PlaylistBatch], quality: str,
     state.completed = 0
     state.logs = []
     state.completed_files = [] # Reset
+    state.stats = {}
+    state.timings = {}
+    state.errors = {}
+    run_started = time.monotonic()
+    run_processed = 0
+    run_cpu_seconds = 0.0
+    run_timings = {}
     
-    # Base Output Path: downloads/{user_id}
-    # Determine base output path
-    safe_user_id = "".join([c for c in user_id if c.isalnum() or c in ['@', '.', '-', '_']])
-    
-    # Logic: 
-    # 1. If explicit output_path provided (and not default "downloads"), use it.
-    # 2. If user_id is "unknown" (local dev default), use "downloads" root.
-    # 3. Otherwise, use downloads/{user_id} for multi-user isolation.
-    if output_path and output_path != "downloads":
-        base_output_path = output_path
-    elif safe_user_id.lower() == "unknown":
-        base_output_path = "downloads"
-    else:
-        base_output_path = os.path.join("downloads", safe_user_id)
-
-    # yt-dlp options
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': quality,
-        }],
-        'outtmpl': f'{base_output_path}/%(artist)s - %(title)s.%(ext)s', 
-        'quiet': True,
-        'no_warnings': True,
-        'noprogress': True,
-        'cookiesfrombrowser': ('chrome',), # Use Chrome cookies to bypass bot detection
-    }
+    # Base Output Path: downloads/{user_id} (see paths.user_output_path)
+    base_output_path = user_output_path(user_id, output_path)
+    ydl_opts = downloader.job_ydl_opts(base_output_path, quality)
 
     if not os.path.exists(base_output_path):
         os.makedirs(base_output_path)
 
-    print(f"Starting download job for user {user_id}: {len(playlists)} playlists")
+    worker_count = resolve_worker_count(workers)
+    print(f"Starting download job {job_id} for user {user_id}: {len(playlists)} playlists, {worker_count} workers")
 
-    for playlist in playlists:
-        # Create Playlist Subfolder
-        safe_playlist_name = "".join([c for c in playlist.name if c.isalpha() or c.isdigit() or c==' ']).rstrip()
-        playlist_dir = os.path.join(base_output_path, safe_playlist_name)
-        
-        state.logs.append(f"Processing Playlist: {playlist.name}")
-        
-        if not os.path.exists(playlist_dir):
-            os.makedirs(playlist_dir)
-        
-        # Update output template for this playlist
-        ydl_opts['outtmpl'] = f'{playlist_dir}/%(artist)s - %(title)s.%(ext)s'
-        ydl_opts['output_dir'] = playlist_dir 
+    # Tracks finish out of order, so every shared mutation of `state`
+    # (counters, logs, completed_files) goes through this lock, and each
+    # playlist keeps a slot per track so the M3U8 stays in playlist order.
+    state_lock = threading.Lock()
+    m3u_lock = threading.Lock()
+    playlist_slots: List[list] = []
+    playlist_remaining: List[int] = []
+    playlist_dirs: List[str] = []
+    playlist_flushed: List[float] = []
+    # URI -> later occurrences of a track already in the pipeline, as
+    # (playlist_index, track_index, task_id). A track listed twice in a job is
+    # downloaded once (two copies would share an outtmpl and ffmpeg target);
+    # the others are settled from its result.
+    in_flight: Dict[str, list] = {}
+    # Index of the playlist still receiving tracks from track_stream (None when closed)
+    stream_index = len(playlists) - 1 if track_stream is not None else None
 
-        m3u_content = ["#EXTM3U"]
-        
-        for track in playlist.tracks:
-            # Check for cancellation
-            if state.cancel_requested:
-                state.status = "cancelled"
-                state.logs.append("Download cancelled by user")
-                print(f"Job cancelled by user {user_id}")
-                return
-            
-            # Rate Limiting: Sleep 3-8 seconds to protect IP reputation
-            time.sleep(random.uniform(3, 8))
-            
-            state.current_track = f"[{playlist.name}] {track.name}"
-            
-            # Call the core logic
-            # Note: process_track might need updates if it relies on global singletons, 
-            # but currently it takes ydl_opts and manages its own index. 
-            # Ideally each user should have their own index? 
-            # For now, we share the index or let process_track handle it.
-            # Ideally pass output_dir to process_track to ensure index is relevant?
-            # existing process_track uses DOWNLOAD_INDEX_FILE which is global. 
-            # This might cause "Skipped" if User A downloaded it and User B tries.
-            # For now, acceptable optimization (global cache), but might be weird if users want separate files.
-            # Let's keep global deduplication for efficiency.
-            
-            result = process_track(track.model_dump(), ydl_opts)
-            
-            if result['status'] == 'success':
-                msg = f"Downloaded: {track.name}"
-                m3u_content.append(f"#EXTINF:-1,{track.artist} - {track.name}")
-                m3u_content.append(result.get('filename', ''))
-                
-                # Rel path relative to USER'S base folder (downloads/user_id) is usually what we want?
-                # Actually for UI download, we need track path relative to something handled by get_file.
-                # get_file will take path relative to downloads/.
-                # So we store path relative to downloads/
-                
-                full_rel_path = os.path.join(safe_user_id, safe_playlist_name, os.path.basename(result.get('filename', '')))
-                state.completed_files.append({
-                    "name": track.name,
-                    "path": full_rel_path
-                })
-
-            elif result['status'] == 'skipped':
-                msg = f"Skipped: {track.name}"
-                if 'filename' in result:
-                     m3u_content.append(f"#EXTINF:-1,{track.artist} - {track.name}")
-                     m3u_content.append(result['filename'])
-                     
-                     full_rel_path = os.path.join(safe_user_id, safe_playlist_name, os.path.basename(result.get('filename', '')))
-                     state.completed_files.append({
-                        "name": track.name,
-                        "path": full_rel_path
-                    })
-                
-            else:
-                msg = f"Error {track.name}: {result.get('message')}"
-                
-            print(msg)
-            state.logs.append(msg)
-            state.completed += 1
-            
-        # Write M3U8
+    def write_playlist_file(playlist_index: int, final: bool):
+        playlist = playlists[playlist_index]
+        with m3u_lock:
+            with state_lock:
+                entries = [(track.artist, track.name, filename) for track, filename in playlist_slots[playlist_index]]
+                playlist_flushed[playlist_index] = time.monotonic()
+            try:
+                 playlist_file = write_m3u(playlist_dirs[playlist_index], playlist.name, entries)
+                 if playlist_file and final:
+                     with state_lock:
+                         add_log(user_id, state, f"Created Playlist: {playlist_file}")
+            except Exception as e:
+                print(f"Error creating m3u: {e}")
+
+    def resolve(ctx: dict) -> dict:
+        with state_lock:
+            state.current_track = f"[{ctx['playlist'].name}] {ctx['track']['name']}"
+        return downloader.resolve_stage(ctx)
+
+    def record_finished(playlist: PlaylistBatch, track: Track, filename: Optional[str]):
+        # Caller holds state_lock
+        if filename:
+            # Store path relative to downloads/ (what get_file expects)
+            full_rel_path = completed_file_path(user_id, playlist.name, filename)
+            state.completed_files.append({
+                "name": track.name,
+                "path": full_rel_path
+            })
+            get_event_log(user_id).append("file", state.completed_files[-1])
+        state.completed += 1
+
+    def record_result(ctx: dict):
+        nonlocal run_processed, run_cpu_seconds
+        playlist = ctx['playlist']
+        playlist_index = ctx['playlist_index']
+        track = playlist.tracks[ctx['track_index']]
+        result = ctx['result']
+
+        filename = None
+        if result['status'] == 'success':
+            msg = f"Reused: {track.name}" if result.get('reused_from') else f"Downloaded: {track.name}"
+            filename = result.get('filename', '')
+        elif result['status'] == 'skipped':
+            msg = f"Skipped: {track.name}"
+            filename = result.get('filename')
+        else:
+            result.setdefault('error_class', retry.classify_error(result.get('message') or ''))
+            msg = f"Error {track.name} ({result['error_class']}): {result.get('message')}"
+            metrics.TRACK_ERRORS.inc(error_class=result['error_class'])
+
+        print(msg)
+        metrics.TRACKS.inc(status=result['status'])
+        cpu_seconds = ctx.get('cpu_seconds', 0.0)
         try:
-             playlist_file = os.path.join(playlist_dir, f"{playlist.name}.m3u8")
-             if len(m3u_content) > 1:
-                 with open(playlist_file, 'w', encoding='utf-8') as f:
-                     f.write("\n".join(m3u_content))
-                 state.logs.append(f"Created Playlist: {playlist_file}")
+            jobqueue.complete_task(ctx['task_id'], dict(result, cpu_seconds=cpu_seconds, timings=ctx.get('timings')))
         except Exception as e:
-            print(f"Error creating m3u: {e}")
-    
+            print(f"Checkpoint error: {e}")
+        if filename:
+            try:
+                library.record_track(user_id, playlist.name, ctx['track_index'], ctx['track'], filename,
+                                     os.path.join(playlist_dirs[playlist_index], filename))
+            except Exception as e:
+                print(f"Library error: {e}")
+
+        with state_lock:
+            run_processed += 1
+            run_cpu_seconds += cpu_seconds
+            state.stats = jobqueue.throughput(run_processed, run_cpu_seconds, time.monotonic() - run_started)
+            metrics.merge_timings(run_timings, ctx.get('timings'))
+            state.timings = metrics.timing_summary(run_timings)
+            if result['status'] == 'error':
+                state.errors[result['error_class']] = state.errors.get(result['error_class'], 0) + 1
+            record_finished(playlist, track, filename)
+            add_log(user_id, state, msg)
+            emit_progress(user_id, state)
+
+            playlist_slots[playlist_index][ctx['track_index']] = (track, filename)
+            playlist_remaining[playlist_index] -= 1
+            playlist_done = playlist_remaining[playlist_index] == 0 and playlist_index != stream_index
+            flush_due = time.monotonic() - playlist_flushed[playlist_index] >= M3U_FLUSH_SECONDS
+
+        # Keep the M3U8 current while the playlist is in progress, and write the final one when its last track lands
+        if playlist_done or (flush_due and filename):
+            write_playlist_file(playlist_index, final=playlist_done)
+
+    def settle_duplicate(first: dict, playlist_index: int, track_index: int, task_id: int):
+        playlist = playlists[playlist_index]
+        ctx = {
+            'track': playlist.tracks[track_index].model_dump(),
+            'playlist': playlist,
+            'playlist_index': playlist_index,
+            'track_index': track_index,
+            'task_id': task_id,
+        }
+        result = first['result']
+        filename = result.get('filename') if result['status'] in ('success', 'skipped') else None
+        if filename:
+            source = os.path.join(playlist_dirs[first['playlist_index']], filename)
+            target = os.path.join(playlist_dirs[playlist_index], filename)
+            try:
+                # Another playlist of this job: link the same file there
+                if not os.path.exists(target):
+                    content_hash = media_store.linked_hash(source)
+                    if not (content_hash and media_store.link(content_hash, target)):
+                        media_store.place(source, target)
+                ctx['result'] = {"status": "skipped", "message": "Duplicate in job", "filename": filename}
+            except Exception as e:
+                ctx['result'] = retry.error_result(e)
+        else:
+            ctx['result'] = dict(result)
+        record_result(ctx)
+
+    def on_result(ctx: dict):
+        record_result(ctx)
+        with state_lock:
+            duplicates = in_flight.pop(ctx['track'].get('uri'), [])
+        for playlist_index, track_index, task_id in duplicates:
+            settle_duplicate(ctx, playlist_index, track_index, task_id)
+
+    # Carry over results from an earlier run of this job
+    pending_work = []
+    with state_lock:
+        for playlist_index, playlist in enumerate(playlists):
+            # Create Playlist Subfolder
+            playlist_dir = os.path.join(base_output_path, safe_playlist_name(playlist.name))
+            if not os.path.exists(playlist_dir):
+                os.makedirs(playlist_dir)
+
+            slots = []
+            remaining = 0
+            for track_index, track in enumerate(playlist.tracks):
+                task = tasks[(playlist_index, track_index)]
+                if task['status'] in ('success', 'skipped'):
+                    slots.append((track, task['filename']))
+                    record_finished(playlist, track, task['filename'])
+                else:
+                    slots.append((track, None))
+                    remaining += 1
+                    pending_work.append((playlist_index, track_index, task['id']))
+            playlist_slots.append(slots)
+            playlist_remaining.append(remaining)
+            playlist_dirs.append(playlist_dir)
+            playlist_flushed.append(0.0)
+        if state.completed and sync:
+            add_log(user_id, state, f"Sync: {state.completed}/{total_tracks} tracks already in the library")
+        elif state.completed:
+            add_log(user_id, state, f"Resuming: {state.completed}/{total_tracks} tracks already done")
+        emit_progress(user_id, state)
+
+    for playlist_index, remaining in enumerate(playlist_remaining):
+        if remaining == 0 and playlist_index != stream_index:
+            write_playlist_file(playlist_index, final=True)
+
+    def playlist_opts(playlist_index: int) -> dict:
+        # Per-playlist copy of the options: tracks must not share a mutable outtmpl
+        playlist_dir = playlist_dirs[playlist_index]
+        opts = dict(ydl_opts)
+        opts['outtmpl'] = f'{playlist_dir}/%(artist)s - %(title)s.%(ext)s'
+        opts['output_dir'] = playlist_dir
+        return opts
+
+    def submit_track(playlist_index: int, track_index: int, task_id: int, opts: dict):
+        playlist = playlists[playlist_index]
+        uri = playlist.tracks[track_index].uri
+        with state_lock:
+            if uri in in_flight:
+                in_flight[uri].append((playlist_index, track_index, task_id))
+                return
+            in_flight[uri] = []
+        ctx = downloader.new_track_context(playlist.tracks[track_index].model_dump(), opts)
+        ctx.update({
+            'playlist': playlist,
+            'playlist_index': playlist_index,
+            'track_index': track_index,
+            'task_id': task_id,
+        })
+        pipeline.submit(ctx)
+
+    def submit_stream_batch(batch: List[Track], opts: dict):
+        playlist = playlists[stream_index]
+        start = len(playlist.tracks)
+        task_ids = jobqueue.append_tasks(job_id, stream_index, start, [t.model_dump() for t in batch], inline=True)
+        with state_lock:
+            playlist.tracks.extend(batch)
+            playlist_slots[stream_index].extend((track, None) for track in batch)
+            playlist_remaining[stream_index] += len(batch)
+            state.total += len(batch)
+            emit_progress(user_id, state)
+        for offset, task_id in enumerate(task_ids):
+            submit_track(stream_index, start + offset, task_id, opts)
+
+    # resolve/fetch are network bound and scale with the job's worker count,
+    # transcode is CPU bound and gets one ffmpeg per core, tagging is cheap.
+    # Rate limiting is handled per upstream inside the stages (see ratelimit.py).
+    stage_workers = {
+        'resolve': worker_count,
+        'fetch': worker_count,
+        'transcode': TRANSCODE_WORKERS,
+        'tag': TAG_WORKERS,
+    }
+    stage_fns = dict(downloader.TRACK_STAGES)
+    stage_fns['resolve'] = resolve
+    pipeline = Pipeline(
+        [Stage(name, stage_fns[name], stage_workers[name]) for name, _ in downloader.TRACK_STAGES],
+        on_result,
+    ).start()
+    active_pipelines[user_id] = pipeline
+
+    sampler = None
+    if profile:
+        job_thread = threading.get_ident()
+        sampler = StackSampler(lambda: {t.ident for s in pipeline.stages for t in s.threads} | {job_thread}).start()
+
+    try:
+        current_playlist = None
+        for playlist_index, track_index, task_id in pending_work:
+            # Check for cancellation
+            if state.cancel_requested:
+                pipeline.cancel()
+                break
+
+            if playlist_index != current_playlist:
+                current_playlist = playlist_index
+                with state_lock:
+                    add_log(user_id, state, f"Processing Playlist: {playlists[playlist_index].name}")
+                opts = playlist_opts(playlist_index)
+            submit_track(playlist_index, track_index, task_id, opts)
+
+        if track_stream is not None and not state.cancel_requested:
+            with state_lock:
+                add_log(user_id, state, f"Processing Playlist: {playlists[stream_index].name}")
+            opts = playlist_opts(stream_index)
+            batch = []
+            try:
+                for track in track_stream:
+                    batch.append(track)
+                    if len(batch) >= STREAM_BATCH_SIZE:
+                        submit_stream_batch(batch, opts)
+                        batch = []
+                    if state.cancel_requested:
+                        break
+            except Exception as e:
+                # A broken upload ends the stream: the tracks read so far still download
+                with state_lock:
+                    add_log(user_id, state, f"Stopped reading tracks: {e}")
+                print(f"Track stream error for user {user_id}: {e}")
+            if batch and not state.cancel_requested:
+                submit_stream_batch(batch, opts)
+            # Stream exhausted: the playlist is now final once its last track lands
+            with state_lock:
+                closed_index, stream_index = stream_index, None
+                stream_done = playlist_remaining[closed_index] == 0
+            if stream_done and not state.cancel_requested:
+                write_playlist_file(closed_index, final=True)
+    finally:
+        # Finish in-flight tracks (or drop them if cancelled) before reporting
+        if state.cancel_requested:
+            pipeline.cancel()
+        pipeline.close()
+        active_pipelines.pop(user_id, None)
+        state.pipeline = pipeline.stats()
+        print(f"YoutubeDL pool after job {job_id}: {ydl_pool.stats()}")
+        if sampler is not None:
+            path = sampler.stop().write(profile_path(job_id))
+            print(f"Profile written: {path} ({sampler.samples} samples)")
+        metrics.JOB_SECONDS.observe(time.monotonic() - run_started, status="cancelled" if state.cancel_requested else "done")
+
+    if state.cancel_requested:
+        # Flush what we have so the partial playlist is usable; /api/resume picks up the rest
+        for playlist_index, remaining in enumerate(playlist_remaining):
+            if 0 < remaining < len(playlists[playlist_index].tracks):
+                write_playlist_file(playlist_index, final=False)
+        jobqueue.set_job_status(job_id, "cancelled")
+        state.status = "cancelled"
+        state.current_track = ""
+        add_log(user_id, state, "Download cancelled by user")
+        emit_progress(user_id, state)
+        print(f"Job cancelled by user {user_id}")
+        return
+
+    jobqueue.set_job_status(job_id, "done")
     state.status = "done"
     state.current_track = ""
+    emit_progress(user_id, state)
     print(f"Job finished for user {user_id}")
 
+def check_storage(playlists: List[PlaylistBatch]):
+    """Admission control: 507 if the job can't fit in the storage budget (see storage.py)."""
+    refusal = storage.admit([t.model_dump() for p in playlists for t in p.tracks])
+    if refusal:
+        raise HTTPException(status_code=507, detail=refusal)
+
+def submit_job(background_tasks: BackgroundTasks, user_id: str, playlists: List[PlaylistBatch], quality: str, output_path: str = "downloads", workers: Optional[int] = None, profile: bool = False, sync: bool = False, prune: bool = False) -> dict:
+    """Start a job in-process (inline mode) or put it on the persistent queue (external mode)."""
+    if QUEUE_MODE == "external":
+        if jobqueue.active_job(user_id) is not None:
+            return {"message": "Job already in progress", "status": "working"}
+        check_storage(playlists)
+        plan = [{"name": p.name, "tracks": [t.model_dump() for t in p.tracks]} for p in playlists]
+        done = sync_playlists(user_id, output_path, plan, prune=prune) if sync else None
+        job_id = jobqueue.enqueue_job(user_id, plan, quality, output_path, done=done)
+        if done and len(done) == sum(len(p.tracks) for p in playlists):
+            jobqueue.add_event(user_id, "progress", {"status": "done", "total": len(done), "completed": len(done), "current_track": ""})
+            return {"message": "Already in sync", "status": "done", "job_id": job_id}
+        return {"message": "Download queued", "status": "starting"}
+
+    state = get_job_state(user_id)
+    if state.status == "working":
+        return {"message": "Job already in progress", "status": "working"}
+    check_storage(playlists)
+    claim_job(state)
+
+    # Start background task with USER CONTEXT
+    background_tasks.add_task(run_download_job, user_id, playlists, quality, output_path, workers, profile=profile, sync=sync, prune=prune)
+    return {"message": "Download started", "status": "starting"}
+
+def event_source(user_id: str):
+    """Where /api/events reads from: this process's ring buffer, or the shared queue DB."""
+    if QUEUE_MODE == "external":
+        return jobqueue.QueueEventLog(user_id)
+    return get_event_log(user_id)
+
 @app.get("/")
 def read_root():
     return {"message": "Offlineify API is running"}
@@ -210,13 +574,13 @@ def get_file(path: str, user_id: str):
          raise HTTPException(status_code=403, detail="Invalid file path")
     
     # Path must start with user_id
-    safe_user_id = "".join([c for c in user_id if c.isalnum() or c in ['@', '.', '-', '_']])
     # Check if the requested path actually inside the user's folder
     # path is like "user_id/playlist/song.mp3"
-    if not path.startswith(safe_user_id):
+    if not path.startswith(safe_user_id(user_id)):
             raise HTTPException(status_code=403, detail="Access denied")
 
     if os.path.exists(safe_path):
+        storage.touch(safe_path)
         return FileResponse(safe_path, filename=os.path.basename(path))
     return {"error": "File not found"}
 
@@ -225,38 +589,197 @@ async def start_download(request: DownloadRequest, background_tasks: BackgroundT
     if not x_user_id:
         raise HTTPException(status_code=400, detail="User ID required")
         
-    state = get_job_state(x_user_id)
-    
+    return submit_job(background_tasks, x_user_id, request.playlists, request.quality, request.output_path, request.workers,
+                      profile=request.profile, sync=request.sync, prune=request.prune)
+
+@app.post("/api/resume")
+def resume_download(user_id: str, background_tasks: BackgroundTasks, workers: Optional[int] = None):
+    """Continue the user's latest job from its checkpoint: only unfinished or failed tracks are processed."""
+    if not user_id:
+        raise HTTPException(status_code=400, detail="User ID required")
+
+    if QUEUE_MODE == "external":
+        if jobqueue.active_job(user_id) is not None:
+            return {"message": "Job already in progress", "status": "working"}
+        job = jobqueue.resumable_job(user_id)
+        if job is None:
+            return {"message": "Nothing to resume", "status": "idle"}
+        jobqueue.reset_unfinished(job['id'])
+        return {"message": "Download resumed", "status": "starting", "job_id": job['id']}
+
+    state = get_job_state(user_id)
     if state.status == "working":
         return {"message": "Job already in progress", "status": "working"}
-    
-    # Start background task with USER CONTEXT
-    background_tasks.add_task(run_download_job, x_user_id, request.playlists, request.quality, request.output_path)
-    return {"message": "Download started", "status": "starting"}
+    job = jobqueue.resumable_job(user_id)
+    if job is None:
+        return {"message": "Nothing to resume", "status": "idle"}
+
+    playlists = [PlaylistBatch(**p) for p in jobqueue.job_plan(job['id'])]
+    claim_job(state)
+    background_tasks.add_task(run_download_job, user_id, playlists, job['quality'], job['output_path'], workers, job['id'])
+    return {"message": "Download resumed", "status": "starting", "job_id": job['id']}
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus scrape endpoint (text exposition format)."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/api/status")
 def get_status(user_id: Optional[str] = Query(None)):
     if not user_id:
         return JobState() # Return empty state
-    return get_job_state(user_id)
+    if QUEUE_MODE == "external":
+        return JobState(**jobqueue.job_state(user_id))
+    state = get_job_state(user_id)
+    pipeline = active_pipelines.get(user_id)
+    if pipeline is not None:
+        state.pipeline = pipeline.stats()
+    return state
+
+# How often open event streams check for new events, and send keep-alives
+EVENT_POLL_INTERVAL = 0.5
+EVENT_KEEPALIVE = 15
+
+@app.get("/api/events")
+async def stream_events(request: Request, user_id: str, cursor: int = 0, last_event_id: Optional[str] = Header(None)):
+    """
+    Server-Sent Events stream of job events (log / file / progress) after `cursor`.
+    Reconnecting EventSource clients resume from their Last-Event-ID automatically.
+    An event of type "reset" means the client fell behind the ring buffer and
+    should re-sync once from /api/status.
+    """
+    if last_event_id and last_event_id.isdigit():
+        cursor = int(last_event_id)
+    log = event_source(user_id)
+
+    async def generate():
+        nonlocal cursor
+        idle = 0.0
+        while not await request.is_disconnected():
+            events, missed, next_cursor = log.since(cursor)
+            if missed:
+                # The id moves the client's Last-Event-ID along, for reconnects
+                yield f"id: {next_cursor}\nevent: reset\ndata: {json.dumps({'cursor': next_cursor})}\n\n"
+            for event in events:
+                yield f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+            # Past a reset too, so it's sent once (not on every poll)
+            cursor = next_cursor
+            if events:
+                idle = 0.0
+                continue
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
+            idle += EVENT_POLL_INTERVAL
+            if idle >= EVENT_KEEPALIVE:
+                idle = 0.0
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(generate(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/api/events/poll")
+async def poll_events(user_id: str, cursor: int = 0, timeout: float = 20):
+    """Long-poll variant of /api/events for clients without EventSource. Returns {cursor, events, reset}."""
+    log = event_source(user_id)
+    waited = 0.0
+    timeout = max(0.0, min(timeout, 60))
+    while True:
+        events, missed, next_cursor = log.since(cursor)
+        if events or missed or waited >= timeout:
+            break
+        await asyncio.sleep(EVENT_POLL_INTERVAL)
+        waited += EVENT_POLL_INTERVAL
+    return {"cursor": next_cursor, "events": events, "reset": missed}
+
+def parse_range(range_header: Optional[str], size: int):
+    """Parse a single 'bytes=start-end' range. Returns (start, end) or None for a full response."""
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start_s, _, end_s = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start_s == "":
+            # Suffix range: last N bytes
+            length = int(end_s)
+            if length <= 0:
+                raise ValueError
+            return max(0, size - length), size - 1
+        start = int(start_s)
+        end = int(end_s) if end_s else size - 1
+    except ValueError:
+        raise HTTPException(status_code=416, detail="Invalid range", headers={"Content-Range": f"bytes */{size}"})
+    if start >= size or end < start:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+def library_response(request: Request, user_id: str, build) -> Response:
+    """JSON from build() with the user's library version as ETag; 304 if the client's copy is current."""
+    etag = f'W/"{library.version(user_id)}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(build(), headers=headers)
+
+@app.get("/api/library")
+def get_library(request: Request, user_id: str, playlist: Optional[str] = None, artist: Optional[str] = None,
+                album: Optional[str] = None, q: Optional[str] = None, offset: int = 0, limit: int = 100):
+    """One page of the user's downloaded tracks, in playlist order, from the library index."""
+    return library_response(request, user_id, lambda: library.list_tracks(
+        user_id, playlist=playlist, artist=artist, album=album, q=q, offset=offset, limit=limit))
+
+@app.get("/api/library/playlists")
+def get_library_playlists(request: Request, user_id: str):
+    return library_response(request, user_id, lambda: {"playlists": library.list_playlists(user_id)})
+
+@app.post("/api/library/rebuild")
+def rebuild_library(user_id: str):
+    """Re-index the user's folder (downloads made before the library index existed)."""
+    return {"tracks": library.rebuild(user_id)}
 
 @app.get("/api/zip")
-def download_zip(user_id: str):
-    """Zips the USER'S download folder"""
+def download_zip(user_id: str, request: Request, playlist: Optional[str] = None):
+    """
+    Streams the USER'S download folder (or one playlist subfolder) as a ZIP.
+    Built on the fly with stored entries: no temp archive, constant memory,
+    exact Content-Length, and Range support for resuming.
+    """
     if not user_id:
         raise HTTPException(status_code=400, detail="User ID required")
         
-    safe_user_id = "".join([c for c in user_id if c.isalnum() or c in ['@', '.', '-', '_']])
-    user_dir = os.path.join("downloads", safe_user_id)
+    user_dir = os.path.join("downloads", safe_user_id(user_id))
     
     if not os.path.exists(user_dir):
         raise HTTPException(status_code=404, detail="Nothing to download")
 
-    zip_filename = f"offlineify_{safe_user_id}_{uuid.uuid4().hex[:8]}"
-    zip_path = os.path.join("downloads", zip_filename) 
-    
-    shutil.make_archive(zip_path, 'zip', user_dir)
-    return FileResponse(f"{zip_path}.zip", filename="your_music.zip")
+    subdir = None
+    download_name = "your_music.zip"
+    if playlist:
+        # Same sanitizing as the playlist folder names created by run_download_job
+        subdir = safe_playlist_name(playlist)
+        if not subdir or not os.path.isdir(os.path.join(user_dir, subdir)):
+            raise HTTPException(status_code=404, detail="Playlist not found")
+        download_name = f"{subdir}.zip"
+
+    archive = ZipStream(collect_entries(user_dir, subdir))
+    storage.touch_dir(os.path.join(user_dir, subdir) if subdir else user_dir)
+    etag = archive.etag()
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f'attachment; filename="{download_name}"',
+    }
+
+    # Only honour Range if the archive is unchanged since the client's first request
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    if not if_range or if_range == etag:
+        byte_range = parse_range(request.headers.get("range"), archive.size)
+
+    if byte_range is None:
+        headers["Content-Length"] = str(archive.size)
+        return StreamingResponse(iter(archive), media_type="application/zip", headers=headers)
+
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{archive.size}"
+    return StreamingResponse(archive.iter_range(start, end), status_code=206, media_type="application/zip", headers=headers)
 
 @app.get("/api/choose-directory")
 def choose_directory():
@@ -309,51 +832,185 @@ def cancel_download(user_id: str):
     if not user_id:
         raise HTTPException(status_code=400, detail="User ID required")
     
+    if QUEUE_MODE == "external":
+        maintenance_state = job_states.get(user_id)
+        if maintenance_state is not None and maintenance_state.status == "working":
+            # Maintenance runs in this process even in external mode
+            maintenance_state.cancel_requested = True
+            return {"message": "Cancellation requested", "status": "cancelling"}
+        if jobqueue.cancel_job(user_id) is None:
+            return {"message": "No active download to cancel", "status": "idle"}
+        return {"message": "Cancellation requested", "status": "cancelling"}
+
     state = get_job_state(user_id)
     if state.status != "working":
         return {"message": "No active download to cancel", "status": state.status}
     
     state.cancel_requested = True
+    # Drop queued pipeline work right away; in-flight stages finish on their own
+    pipeline = active_pipelines.get(user_id)
+    if pipeline is not None:
+        pipeline.cancel()
     return {"message": "Cancellation requested", "status": "cancelling"}
 
+def run_maintenance_job(user_id: str, playlist: Optional[str], retag: bool, verify: bool, decode: bool, requeue: bool, quality: str):
+    """Re-tag and check the user's files (see maintenance.py), then re-download what's broken as a sync job."""
+    from . import maintenance
+    state = get_job_state(user_id)
+    state.status = "working"
+    state.total = 0
+    state.completed = 0
+    state.logs = []
+    state.completed_files = []
+    state.stats = {}
+    state.timings = {}
+    state.errors = {}
+
+    def on_start(total: int):
+        state.total = total
+        emit_progress(user_id, state)
+
+    def on_result(entry: dict, result: dict):
+        state.completed += 1
+        state.current_track = f"[{entry['playlist']}] {entry['track'].get('name')}"
+        if result['status'] in (maintenance.MISSING, maintenance.CORRUPT, maintenance.LENGTH_MISMATCH, maintenance.FAILED):
+            state.errors[result['status']] = state.errors.get(result['status'], 0) + 1
+            add_log(user_id, state, f"{result['status'].capitalize()}: {entry['track'].get('name')} ({result['message']})")
+        emit_progress(user_id, state)
+
+    summary = None
+    try:
+        summary = maintenance.run_maintenance(user_id, playlist, retag=retag, verify=verify, decode=decode,
+                                              on_start=on_start, on_result=on_result,
+                                              should_stop=lambda: state.cancel_requested)
+        counts = ", ".join(f"{n} {status}" for status, n in sorted(summary['counts'].items())) or "nothing to do"
+        add_log(user_id, state, f"Maintenance: {counts}, {summary['relinked']} relinked, "
+                                f"{summary['covers']['fetched']}/{summary['covers']['distinct']} covers")
+    except Exception as e:
+        add_log(user_id, state, f"Maintenance error: {e}")
+        print(f"Maintenance error for user {user_id}: {e}")
+
+    if summary and requeue and summary['requeue'] and not state.cancel_requested:
+        tracks = sum(len(p['tracks']) for p in summary['requeue'])
+        add_log(user_id, state, f"Re-downloading missing and corrupt tracks ({len(summary['requeue'])} playlists, {tracks} tracks checked)")
+        if QUEUE_MODE == "external":
+            maintenance.enqueue_requeue(summary['requeue'], quality)
+        else:
+            playlists = [PlaylistBatch(name=p['name'], tracks=[Track(**t) for t in p['tracks']]) for p in summary['requeue']]
+            run_download_job(user_id, playlists, quality, sync=True)
+            return
+
+    state.status = "cancelled" if state.cancel_requested else "done"
+    state.current_track = ""
+    emit_progress(user_id, state)
+
+@app.post("/api/maintenance")
+def start_maintenance(user_id: str, background_tasks: BackgroundTasks, playlist: Optional[str] = None, retag: bool = True,
+                      verify: bool = True, decode: bool = False, requeue: bool = True, quality: str = "320"):
+    """Re-tag (tags and cover art) and verify the user's downloaded files in place; broken ones are re-downloaded."""
+    if not user_id:
+        raise HTTPException(status_code=400, detail="User ID required")
+    state = get_job_state(user_id)
+    # Files must not be re-tagged while a job is writing them
+    if state.status == "working" or (QUEUE_MODE == "external" and jobqueue.active_job(user_id) is not None):
+        return {"message": "Job already in progress", "status": "working"}
+    claim_job(state)
+    background_tasks.add_task(run_maintenance_job, user_id, playlist, retag, verify, decode, requeue, quality)
+    return {"message": "Maintenance started", "status": "starting"}
+
+CSV_PLAYLIST_NAME = "CSV Upload"
+
+def csv_track_stream(user_id: str, csv_path: str) -> Iterator[Track]:
+    """Tracks from an uploaded CSV, one row at a time; rows that can't be downloaded are logged and skipped."""
+    def on_invalid(line: int, reason: str):
+        print(f"CSV line {line} skipped for user {user_id}: {reason}")
+    for fields in iter_csv_tracks(csv_path, on_invalid):
+        yield Track(**fields)
+
+def run_csv_job(user_id: str, csv_path: str, quality: str, output_path: str = "downloads"):
+    """Inline mode: download while the CSV is still being read."""
+    try:
+        run_download_job(user_id, [PlaylistBatch(name=CSV_PLAYLIST_NAME, tracks=[])], quality, output_path,
+                         track_stream=csv_track_stream(user_id, csv_path))
+    finally:
+        os.remove(csv_path)
+
+def enqueue_csv_job(user_id: str, job_id: str, csv_path: str, output_path: str = "downloads"):
+    """External mode: feed CSV rows into a loading job in batches; workers start on the first batch."""
+    try:
+        count = 0
+        batch = []
+        try:
+            for track in csv_track_stream(user_id, csv_path):
+                batch.append(track.model_dump())
+                if len(batch) >= STREAM_BATCH_SIZE:
+                    jobqueue.append_tasks(job_id, 0, count, batch)
+                    count += len(batch)
+                    batch = []
+                    job = jobqueue.get_job(job_id)
+                    if job is None or job['cancel_requested']:
+                        break
+            if batch:
+                jobqueue.append_tasks(job_id, 0, count, batch)
+                count += len(batch)
+        except Exception as e:
+            # Still finish loading below: a job left 'loading' blocks the user for good
+            print(f"CSV read error for user {user_id} (job {job_id}): {e}")
+            jobqueue.add_event(user_id, "log", f"Stopped reading tracks: {e}")
+        if jobqueue.finish_loading(job_id):
+            # Workers already finished every track: write the playlist they couldn't treat as final
+            playlist_dir = os.path.join(user_output_path(user_id, output_path), safe_playlist_name(CSV_PLAYLIST_NAME))
+            write_m3u(playlist_dir, CSV_PLAYLIST_NAME, jobqueue.playlist_entries(job_id, 0))
+        print(f"Queued {count} CSV tracks for user {user_id} (job {job_id})")
+    finally:
+        os.remove(csv_path)
+
 @app.post("/api/csv-download")
-async def csv_download(file: UploadFile, background_tasks: BackgroundTasks, quality: str = "320", user_id: str = "csv_user"):
-    """Upload a Spotify CSV export and download the tracks"""
+async def csv_download(
+    file: UploadFile,
+    background_tasks: BackgroundTasks,
+    quality: str = "320",
+    user_id: str = "csv_user",
+    form_quality: Optional[str] = Form(None, alias="quality"),
+    form_user_id: Optional[str] = Form(None, alias="user_id"),
+):
+    """
+    Upload a Spotify CSV export and download the tracks.
+    The upload is spooled to disk and parsed row by row as the job runs, so
+    the first tracks start downloading before the whole file is read.
+    """
+    # The web UI sends these as form fields; query params still work
+    quality = form_quality or quality
+    user_id = form_user_id or user_id
+
+    csv_path = await save_upload(file)
     try:
-        # Read CSV file
-        import io
-        contents = await file.read()
-        df = pd.read_csv(io.BytesIO(contents))
-        
-        # Parse tracks from CSV
-        tracks = []
-        for _, row in df.iterrows():
-            track = Track(
-                uri=row.get('Track URI', ''),
-                name=row.get('Track Name', ''),
-                artist=row.get('Artist Name(s)', ''),
-                album=row.get('Album Name', ''),
-                cover_url=row.get('Album Image URL', None),
-                release_date=row.get('Album Release Date', None),
-                track_number=int(row.get('Track Number', 0)) if pd.notna(row.get('Track Number')) else None,
-                total_tracks=int(row.get('Album Artist Name(s)', 0)) if pd.notna(row.get('Album Artist Name(s)')) else None,
-                explicit=bool(row.get('Explicit', 'false').lower() == 'true')
-            )
-            tracks.append(track)
-        
-        # Create a single playlist batch
-        playlist_batch = PlaylistBatch(name="CSV Upload", tracks=tracks)
-        
-        # Start download job
+        check_header(csv_path)
+    except (ValueError, UnicodeDecodeError) as e:
+        os.remove(csv_path)
+        raise HTTPException(status_code=400, detail=f"CSV parsing error: {str(e)}")
+    # The row count isn't known yet: only refuse when the budget is already exhausted
+    refusal = storage.admit()
+    if refusal:
+        os.remove(csv_path)
+        raise HTTPException(status_code=507, detail=refusal)
+
+    if QUEUE_MODE == "external":
+        if jobqueue.active_job(user_id) is not None:
+            os.remove(csv_path)
+            return {"message": "Job already in progress", "status": "working"}
+        job_id = jobqueue.enqueue_job(user_id, [{"name": CSV_PLAYLIST_NAME, "tracks": []}], quality, "downloads", loading=True)
+        background_tasks.add_task(enqueue_csv_job, user_id, job_id, csv_path)
+    else:
         state = get_job_state(user_id)
         if state.status == "working":
+            os.remove(csv_path)
             return {"message": "Job already in progress", "status": "working"}
-        
-        background_tasks.add_task(run_download_job, user_id, [playlist_batch], quality, "downloads")
-        return {"message": "CSV upload successful, download started", "status": "starting", "track_count": len(tracks)}
-        
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"CSV parsing error: {str(e)}")
+        claim_job(state)
+        background_tasks.add_task(run_csv_job, user_id, csv_path, quality)
+
+    # Rows are counted as they are read; /api/status reports the running total
+    return {"message": "CSV upload successful, download started", "status": "starting", "track_count": None}
 
 if __name__ == "__main__":
     import uvicorn
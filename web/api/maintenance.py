@@ -0,0 +1,272 @@
+# Library maintenance: re-tag, refresh covers and check the integrity of
+# tracks already on disk, without downloading them again.
+#
+#     python -m web.api.maintenance --user alice@example.com [--playlist NAME] [--decode]
+#     python -m web.api.maintenance --all --requeue
+#
+# Walks the library index (library.py) of one user, one of their playlists,
+# or every user. Covers are fetched first, once per album, into the cover
+# cache. Then every file is checked and re-tagged in a process pool: tag
+# writing and decoding are CPU bound, and pool processes never touch the
+# network (covers come from the cache, nothing is searched or downloaded).
+# Only files with the full metadata of their download are re-tagged: rows
+# rebuilt from folders that predate the library index (library.rebuild) keep
+# the tags they were written with.
+# Files that are missing and can't be relinked from the media store, or that
+# don't parse or don't decode (--decode), are removed. A length that doesn't
+# match the track's is only reported: the download may be a longer or shorter
+# version the matcher picked on purpose, and would come back the same.
+# Their playlists are returned for re-download as sync jobs, so only those
+# tracks are fetched again. POST /api/maintenance runs the same thing.
+import os
+import argparse
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from . import index_db
+from . import library
+from . import media_store
+from . import search_cache
+from .paths import DOWNLOADS_ROOT
+
+MAINTENANCE_WORKERS = int(os.environ.get('OFFLINEIFY_MAINTENANCE_WORKERS', str(os.cpu_count() or 2)))
+# Files whose length differs from the track's by more than this many seconds are reported (not removed)
+VERIFY_DURATION_TOLERANCE = float(os.environ.get('OFFLINEIFY_VERIFY_DURATION_TOLERANCE', '15'))
+COVER_FETCH_WORKERS = 4
+CHUNK_SIZE = 16
+
+# Outcome of one file
+OK = 'ok'                # verified, tags untouched
+RETAGGED = 'retagged'    # verified (if asked) and re-tagged
+NO_METADATA = 'no_metadata'  # verified (if asked), not re-tagged: only partial metadata is known
+MISSING = 'missing'      # gone from disk and from the media store: re-download
+LENGTH_MISMATCH = 'length_mismatch'  # plays, but not the track's length: reported, kept (and re-tagged)
+CORRUPT = 'corrupt'      # unreadable or undecodable: removed, re-download
+FAILED = 'error'         # maintenance itself failed (file left as is)
+REQUEUE = (MISSING, CORRUPT)
+
+
+def cover_source(track):
+    """(url, square_crop) of the cover tag_stage would embed, or None."""
+    if track.get('cover_url'):
+        return (track['cover_url'], False)
+    cached = search_cache.get(track) if track.get('name') and track.get('artist') else None
+    if cached and cached.get('thumbnail'):
+        return (cached['thumbnail'], True)
+    return None
+
+
+def fetch_covers(sources):
+    """Get every distinct cover into the cover cache. Returns (fetched, distinct)."""
+    distinct = {s for s in sources if s}
+    if not distinct:
+        return 0, 0
+    from . import cover_cache
+    with ThreadPoolExecutor(COVER_FETCH_WORKERS) as pool:
+        fetched = sum(1 for data in pool.map(lambda s: cover_cache.get_cover_jpeg(*s), distinct) if data)
+    return fetched, len(distinct)
+
+
+def verify_file(path, track, decode=False):
+    """
+    (status, message): (None, None) if `path` looks like a complete copy of
+    `track`, (CORRUPT, ...) if it doesn't parse or decode, (LENGTH_MISMATCH, ...)
+    if it plays but its length is off.
+    """
+    import mutagen
+    from .downloader import run_ffmpeg
+    try:
+        audio = mutagen.File(path)
+    except Exception as e:
+        return CORRUPT, f"Unreadable: {e}"
+    length = getattr(getattr(audio, 'info', None), 'length', 0)
+    if not length:
+        return CORRUPT, "Not an audio file"
+    if decode:
+        try:
+            run_ffmpeg(['-xerror', '-i', path, '-map', '0:a', '-f', 'null', '-'])
+        except RuntimeError as e:
+            return CORRUPT, f"Decode failed: {e}"
+    expected = (track.get('duration_ms') or 0) / 1000.0
+    if expected and abs(length - expected) > VERIFY_DURATION_TOLERANCE:
+        return LENGTH_MISMATCH, f"Length {length:.0f}s, expected {expected:.0f}s"
+    return None, None
+
+
+def retag_file(path, track, cover_data=None):
+    """Re-write all tags of `path` in place and move it onto the blob of its new content."""
+    from .downloader import write_tags
+    old_hash = media_store.linked_hash(path)
+    # Other playlists may link the same blob: they get re-tagged on their own turn
+    media_store.detach(path)
+    write_tags(path, track, cover_data, replace=True)
+    new_hash = media_store.ingest(path)
+    uri = track.get('uri')
+    entry = index_db.get_track(uri) if uri else None
+    if entry and old_hash and entry.get('content_hash') == old_hash:
+        index_db.upsert_track(uri, content_hash=new_hash)
+
+
+def check_file(task, retag=True, verify=True, decode=False):
+    """
+    Maintain one file (runs in a pool process).
+    task: {"path": path on disk, "track": track dict, "complete": full metadata known,
+           "cover": (url, square_crop) or None}.
+    Returns {"path", "status", "message", "relinked", "retagged", "size"}.
+    """
+    path, track = task['path'], task['track']
+    result = {"path": path, "status": OK, "message": None, "relinked": False, "retagged": False, "size": None}
+    try:
+        if not os.path.exists(path):
+            entry = index_db.get_track(track.get('uri')) if track.get('uri') else None
+            content_hash = (entry or {}).get('content_hash')
+            if not (media_store.has_blob(content_hash) and media_store.link(content_hash, path)):
+                return dict(result, status=MISSING, message="Not on disk or in the media store")
+            result['relinked'] = True
+        if verify:
+            problem, message = verify_file(path, track, decode)
+            if problem == CORRUPT:
+                return dict(result, status=CORRUPT, message=message)
+            result['message'] = message
+        if retag and not task['complete']:
+            result['status'] = NO_METADATA
+        elif retag:
+            from . import cover_cache
+            cover_data = cover_cache.cached_cover_jpeg(*task['cover']) if task.get('cover') else None
+            retag_file(path, track, cover_data)
+            result['status'] = RETAGGED
+            result['retagged'] = True
+        if result['message']:
+            # Reported instead of the re-tag outcome: the file is kept either way
+            result['status'] = LENGTH_MISMATCH
+        result['size'] = os.path.getsize(path)
+    except Exception as e:
+        return dict(result, status=FAILED, message=str(e))
+    return result
+
+
+def _requeue_track(track):
+    # Re-download needs what a download request carries (rows rebuilt from old folders may not)
+    if not (track.get('uri') and track.get('name') and track.get('artist')):
+        return None
+    return dict(track, album=track.get('album') or '')
+
+
+def _discard(entry, result):
+    """Drop a missing or corrupt file so a sync job downloads it again."""
+    disk_path = result['path']
+    if result['status'] == CORRUPT:
+        media_store.unlink(disk_path)
+        # Its blob may hold the same broken bytes: don't let resolve_stage relink it
+        if entry['track'].get('uri'):
+            index_db.delete_track(entry['track']['uri'])
+    library.forget(disk_path)
+
+
+def run_maintenance(user_id=None, playlist=None, retag=True, verify=True, decode=False, workers=None,
+                    on_start=None, on_result=None, should_stop=None):
+    """
+    Maintain the library of `user_id` (every user if None), or only its `playlist`.
+    on_start(total) is called once the files are known, on_result(entry, result)
+    as each one finishes, should_stop() between files. Returns
+    {"counts": {status: n}, "relinked", "covers": {"fetched", "distinct"},
+     "requeue": [{"user_id", "name", "tracks"}]} where requeue lists the
+    playlists to sync again (every track, in order; present ones are skipped).
+    """
+    if user_id is not None and library.version(user_id) == 0:
+        # Downloads from before the library index existed
+        library.rebuild(user_id)
+    entries = library.entries(user_id, playlist)
+    tasks = [{"path": os.path.join(DOWNLOADS_ROOT, e['path']), "track": e['track'], "complete": e['complete'],
+              "cover": cover_source(e['track']) if retag and e['complete'] else None} for e in entries]
+    if on_start:
+        on_start(len(tasks))
+
+    fetched, distinct = fetch_covers(t['cover'] for t in tasks) if retag else (0, 0)
+    print(f"Maintenance: {len(tasks)} files, {fetched}/{distinct} covers available")
+
+    counts = {}
+    relinked = 0
+    updated = []
+    broken = set()
+    if tasks:
+        check = functools.partial(check_file, retag=retag, verify=verify, decode=decode)
+        # spawn, not fork: the API process has threads holding SQLite connections
+        pool = ProcessPoolExecutor(max(1, workers or MAINTENANCE_WORKERS), mp_context=multiprocessing.get_context('spawn'))
+        try:
+            for entry, result in zip(entries, pool.map(check, tasks, chunksize=CHUNK_SIZE)):
+                counts[result['status']] = counts.get(result['status'], 0) + 1
+                relinked += result['relinked']
+                if result['status'] in REQUEUE:
+                    try:
+                        _discard(entry, result)
+                    except Exception as e:
+                        print(f"Maintenance cleanup error {result['path']}: {e}")
+                    broken.add((entry['user_id'], entry['playlist']))
+                elif result['retagged']:
+                    updated.append((entry, result))
+                if on_result:
+                    on_result(entry, result)
+                if should_stop and should_stop():
+                    break
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    # Sizes change with the tags
+    by_user = {}
+    for entry, result in updated:
+        by_user.setdefault(entry['user_id'], []).append(
+            (entry['playlist'], entry['position'], entry['track'], os.path.basename(result['path']), result['path']))
+    for user, rows in by_user.items():
+        library.record_tracks(user, rows)
+
+    requeue = []
+    for user, name in sorted(broken):
+        tracks = [_requeue_track(e['track']) for e in entries if e['user_id'] == user and e['playlist'] == name]
+        requeue.append({"user_id": user, "name": name, "tracks": [t for t in tracks if t]})
+    print(f"Maintenance done: {counts}, {relinked} relinked, {len(requeue)} playlists to re-download")
+    return {"counts": counts, "relinked": relinked, "covers": {"fetched": fetched, "distinct": distinct}, "requeue": requeue}
+
+
+def enqueue_requeue(requeue, quality='320'):
+    """Put the re-downloads on the persistent queue as sync jobs (external mode), one job per user."""
+    from . import jobqueue
+    from .sync import sync_playlists
+    by_user = {}
+    for playlist in requeue:
+        by_user.setdefault(playlist['user_id'], []).append({"name": playlist['name'], "tracks": playlist['tracks']})
+    job_ids = []
+    for user, plan in by_user.items():
+        done = sync_playlists(user, DOWNLOADS_ROOT, plan)
+        job_ids.append(jobqueue.enqueue_job(user, plan, quality, DOWNLOADS_ROOT, done=done))
+    return job_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offlineify library maintenance")
+    scope = parser.add_mutually_exclusive_group(required=True)
+    scope.add_argument('--user', help="maintain this user's library")
+    scope.add_argument('--all', action='store_true', help="maintain every user's library")
+    parser.add_argument('--playlist', help="only this playlist (with --user)")
+    parser.add_argument('--no-retag', action='store_true', help="don't re-write tags and covers")
+    parser.add_argument('--no-verify', action='store_true', help="don't check that files parse (and report wrong lengths)")
+    parser.add_argument('--decode', action='store_true', help="also decode every file with ffmpeg (slower, catches corrupt frames)")
+    parser.add_argument('--workers', type=int, default=None, help="pool processes (default OFFLINEIFY_MAINTENANCE_WORKERS)")
+    parser.add_argument('--requeue', action='store_true', help="queue re-downloads for workers (OFFLINEIFY_QUEUE_MODE=external)")
+    parser.add_argument('--quality', default='320')
+    args = parser.parse_args()
+
+    def report(entry, result):
+        if result['status'] in (MISSING, CORRUPT, LENGTH_MISMATCH, FAILED):
+            print(f"{result['status']}: {result['path']} ({result['message']})")
+
+    summary = run_maintenance(None if args.all else args.user, args.playlist, retag=not args.no_retag,
+                              verify=not args.no_verify, decode=args.decode, workers=args.workers, on_result=report)
+    for playlist in summary['requeue']:
+        print(f"To re-download: {playlist['user_id']} / {playlist['name']}")
+    if args.requeue and summary['requeue']:
+        print(f"Queued jobs: {', '.join(enqueue_requeue(summary['requeue'], args.quality))}")
+
+
+if __name__ == "__main__":
+    main()
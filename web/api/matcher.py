@@ -0,0 +1,147 @@
+import os
+import re
+import unicodedata
+
+# Scores YouTube candidates against the Spotify track they should be.
+# Signals, strongest first:
+#   - ISRC found in the candidate's metadata (decisive when present)
+#   - duration vs the track's real length (duration_ms)
+#   - title / artist token overlap
+#   - channel: "<Artist> - Topic" auto-generated uploads, VEVO, the artist's own channel
+# Variant uploads (live, remix, sped up...) the track name doesn't ask for are penalized.
+# resolve_stage stops searching as soon as a candidate is confident().
+MATCH_ACCEPT_SCORE = float(os.environ.get('OFFLINEIFY_MATCH_ACCEPT', '0.75'))
+# Seconds of difference from the Spotify duration still treated as the same recording
+MATCH_DURATION_TOLERANCE = float(os.environ.get('OFFLINEIFY_MATCH_DURATION_TOLERANCE', '3'))
+# Beyond tolerance, the duration score falls to 0 over this many seconds
+DURATION_FALLOFF = 30.0
+
+WEIGHTS = {'duration': 0.45, 'title': 0.3, 'artist': 0.15, 'channel': 0.1}
+
+NOISE_WORDS = {
+    'the', 'a', 'an', 'feat', 'ft', 'featuring', 'official', 'video', 'audio', 'music',
+    'lyrics', 'lyric', 'hd', 'hq', 'topic', 'visualizer', 'mv', 'with',
+}
+VARIANT_WORDS = {
+    'live', 'cover', 'remix', 'karaoke', 'instrumental', 'nightcore', 'sped', 'slowed',
+    'reverb', '8d', 'acoustic', 'mashup', 'reaction', 'edit', 'extended', 'loop',
+}
+VARIANT_PENALTY = 0.5
+
+# "(feat. X)", "[Remastered 2011]", " - 2004 Remaster" add nothing to a search match
+_TITLE_SUFFIX = re.compile(r'\s*[\(\[][^\)\]]*[\)\]]|\s+-\s+.*$')
+_ARTIST_SPLIT = re.compile(r'\s*(?:;|,|&|\bx\b|\bfeat\.?|\bft\.?)\s*', re.IGNORECASE)
+
+
+def tokens(text):
+    if not text:
+        return set()
+    text = unicodedata.normalize('NFKD', str(text).lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return set(re.findall(r'\w+', text)) - NOISE_WORDS
+
+
+def core_title(name):
+    core = _TITLE_SUFFIX.sub('', name or '')
+    return core or name or ''
+
+
+def artist_names(track):
+    return [a for a in _ARTIST_SPLIT.split(track.get('artist') or '') if a.strip()]
+
+
+def _coverage(wanted, found):
+    if not wanted:
+        return None
+    return len(wanted & found) / len(wanted)
+
+
+def duration_score(track, candidate):
+    if not track.get('duration_ms') or not candidate.get('duration'):
+        return None
+    diff = abs(candidate['duration'] - track['duration_ms'] / 1000.0)
+    if diff <= MATCH_DURATION_TOLERANCE:
+        return 1.0
+    return max(0.0, 1.0 - (diff - MATCH_DURATION_TOLERANCE) / DURATION_FALLOFF)
+
+
+def channel_score(track, candidate):
+    channel = (candidate.get('channel') or candidate.get('uploader') or '').strip()
+    if not channel:
+        return None
+    lowered = channel.lower()
+    if lowered.endswith(' - topic') or 'vevo' in lowered:
+        return 1.0
+    channel_tokens = tokens(channel)
+    for artist in artist_names(track):
+        artist_tokens = tokens(artist)
+        if artist_tokens and artist_tokens <= channel_tokens:
+            return 1.0
+    return 0.3
+
+
+def isrc_match(track, candidate):
+    isrc = (track.get('isrc') or '').upper()
+    if not isrc:
+        return False
+    if (candidate.get('isrc') or '').upper() == isrc:
+        return True
+    return isrc in (candidate.get('description') or '').upper()
+
+
+def score_candidate(track, candidate):
+    """0..1 confidence that `candidate` (a yt-dlp entry) is `track`."""
+    if not candidate:
+        return 0.0
+    if isrc_match(track, candidate):
+        return 1.0
+
+    title_tokens = tokens(candidate.get('title'))
+    context_tokens = title_tokens | tokens(candidate.get('channel')) | tokens(candidate.get('uploader')) | tokens(candidate.get('artist'))
+
+    artist_scores = [_coverage(tokens(a), context_tokens) for a in artist_names(track)]
+    artist_scores = [s for s in artist_scores if s is not None]
+    signals = {
+        'duration': duration_score(track, candidate),
+        'title': _coverage(tokens(core_title(track.get('name'))), title_tokens),
+        # Main artist counts most; features are often left out of video titles
+        'artist': max(artist_scores) if artist_scores else None,
+        'channel': channel_score(track, candidate),
+    }
+    known = {k: v for k, v in signals.items() if v is not None}
+    if not known:
+        return 0.0
+    score = sum(WEIGHTS[k] * v for k, v in known.items()) / sum(WEIGHTS[k] for k in known)
+
+    # An unrequested variant is the wrong recording even if the text matches
+    unrequested = (title_tokens & VARIANT_WORDS) - tokens(track.get('name'))
+    if unrequested:
+        score *= VARIANT_PENALTY
+    return score
+
+
+def confident(track, candidate, score=None):
+    """
+    True when `candidate` is good enough to stop searching for more.
+    Needs the real track length: text alone can't tell an album cut from a
+    music video with a long intro.
+    """
+    if not candidate:
+        return False
+    if isrc_match(track, candidate):
+        return True
+    if duration_score(track, candidate) != 1.0:
+        return False
+    if score is None:
+        score = score_candidate(track, candidate)
+    return score >= MATCH_ACCEPT_SCORE
+
+
+def best_match(track, candidates):
+    """(candidate, score) with the highest score; earlier candidates win ties."""
+    best, best_score = None, -1.0
+    for candidate in candidates:
+        score = score_candidate(track, candidate)
+        if score > best_score:
+            best, best_score = candidate, score
+    return best, max(best_score, 0.0)
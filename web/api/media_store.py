@@ -0,0 +1,229 @@
+import os
+import time
+import shutil
+import hashlib
+from datetime import datetime
+from . import index_db
+
+# Content-addressed store for finished audio files.
+# Every finished file is hashed and kept once under MEDIA_STORE_DIR; the
+# per-user / per-playlist files are hardlinks (or reflinks, or copies as a
+# last resort) to that blob. blob_links records which paths point at which
+# blob, and blobs.refcount drops the blob when its last link goes away.
+# The store lives under downloads/ so hardlinks stay on one filesystem.
+# Files finished in a folder on another filesystem (a custom output folder on
+# another disk) are left out of the store: neither a hardlink nor a reflink
+# can reach it, and copying every track in would double the disk use.
+# A blob keeps the extension of the file it was ingested from (blobs.ext;
+# blobs stored before that was recorded are all .mp3).
+MEDIA_STORE_DIR = os.environ.get('OFFLINEIFY_MEDIA_STORE', os.path.join('downloads', '.media'))
+
+_CHUNK = 1024 * 1024
+
+_store_dev = None
+# Devices already reported as not sharing the store's filesystem
+_foreign_devs = set()
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def blob_path(content_hash, ext=None):
+    if ext is None:
+        row = index_db.connect().execute("SELECT ext FROM blobs WHERE hash = ?", (content_hash,)).fetchone()
+        ext = (row['ext'] if row else None) or '.mp3'
+    return os.path.join(MEDIA_STORE_DIR, content_hash[:2], f"{content_hash}{ext}")
+
+
+def has_blob(content_hash):
+    return bool(content_hash) and os.path.exists(blob_path(content_hash))
+
+
+def linked_hash(path):
+    """Hash of the blob `path` is linked to, or None."""
+    row = index_db.connect().execute("SELECT hash FROM blob_links WHERE path = ?", (os.path.abspath(path),)).fetchone()
+    return row['hash'] if row else None
+
+
+def shares_filesystem(path):
+    """True if the folder of `path` is on the store's filesystem, so blobs can be hardlinked there."""
+    global _store_dev
+    if _store_dev is None:
+        os.makedirs(MEDIA_STORE_DIR, exist_ok=True)
+        _store_dev = os.stat(MEDIA_STORE_DIR).st_dev
+    folder = os.path.dirname(os.path.abspath(path))
+    dev = os.stat(folder).st_dev
+    if dev == _store_dev:
+        return True
+    if dev not in _foreign_devs:
+        _foreign_devs.add(dev)
+        print(f"Media store: {folder} is not on the filesystem of {MEDIA_STORE_DIR}, files there are not deduplicated")
+    return False
+
+
+def _reflink(src, dst):
+    """Copy-on-write clone (btrfs/xfs). Raises OSError where unsupported."""
+    import fcntl
+    FICLONE = 0x40049409
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+
+
+def place(src, dst):
+    """Materialize `src` at `dst`: hardlink, else reflink, else plain copy. Returns the method used."""
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    # rename() onto another name of the same inode is a no-op that would leave tmp behind
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return 'hardlink'
+    tmp = f"{dst}.link.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+        method = 'hardlink'
+    except (OSError, AttributeError):
+        try:
+            _reflink(src, tmp)
+            method = 'reflink'
+        except (OSError, ImportError):
+            shutil.copy2(src, tmp)
+            method = 'copy'
+    os.replace(tmp, dst)
+    return method
+
+
+def _add_link(conn, path, content_hash):
+    """Point `path` at `content_hash`, moving the reference off any previous blob."""
+    path = os.path.abspath(path)
+    row = conn.execute("SELECT hash FROM blob_links WHERE path = ?", (path,)).fetchone()
+    if row is not None and row['hash'] == content_hash:
+        return
+    if row is not None:
+        conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?", (row['hash'],))
+    conn.execute(
+        "INSERT INTO blob_links (path, hash) VALUES (?, ?) ON CONFLICT(path) DO UPDATE SET hash = excluded.hash",
+        (path, content_hash),
+    )
+    conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?", (content_hash,))
+    # A new file counts as just used for the storage manager's LRU (see storage.py)
+    conn.execute(
+        "INSERT INTO file_access (path, dir, last_access) VALUES (?, ?, ?) "
+        "ON CONFLICT(path) DO UPDATE SET last_access = excluded.last_access",
+        (path, os.path.dirname(path), time.time()),
+    )
+
+
+def _collect_garbage(conn, content_hash):
+    row = conn.execute("SELECT refcount, ext FROM blobs WHERE hash = ?", (content_hash,)).fetchone()
+    if row is not None and row['refcount'] <= 0:
+        conn.execute("DELETE FROM blobs WHERE hash = ?", (content_hash,))
+        try:
+            os.remove(blob_path(content_hash, row['ext'] or '.mp3'))
+        except OSError:
+            pass
+
+
+def ingest(file_path):
+    """
+    Move a finished file into the store (or drop it if an identical blob
+    exists) and leave a link at its original path. Returns the content hash,
+    or None if the file's folder is on another filesystem (it stays as is).
+    """
+    if not shares_filesystem(file_path):
+        return None
+    content_hash = file_hash(file_path)
+    conn = index_db.connect()
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT ext FROM blobs WHERE hash = ?", (content_hash,)).fetchone()
+        if row is not None:
+            target = blob_path(content_hash, row['ext'] or '.mp3')
+        else:
+            target = blob_path(content_hash, os.path.splitext(file_path)[1].lower() or '.mp3')
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            place(file_path, target)
+        conn.execute(
+            "INSERT OR IGNORE INTO blobs (hash, size, refcount, created_at, ext) VALUES (?, ?, 0, ?, ?)",
+            (content_hash, os.path.getsize(target), datetime.now().isoformat(), os.path.splitext(target)[1]),
+        )
+        # Swap the original file for a link to the blob (a no-op for hardlinks)
+        place(target, file_path)
+        _add_link(conn, file_path, content_hash)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return content_hash
+
+
+def link(content_hash, dst):
+    """Materialize an existing blob at `dst` and count the reference. Returns False if the blob is gone."""
+    src = blob_path(content_hash)
+    conn = index_db.connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if not os.path.exists(src):
+            conn.execute("COMMIT")
+            return False
+        place(src, dst)
+        _add_link(conn, dst, content_hash)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return True
+
+
+def unlink(path):
+    """Delete a linked file and release its reference; the blob goes when nothing points at it."""
+    path = os.path.abspath(path)
+    conn = index_db.connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT hash FROM blob_links WHERE path = ?", (path,)).fetchone()
+        if os.path.exists(path):
+            os.remove(path)
+        if row is not None:
+            conn.execute("DELETE FROM blob_links WHERE path = ?", (path,))
+            conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?", (row['hash'],))
+            _collect_garbage(conn, row['hash'])
+        conn.execute("DELETE FROM file_access WHERE path = ?", (path,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def detach(path):
+    """
+    Give `path` its own private copy before modifying it in place (e.g.
+    re-tagging), so other links to the same blob are left untouched.
+    """
+    path = os.path.abspath(path)
+    conn = index_db.connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT hash FROM blob_links WHERE path = ?", (path,)).fetchone()
+        if row is not None:
+            tmp = f"{path}.detach.tmp"
+            shutil.copy2(path, tmp)
+            os.replace(tmp, path)
+            conn.execute("DELETE FROM blob_links WHERE path = ?", (path,))
+            conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?", (row['hash'],))
+            _collect_garbage(conn, row['hash'])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
@@ -0,0 +1,193 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Process-wide counters and histograms, rendered in the Prometheus text
+# format by /metrics (and by `python -m web.api.worker --metrics-port`).
+# Track code times its phases with span(phase, ctx): the duration goes into
+# the phase histogram and into ctx['timings'], which the job sums up into
+# the per-job breakdown shown by /api/status.
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+JOB_BUCKETS = (10, 30, 60, 300, 600, 1800, 3600, 7200, 21600)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1.0, **labels):
+        key = tuple(labels.get(l, '') for l in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge:
+    """A value read at scrape time from `fn()`: a number, or {label values tuple: number}."""
+
+    def __init__(self, name, help_text, labels=(), fn=None):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.fn = fn
+        _registry.append(self)
+
+    def set_function(self, fn):
+        self.fn = fn
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.fn() if self.fn else 0
+        except Exception as e:
+            print(f"Metric {self.name} failed: {e}")
+            return lines
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for key, v in sorted(items):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(v)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}  # label values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(l, '') for l in self.labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', _format_value(bound))])} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(series[-2])}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series[-1]}")
+        return lines
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+TRACKS = Counter('offlineify_tracks_total', 'Tracks finished, by outcome.', ('status',))
+STAGE_SECONDS = Histogram('offlineify_stage_seconds', 'Time a track spends in each pipeline stage.', ('stage',))
+PHASE_SECONDS = Histogram('offlineify_phase_seconds', 'Time spent in each phase of a track (search, media download, ffmpeg, ...).', ('phase',))
+RATELIMIT_WAIT_SECONDS = Counter('offlineify_ratelimit_wait_seconds_total', 'Seconds spent waiting for an upstream rate-limit token.', ('upstream',))
+RATELIMIT_WAITS = Counter('offlineify_ratelimit_waits_total', 'Requests that had to wait for a rate-limit token.', ('upstream',))
+JOB_SECONDS = Histogram('offlineify_job_duration_seconds', 'Wall time of finished jobs.', ('status',), buckets=JOB_BUCKETS)
+ACTIVE_JOBS = Gauge('offlineify_active_jobs', 'Jobs currently running.')
+STAGE_QUEUED = Gauge('offlineify_stage_queued', 'Tracks waiting for each pipeline stage, across running jobs.', ('stage',))
+TRACK_ERRORS = Counter('offlineify_track_errors_total', 'Failed tracks, by error class.', ('error_class',))
+RETRIES = Counter('offlineify_upstream_retries_total', 'Upstream requests retried after a transient or throttling error.', ('upstream', 'error_class'))
+UPSTREAM_RATE = Gauge('offlineify_upstream_rate', 'Current adaptive request rate per upstream (requests/second).', ('upstream',))
+STORAGE_USED = Gauge('offlineify_storage_used_bytes', 'Bytes of audio in the media store.')
+STORAGE_BUDGET = Gauge('offlineify_storage_budget_bytes', 'Configured storage budget (0 = unlimited).')
+EVICTIONS = Counter('offlineify_storage_evictions_total', 'Playlist folders evicted to stay within the storage budget.')
+
+
+# ---------------------------------------------------------------------------
+# Per-track timings
+# ---------------------------------------------------------------------------
+
+_current = threading.local()
+
+
+def add_timing(ctx, kind, name, seconds):
+    """Accumulate `seconds` into ctx['timings'][kind][name] ('stages' or 'phases')."""
+    if ctx is None:
+        return
+    timings = ctx.setdefault('timings', {}).setdefault(kind, {})
+    timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def span(phase, ctx=None):
+    """Time a phase of a track: phase histogram + ctx['timings']['phases']."""
+    previous = getattr(_current, 'ctx', None)
+    _current.ctx = ctx
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        _current.ctx = previous
+        PHASE_SECONDS.observe(elapsed, phase=phase)
+        add_timing(ctx, 'phases', phase, elapsed)
+
+
+def observe_stage(ctx, stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    add_timing(ctx, 'stages', stage, seconds)
+
+
+def record_wait(upstream, seconds):
+    """Called by ratelimit.throttle; waits inside a span are also charged to that track."""
+    if seconds <= 0:
+        return
+    RATELIMIT_WAIT_SECONDS.inc(seconds, upstream=upstream)
+    RATELIMIT_WAITS.inc(upstream=upstream)
+    add_timing(getattr(_current, 'ctx', None), 'phases', f"ratelimit_wait_{upstream}", seconds)
+
+
+def merge_timings(totals, timings):
+    """Add one track's ctx['timings'] into a job's {kind: {name: [count, seconds]}}."""
+    for kind, values in (timings or {}).items():
+        bucket = totals.setdefault(kind, {})
+        for name, seconds in values.items():
+            entry = bucket.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+
+def timing_summary(totals):
+    """{kind: {name: {count, seconds, avg_ms}}} for JobState.timings."""
+    return {
+        kind: {
+            name: {"count": count, "seconds": round(seconds, 3), "avg_ms": round(1000 * seconds / count, 1) if count else 0.0}
+            for name, (count, seconds) in sorted(values.items())
+        }
+        for kind, values in totals.items()
+    }
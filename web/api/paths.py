@@ -0,0 +1,31 @@
+import os
+
+# Filesystem naming shared by the API process and queue workers.
+DOWNLOADS_ROOT = "downloads"
+
+
+def safe_user_id(user_id):
+    return "".join([c for c in user_id if c.isalnum() or c in ['@', '.', '-', '_']])
+
+
+def safe_playlist_name(name):
+    return "".join([c for c in name if c.isalpha() or c.isdigit() or c==' ']).rstrip()
+
+
+def user_output_path(user_id, output_path=DOWNLOADS_ROOT):
+    """
+    Logic:
+    1. If explicit output_path provided (and not default "downloads"), use it.
+    2. If user_id is "unknown" (local dev default), use "downloads" root.
+    3. Otherwise, use downloads/{user_id} for multi-user isolation.
+    """
+    if output_path and output_path != DOWNLOADS_ROOT:
+        return output_path
+    if safe_user_id(user_id).lower() == "unknown":
+        return DOWNLOADS_ROOT
+    return os.path.join(DOWNLOADS_ROOT, safe_user_id(user_id))
+
+
+def completed_file_path(user_id, playlist_name, filename):
+    """Path of a finished track relative to downloads/ (what /api/file expects)."""
+    return os.path.join(safe_user_id(user_id), safe_playlist_name(playlist_name), os.path.basename(filename))
@@ -0,0 +1,114 @@
+import time
+import queue
+import threading
+from . import metrics
+from . import retry
+
+# Marker pushed through a stage queue to stop one of its workers.
+_STOP = object()
+
+
+class Stage:
+    """One pipeline step: a bounded input queue drained by `workers` threads."""
+
+    def __init__(self, name, fn, workers=1, queue_size=None):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=queue_size or self.workers * 2)
+        self.threads = []
+        self.active = 0
+        self.processed = 0
+        self.lock = threading.Lock()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": self.queue.qsize(),
+                "active": self.active,
+                "workers": self.workers,
+                "processed": self.processed,
+            }
+
+
+class Pipeline:
+    """
+    Runs items through a chain of stages connected by bounded queues.
+
+    Every stage function takes a context dict and returns it. As soon as a
+    stage sets ctx['result'], the item leaves the pipeline and `on_result`
+    is called with it (skips and errors don't visit later stages).
+    Because the queues are bounded, a slow stage back-pressures the ones
+    before it instead of letting work pile up in memory.
+    """
+
+    def __init__(self, stages, on_result):
+        self.stages = stages
+        self.on_result = on_result
+        self.cancelled = threading.Event()
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                t = threading.Thread(target=self._run_stage, args=(index,), name=f"{stage.name}-{i}", daemon=True)
+                t.start()
+                stage.threads.append(t)
+        return self
+
+    def submit(self, ctx):
+        """Feed one item into the first stage (blocks while that queue is full)."""
+        self.stages[0].queue.put(ctx)
+
+    def cancel(self):
+        """Drop everything still queued; items already inside a stage finish that stage only."""
+        self.cancelled.set()
+
+    def close(self):
+        """Wait for all submitted items to drain, then stop the workers stage by stage."""
+        for stage in self.stages:
+            for _ in stage.threads:
+                stage.queue.put(_STOP)
+            for t in stage.threads:
+                t.join()
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def _run_stage(self, index):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+
+        while True:
+            ctx = stage.queue.get()
+            if ctx is _STOP:
+                return
+            if self.cancelled.is_set():
+                continue
+
+            with stage.lock:
+                stage.active += 1
+            started = time.thread_time()
+            wall_started = time.perf_counter()
+            try:
+                ctx = stage.fn(ctx)
+            except Exception as e:
+                # Keeps the error class retry.call attached (throttled, not_found...)
+                ctx['result'] = retry.error_result(e)
+            finally:
+                # CPU used by this worker thread; stages add their subprocesses' share themselves
+                ctx['cpu_seconds'] = ctx.get('cpu_seconds', 0.0) + time.thread_time() - started
+                metrics.observe_stage(ctx, stage.name, time.perf_counter() - wall_started)
+                with stage.lock:
+                    stage.active -= 1
+                    stage.processed += 1
+
+            if ctx.get('result') is None and next_stage is None:
+                ctx['result'] = {"status": "error", "message": "Pipeline produced no result"}
+
+            if ctx.get('result') is not None:
+                try:
+                    self.on_result(ctx)
+                except Exception as e:
+                    print(f"Pipeline result handler error: {e}")
+            elif not self.cancelled.is_set():
+                next_stage.queue.put(ctx)
@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+# Opt-in sampling profiler for a single job (DownloadRequest.profile, or
+# `python -m web.api.worker --profile`). A background thread snapshots the
+# stacks of the job's threads every PROFILE_INTERVAL seconds and counts them;
+# the result is written in the "folded" format that flamegraph.pl and
+# speedscope read. Sampling keeps the overhead low enough for real jobs.
+PROFILE_DIR = os.environ.get('OFFLINEIFY_PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL = float(os.environ.get('OFFLINEIFY_PROFILE_INTERVAL', '0.01'))
+MAX_DEPTH = 64
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class StackSampler:
+    """Samples the threads whose idents `thread_ids()` returns (all but itself when None)."""
+
+    def __init__(self, thread_ids=None, interval=PROFILE_INTERVAL):
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.started = None
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        return self
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            wanted = self.thread_ids() if self.thread_ids else None
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or (wanted is not None and ident not in wanted):
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_DEPTH:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                # Group by thread role ("fetch-3" -> "fetch") so workers of a stage add up
+                role = names.get(ident, str(ident)).rsplit('-', 1)[0]
+                self.stacks[';'.join([role] + stack[::-1])] += 1
+            self.samples += 1
+
+    def write(self, path):
+        """Write folded stacks ("a;b;c count" per line). Returns the path."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+def profile_path(name):
+    return os.path.join(PROFILE_DIR, f"{name}.folded")
@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+from . import metrics
+
+# Process-wide request budgets, one bucket per upstream.
+# rate = tokens refilled per second, burst = bucket capacity.
+# Defaults roughly match the old "3-8s sleep per track" pace for search,
+# but let several tracks be in flight at once.
+DEFAULT_BUDGETS = {
+    'search': (float(os.environ.get('OFFLINEIFY_SEARCH_RATE', '1.0')), float(os.environ.get('OFFLINEIFY_SEARCH_BURST', '3'))),
+    'media': (float(os.environ.get('OFFLINEIFY_MEDIA_RATE', '0.5')), float(os.environ.get('OFFLINEIFY_MEDIA_BURST', '2'))),
+    'cover': (float(os.environ.get('OFFLINEIFY_COVER_RATE', '5.0')), float(os.environ.get('OFFLINEIFY_COVER_BURST', '10'))),
+}
+
+# AIMD: every successful request raises an upstream's rate by RATE_STEP x its
+# configured rate (up to RATE_CEILING x), every throttling signal (HTTP 429,
+# bot check) halves it (down to RATE_FLOOR x) and pauses the bucket for
+# THROTTLE_COOLDOWN seconds. The configured rates are the starting point.
+ADAPTIVE_RATE = os.environ.get('OFFLINEIFY_ADAPTIVE_RATE', '1') != '0'
+RATE_CEILING = float(os.environ.get('OFFLINEIFY_RATE_CEILING', '4'))
+RATE_FLOOR = float(os.environ.get('OFFLINEIFY_RATE_FLOOR', '0.125'))
+RATE_STEP = 0.05
+RATE_DECREASE = 0.5
+THROTTLE_COOLDOWN = float(os.environ.get('OFFLINEIFY_THROTTLE_COOLDOWN', '30'))
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. acquire() blocks until a token is available.
+    on_success() / on_throttled() adapt the rate (see ADAPTIVE_RATE).
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.base_rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1.0):
+        """
+        Take `tokens` from the bucket, sleeping until they are available.
+        Returns the number of seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                paused = self.paused_until - time.monotonic()
+                if paused > 0:
+                    delay = paused
+                elif self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                else:
+                    delay = (tokens - self.tokens) / self.rate if self.rate > 0 else 1.0
+
+            time.sleep(delay)
+            waited += delay
+
+    def on_success(self):
+        """Additive increase after a request went through."""
+        if not ADAPTIVE_RATE:
+            return
+        with self.lock:
+            self._refill()
+            self.rate = min(self.base_rate * RATE_CEILING, self.rate + self.base_rate * RATE_STEP)
+
+    def on_throttled(self, cooldown=THROTTLE_COOLDOWN):
+        """Multiplicative decrease, and no requests at all for `cooldown` seconds."""
+        with self.lock:
+            self._refill()
+            self.throttled += 1
+            now = time.monotonic()
+            # Requests already in flight fail together: one decrease per cooldown window
+            if ADAPTIVE_RATE and now >= self.paused_until:
+                self.rate = max(self.base_rate * RATE_FLOOR, self.rate * RATE_DECREASE)
+            self.tokens = 0.0
+            self.paused_until = max(self.paused_until, now + cooldown)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "rate": round(self.rate, 3),
+                "base_rate": self.base_rate,
+                "throttled": self.throttled,
+                "paused_seconds": round(max(0.0, self.paused_until - time.monotonic()), 1),
+            }
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_limiter(name):
+    """Return the shared bucket for an upstream ('search', 'media', 'cover')."""
+    with _buckets_lock:
+        if name not in _buckets:
+            rate, burst = DEFAULT_BUDGETS.get(name, (1.0, 1.0))
+            _buckets[name] = TokenBucket(rate, burst)
+        return _buckets[name]
+
+
+def throttle(name, tokens=1.0):
+    """Convenience wrapper: block on the named upstream's budget."""
+    waited = get_limiter(name).acquire(tokens)
+    metrics.record_wait(name, waited)
+    return waited
+
+
+def report_success(name):
+    get_limiter(name).on_success()
+
+
+def report_throttled(name):
+    print(f"Upstream '{name}' is throttling us, backing off")
+    get_limiter(name).on_throttled()
+
+
+def stats():
+    """Current (adapted) rate per upstream."""
+    with _buckets_lock:
+        buckets = dict(_buckets)
+    return {name: bucket.stats() for name, bucket in buckets.items()}
+
+
+metrics.UPSTREAM_RATE.set_function(lambda: {(name,): s['rate'] for name, s in stats().items()})
@@ -0,0 +1,95 @@
+import os
+import time
+import random
+from . import metrics
+from .ratelimit import report_success, report_throttled, throttle
+
+# Upstream calls (searches, media downloads, cover fetches) go through call():
+# it takes a rate-limit token, classifies any failure, retries transient and
+# throttling errors with jittered exponential backoff, and feeds the outcome
+# back into the upstream's adaptive rate (see ratelimit.py).
+#
+# Error classes, also reported as `error_class` on failed tracks:
+TRANSIENT = 'transient'      # timeouts, dropped connections, 5xx: retried
+THROTTLED = 'throttled'      # HTTP 429, bot checks: retried after the upstream slows down
+NOT_FOUND = 'not_found'      # unavailable/removed videos, 404, no search results: final
+POSTPROCESS = 'postprocess'  # ffmpeg / conversion failures: final
+FAILED = 'failed'            # anything else: final
+
+RETRY_ATTEMPTS = int(os.environ.get('OFFLINEIFY_RETRY_ATTEMPTS', '4'))
+RETRY_BASE = float(os.environ.get('OFFLINEIFY_RETRY_BASE', '2'))
+RETRY_MAX = float(os.environ.get('OFFLINEIFY_RETRY_MAX', '60'))
+RETRYABLE = (TRANSIENT, THROTTLED)
+
+# Lower-cased substrings of the error message (yt-dlp wraps everything in DownloadError)
+_PATTERNS = [
+    (THROTTLED, ('http error 429', '429 client error', 'too many requests', 'not a bot', 'rate limit', 'rate-limit', 'captcha', 'unusual traffic')),
+    (NOT_FOUND, ('video unavailable', 'private video', 'has been removed', 'is not available', 'no video formats',
+                 'http error 404', '404 client error', 'does not exist', 'no results found', 'has been terminated')),
+    (POSTPROCESS, ('ffmpeg', 'postprocess', 'conversion failed')),
+    (TRANSIENT, ('timed out', 'timeout', 'connection reset', 'connection aborted', 'connection refused',
+                 'temporary failure in name resolution', 'name or service not known', 'remote end closed',
+                 'incompleteread', 'incomplete read', 'http error 5', 'server error', 'unable to download webpage',
+                 'unable to download video data', 'errno 104')),
+]
+_TRANSIENT_TYPES = ('Timeout', 'ConnectionError', 'IncompleteRead', 'ProtocolError', 'RemoteDisconnected')
+
+
+def classify_error(exc):
+    """One of the error classes above for an exception (or an error message string)."""
+    known = getattr(exc, 'error_class', None)
+    if known:
+        return known
+    message = str(exc).lower()
+    for error_class, needles in _PATTERNS:
+        if any(n in message for n in needles):
+            return error_class
+    # Fall back on the exception types in the chain (yt-dlp keeps the original in exc_info)
+    seen = 0
+    while isinstance(exc, BaseException) and seen < 5:
+        if isinstance(exc, (TimeoutError, ConnectionError)) or any(t in type(exc).__name__ for t in _TRANSIENT_TYPES):
+            return TRANSIENT
+        exc_info = getattr(exc, 'exc_info', None)
+        exc = exc_info[1] if exc_info else (exc.__cause__ or exc.__context__)
+        seen += 1
+    return FAILED
+
+
+def backoff_delay(attempt, error_class=TRANSIENT):
+    """Full jitter: uniform in [0, min(RETRY_MAX, base * 2^attempt)]; throttling starts from a longer base."""
+    base = RETRY_BASE * (4 if error_class == THROTTLED else 1)
+    return random.uniform(0, min(RETRY_MAX, base * 2 ** attempt))
+
+
+def error_result(exc):
+    return {"status": "error", "message": str(exc), "error_class": classify_error(exc)}
+
+
+def call(upstream, fn, attempts=None):
+    """
+    Run `fn()` against `upstream` ('search', 'media', 'cover') under its rate
+    limit. Transient and throttling errors are retried up to `attempts` times;
+    the error that finally escapes carries its class in `error_class`.
+    """
+    attempts = max(1, attempts or RETRY_ATTEMPTS)
+    for attempt in range(attempts):
+        throttle(upstream)
+        try:
+            result = fn()
+        except Exception as e:
+            error_class = classify_error(e)
+            if error_class == THROTTLED:
+                report_throttled(upstream)
+            if error_class not in RETRYABLE or attempt == attempts - 1:
+                try:
+                    e.error_class = error_class
+                except Exception:
+                    pass
+                raise
+            delay = backoff_delay(attempt, error_class)
+            metrics.RETRIES.inc(upstream=upstream, error_class=error_class)
+            print(f"{upstream} request failed ({error_class}), retry {attempt + 1}/{attempts - 1} in {delay:.1f}s: {e}")
+            time.sleep(delay)
+            continue
+        report_success(upstream)
+        return result
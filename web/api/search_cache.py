@@ -0,0 +1,165 @@
+import os
+import re
+import json
+import time
+import threading
+import unicodedata
+from .index_db import ensure_columns, open_connection
+
+# Persistent cache of YouTube search results and the candidate Smart Selection
+# picked, so re-running a playlist (or retrying a failed track) skips search.
+# Entries expire after SEARCH_CACHE_TTL seconds; beyond SEARCH_CACHE_MAX rows
+# the least recently used ones are evicted.
+# Rows remember the ISRC of the track they were picked for: the artist/title
+# key never hands a selection to a track with a different ISRC (a remaster,
+# live or radio edit with the same title), as in identity.find_recording.
+SEARCH_CACHE_DB = os.environ.get('OFFLINEIFY_SEARCH_CACHE_DB', 'search_cache.db')
+SEARCH_CACHE_TTL = int(os.environ.get('OFFLINEIFY_SEARCH_CACHE_TTL', str(30 * 24 * 3600)))
+SEARCH_CACHE_MAX = int(os.environ.get('OFFLINEIFY_SEARCH_CACHE_MAX', '50000'))
+
+# Eviction runs every N writes rather than on every put
+_EVICT_EVERY = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_cache (
+    key TEXT PRIMARY KEY,
+    candidates TEXT,
+    selected_url TEXT,
+    thumbnail TEXT,
+    created_at REAL,
+    last_used REAL
+);
+CREATE INDEX IF NOT EXISTS idx_search_cache_last_used ON search_cache(last_used);
+"""
+
+# Columns added after the first release (existing cache DBs get them via ALTER TABLE)
+ADDED_COLUMNS = [
+    ('search_cache', 'isrc', 'TEXT'),
+]
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+_writes = 0
+_writes_lock = threading.Lock()
+
+
+def _conn():
+    global _schema_ready
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = open_connection(SEARCH_CACHE_DB)
+        with _schema_lock:
+            if not _schema_ready:
+                conn.executescript(SCHEMA)
+                ensure_columns(conn, ADDED_COLUMNS)
+                _schema_ready = True
+    return conn
+
+
+def normalize(text):
+    """Lowercase, strip accents/punctuation and collapse whitespace."""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(text.split())
+
+
+def _isrc(track):
+    return (track.get('isrc') or '').strip().upper() or None
+
+
+def cache_keys(track):
+    """ISRC key first (most specific), then normalized artist/title."""
+    keys = []
+    if _isrc(track):
+        keys.append(f"isrc:{_isrc(track)}")
+    keys.append(f"title:{normalize(track.get('artist'))}|{normalize(track.get('name'))}")
+    return keys
+
+
+def candidate_summary(entry):
+    """The handful of fields selection needs; full yt-dlp info dicts are huge."""
+    thumbnail = entry.get('thumbnail')
+    if not thumbnail and entry.get('thumbnails'):
+        thumbnail = entry['thumbnails'][-1].get('url')
+    url = entry.get('webpage_url') or entry.get('url')
+    if not url and entry.get('id'):
+        url = f"https://www.youtube.com/watch?v={entry['id']}"
+    return {
+        'id': entry.get('id'),
+        'webpage_url': url,
+        'title': entry.get('title'),
+        'duration': entry.get('duration') or 0,
+        'channel': entry.get('channel') or entry.get('uploader'),
+        'thumbnail': thumbnail,
+    }
+
+
+def get(track):
+    """Return the cached {'candidates', 'selected_url', 'thumbnail'} for a track, or None."""
+    now = time.time()
+    isrc = _isrc(track)
+    conn = _conn()
+    for key in cache_keys(track):
+        row = conn.execute(
+            "SELECT candidates, selected_url, thumbnail, created_at, isrc FROM search_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            continue
+        if isrc and row['isrc'] and row['isrc'] != isrc:
+            continue  # Same title, different recording
+        if now - row['created_at'] > SEARCH_CACHE_TTL:
+            conn.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+            continue
+        conn.execute("UPDATE search_cache SET last_used = ? WHERE key = ?", (now, key))
+        return {
+            'candidates': json.loads(row['candidates'] or '[]'),
+            'selected_url': row['selected_url'],
+            'thumbnail': row['thumbnail'],
+        }
+    return None
+
+
+def put(track, candidates, selected_url, thumbnail=None):
+    global _writes
+    now = time.time()
+    payload = json.dumps([candidate_summary(c) for c in candidates])
+    conn = _conn()
+    for key in cache_keys(track):
+        conn.execute(
+            "INSERT INTO search_cache (key, candidates, selected_url, thumbnail, created_at, last_used, isrc) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+            "candidates = excluded.candidates, selected_url = excluded.selected_url, "
+            "thumbnail = excluded.thumbnail, created_at = excluded.created_at, last_used = excluded.last_used, "
+            "isrc = excluded.isrc",
+            (key, payload, selected_url, thumbnail, now, now, _isrc(track)),
+        )
+
+    with _writes_lock:
+        _writes += 1
+        run_eviction = _writes % _EVICT_EVERY == 0
+    if run_eviction:
+        evict()
+
+
+def invalidate(track):
+    """Forget a track's cached selection (e.g. the chosen video turned out to be unavailable)."""
+    isrc = _isrc(track)
+    conn = _conn()
+    for key in cache_keys(track):
+        # Leave a title row picked for another recording alone
+        conn.execute("DELETE FROM search_cache WHERE key = ? AND (? IS NULL OR isrc IS NULL OR isrc = ?)", (key, isrc, isrc))
+
+
+def evict():
+    """Drop expired rows, then least recently used rows beyond SEARCH_CACHE_MAX."""
+    conn = _conn()
+    conn.execute("DELETE FROM search_cache WHERE created_at < ?", (time.time() - SEARCH_CACHE_TTL,))
+    count = conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+    if count > SEARCH_CACHE_MAX:
+        conn.execute(
+            "DELETE FROM search_cache WHERE key IN "
+            "(SELECT key FROM search_cache ORDER BY last_used ASC LIMIT ?)",
+            (count - SEARCH_CACHE_MAX,),
+        )
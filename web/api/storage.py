@@ -0,0 +1,186 @@
+import os
+import glob
+import time
+import threading
+from . import index_db
+from . import library
+from . import media_store
+from . import metrics
+from .paths import DOWNLOADS_ROOT
+
+# Disk budget for downloads/. Every finished track lives once in the media
+# store, so the bytes in use are the sum of blob sizes, a cheap query instead
+# of a directory walk. Each linked file has a last-access time (set when it is
+# linked, bumped when /api/file or /api/zip serves it); over budget, the
+# least recently used playlist folders are evicted as a whole until usage is
+# back under LOW_WATERMARK of the budget. Jobs whose estimated size can't fit
+# even after eviction are refused up front (admit()).
+#
+# OFFLINEIFY_STORAGE_BUDGET takes bytes or a size like "50G"; 0 disables
+# eviction and admission control (stale zips are still cleaned up).
+STORAGE_INTERVAL = float(os.environ.get('OFFLINEIFY_STORAGE_INTERVAL', '300'))
+# Folders used more recently than this are never evicted (running jobs, fresh downloads)
+EVICT_MIN_IDLE = float(os.environ.get('OFFLINEIFY_EVICT_MIN_IDLE', '3600'))
+LOW_WATERMARK = 0.9
+# Archives left behind by the old /api/zip (before zips were streamed)
+STALE_ZIP_PATTERN = os.path.join(DOWNLOADS_ROOT, 'offlineify_*.zip')
+STALE_ZIP_AGE = 3600
+# Size assumed per new track until the store has its own average (~3.5 min at 320 kbit/s)
+DEFAULT_TRACK_BYTES = 8 * 1024 * 1024
+
+_UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_size(text):
+    """'50G', '500M', '1024' -> bytes."""
+    text = (text or '0').strip().lower().rstrip('b')
+    if text and text[-1] in _UNITS:
+        return int(float(text[:-1]) * _UNITS[text[-1]])
+    return int(float(text))
+
+
+STORAGE_BUDGET = parse_size(os.environ.get('OFFLINEIFY_STORAGE_BUDGET', '0'))
+
+_evict_lock = threading.Lock()
+_manager = None
+
+
+def used_bytes():
+    return index_db.connect().execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+
+def avg_track_bytes():
+    avg = index_db.connect().execute("SELECT AVG(size) FROM blobs").fetchone()[0]
+    return int(avg) if avg else DEFAULT_TRACK_BYTES
+
+
+def touch(path):
+    """Record that a file was just served."""
+    index_db.connect().execute(
+        "UPDATE file_access SET last_access = ? WHERE path = ?", (time.time(), os.path.abspath(path))
+    )
+
+
+def touch_dir(directory):
+    """Record that everything under `directory` was just served (a ZIP of it)."""
+    directory = os.path.abspath(directory)
+    index_db.connect().execute(
+        "UPDATE file_access SET last_access = ? WHERE dir = ? OR dir LIKE ? ESCAPE '\\'",
+        (time.time(), directory, index_db.like_prefix(directory)),
+    )
+
+
+def cleanup_stale_zips():
+    """Delete leftover offlineify_*.zip archives. Returns the bytes freed."""
+    freed = 0
+    cutoff = time.time() - STALE_ZIP_AGE
+    for path in glob.glob(STALE_ZIP_PATTERN):
+        try:
+            st = os.stat(path)
+            if st.st_mtime < cutoff:
+                os.remove(path)
+                freed += st.st_size
+        except OSError:
+            pass
+    if freed:
+        print(f"Removed stale zips: {freed // (1024 * 1024)} MB")
+    return freed
+
+
+def evict_dir(directory):
+    """Remove a playlist folder: its linked tracks (blobs go with their last link), M3U8 and the folder if empty."""
+    rows = index_db.connect().execute("SELECT path FROM file_access WHERE dir = ?", (directory,)).fetchall()
+    for row in rows:
+        try:
+            media_store.unlink(row['path'])
+        except Exception as e:
+            print(f"Evict error {row['path']}: {e}")
+    for playlist_file in glob.glob(os.path.join(glob.escape(directory), '*.m3u8')):
+        try:
+            os.remove(playlist_file)
+        except OSError:
+            pass
+    try:
+        os.rmdir(directory)
+    except OSError:
+        pass  # Something we don't track is still in there
+    library.forget(directory)
+    metrics.EVICTIONS.inc()
+    print(f"Evicted {directory} ({len(rows)} files)")
+
+
+def evict(target_bytes):
+    """Evict least recently used folders until the store is at or under `target_bytes`. Returns bytes in use."""
+    with _evict_lock:
+        used = used_bytes()
+        cutoff = time.time() - EVICT_MIN_IDLE
+        while used > target_bytes:
+            row = index_db.connect().execute(
+                "SELECT dir, MAX(last_access) AS last FROM file_access GROUP BY dir HAVING last < ? ORDER BY last LIMIT 1",
+                (cutoff,),
+            ).fetchone()
+            if row is None:
+                break  # Everything left is in use
+            evict_dir(row['dir'])
+            used = used_bytes()
+        return used
+
+
+def enforce():
+    """One pass of the storage manager."""
+    cleanup_stale_zips()
+    if STORAGE_BUDGET and used_bytes() > STORAGE_BUDGET:
+        used = evict(int(STORAGE_BUDGET * LOW_WATERMARK))
+        if used > STORAGE_BUDGET:
+            print(f"Storage over budget: {used // (1024 * 1024)} MB used, nothing left to evict")
+
+
+def estimate_job_bytes(tracks):
+    """Bytes a job will add: tracks whose audio isn't in the store yet, at the store's average size."""
+    entries = index_db.get_tracks([t.get('uri') for t in tracks])
+    new = sum(1 for t in tracks if not media_store.has_blob((entries.get(t.get('uri')) or {}).get('content_hash')))
+    return new * avg_track_bytes()
+
+
+def admit(tracks=None):
+    """
+    Admission control for a new job. Returns None if it fits (evicting old
+    folders if needed), else a message explaining why it was refused.
+    `tracks` is None when the size isn't known up front (CSV uploads).
+    """
+    if not STORAGE_BUDGET:
+        return None
+    needed = estimate_job_bytes(tracks) if tracks else 0
+    if used_bytes() + needed <= STORAGE_BUDGET:
+        return None
+    used = evict(max(0, STORAGE_BUDGET - needed))
+    if used + needed <= STORAGE_BUDGET:
+        return None
+    return (f"Not enough storage: job needs ~{needed // (1024 * 1024)} MB, "
+            f"{max(0, STORAGE_BUDGET - used) // (1024 * 1024)} MB of the budget is free")
+
+
+def _run():
+    while True:
+        try:
+            enforce()
+        except Exception as e:
+            print(f"Storage manager error: {e}")
+        time.sleep(STORAGE_INTERVAL)
+
+
+def start_manager():
+    """Start the background storage manager (once per process)."""
+    global _manager
+    if _manager is None:
+        _manager = threading.Thread(target=_run, name="storage", daemon=True)
+        _manager.start()
+    return _manager
+
+
+def stats():
+    return {"budget_bytes": STORAGE_BUDGET, "used_bytes": used_bytes()}
+
+
+metrics.STORAGE_USED.set_function(used_bytes)
+metrics.STORAGE_BUDGET.set_function(lambda: STORAGE_BUDGET)
@@ -0,0 +1,86 @@
+import os
+from . import index_db
+from . import library
+from . import media_store
+from .m3u import write_m3u
+from .paths import safe_playlist_name, user_output_path
+
+# Incremental playlist sync: before a re-submitted playlist is queued, diff it
+# against the download index and its folder. Tracks whose file is already
+# there (or can be linked from the media store) are settled up front, so only
+# new tracks reach the pipeline, and the M3U8 is rewritten in the submitted
+# order straight away. Everything here is local: no search, no downloads.
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.opus', '.ogg', '.flac')
+
+
+def diff_playlist(playlist_dir, tracks):
+    """
+    Compare one playlist with what's on disk.
+    tracks: [track dict]. Returns (present, stale):
+    present maps track_index -> filename for tracks already in the folder,
+    stale lists audio files in the folder that no submitted track points at
+    (removed from the playlist since the last sync).
+    """
+    entries = index_db.get_tracks([t.get('uri') for t in tracks])
+    present = {}
+    for track_index, track in enumerate(tracks):
+        entry = entries.get(track.get('uri'))
+        if not entry or not entry.get('filename'):
+            continue
+        filename = entry['filename']
+        path = os.path.join(playlist_dir, filename)
+        if os.path.exists(path):
+            present[track_index] = filename
+        elif media_store.has_blob(entry.get('content_hash')) and media_store.link(entry['content_hash'], path):
+            present[track_index] = filename
+
+    keep = set(present.values())
+    stale = []
+    if os.path.isdir(playlist_dir):
+        for name in sorted(os.listdir(playlist_dir)):
+            if name.lower().endswith(AUDIO_EXTENSIONS) and name not in keep:
+                stale.append(name)
+    return present, stale
+
+
+def sync_playlists(user_id, output_path, playlists, prune=False):
+    """
+    Diff every playlist ({"name", "tracks"}) of a job before it is queued.
+    Rewrites each M3U8 with the tracks already present, in submitted order,
+    and with prune=True deletes the files of tracks no longer in the playlist.
+    Returns {(playlist_index, track_index): filename} for jobqueue.enqueue_job(done=...).
+    """
+    base_output_path = user_output_path(user_id, output_path)
+    done = {}
+    for playlist_index, playlist in enumerate(playlists):
+        playlist_dir = os.path.join(base_output_path, safe_playlist_name(playlist['name']))
+        present, stale = diff_playlist(playlist_dir, playlist['tracks'])
+        for track_index, filename in present.items():
+            done[(playlist_index, track_index)] = filename
+
+        if prune:
+            for name in stale:
+                try:
+                    media_store.unlink(os.path.join(playlist_dir, name))
+                    library.forget(os.path.join(playlist_dir, name))
+                except Exception as e:
+                    print(f"Sync prune error {name}: {e}")
+        # Positions may have changed (reorders)
+        library.record_tracks(user_id, [
+            (playlist['name'], track_index, playlist['tracks'][track_index], filename, os.path.join(playlist_dir, filename))
+            for track_index, filename in present.items()
+        ])
+
+        if present or stale:
+            try:
+                write_m3u(playlist_dir, playlist['name'], [
+                    (track.get('artist'), track.get('name'), present.get(track_index))
+                    for track_index, track in enumerate(playlist['tracks'])
+                ])
+            except Exception as e:
+                print(f"Error creating m3u: {e}")
+
+        missing = len(playlist['tracks']) - len(present)
+        action = "removed" if prune else "no longer in playlist"
+        print(f"Sync {playlist['name']}: {len(present)} present, {missing} to download, {len(stale)} {action}")
+    return done
@@ -0,0 +1,206 @@
+# Queue worker for OFFLINEIFY_QUEUE_MODE=external.
+#
+#     python -m web.api.worker --concurrency 4
+#
+# Each process runs `concurrency` threads that claim track tasks from the
+# persistent queue (jobqueue.py) and download them. Start more processes to
+# add throughput, on the API's host only: the queue and index DBs are SQLite
+# in WAL mode, which doesn't work over network filesystems.
+import os
+import socket
+import signal
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import jobqueue
+from . import library
+from . import metrics
+from . import retry
+from . import ydl_pool
+from .downloader import job_ydl_opts, process_track, warm_up
+from .m3u import M3U_FLUSH_SECONDS, write_m3u
+from .paths import completed_file_path, user_output_path
+from .profiler import StackSampler, profile_path
+
+POLL_INTERVAL = 2.0
+# Serve /metrics for this process on this port (0 = off); the API's /metrics
+# only sees its own process in external mode.
+METRICS_PORT = int(os.environ.get("OFFLINEIFY_WORKER_METRICS_PORT", "0"))
+
+# (job_id, playlist_index) -> last M3U8 write in this process
+_m3u_flushed = {}
+# job_id -> tasks of that job being processed by this process
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+metrics.ACTIVE_JOBS.set_function(lambda: len(_in_flight))
+# Striped by URI: a track listed twice in a job is never processed by two
+# threads of this process at once (they would share an outtmpl and ffmpeg
+# target); the second copy then resolves to the first one's file.
+_track_locks = [threading.Lock() for _ in range(64)]
+
+
+def handle_task(task):
+    user_id = task['user_id']
+    track = task['track']
+
+    if task['cancel_requested']:
+        result = {"status": "cancelled", "message": "Job cancelled"}
+    else:
+        jobqueue.add_event(user_id, "progress", {
+            "status": "working",
+            "current_track": f"[{task['playlist_name']}] {track.get('name')}",
+        })
+        base_output_path = user_output_path(user_id, task['output_path'])
+        opts = job_ydl_opts(base_output_path, task['quality'])
+        opts['outtmpl'] = f"{task['playlist_dir']}/%(artist)s - %(title)s.%(ext)s"
+        opts['output_dir'] = task['playlist_dir']
+        os.makedirs(task['playlist_dir'], exist_ok=True)
+        with _track_locks[hash(track.get('uri')) % len(_track_locks)]:
+            result = process_track(track, opts)
+
+    if result['status'] == 'success':
+        msg = f"Reused: {track.get('name')}" if result.get('reused_from') else f"Downloaded: {track.get('name')}"
+    elif result['status'] == 'skipped':
+        msg = f"Skipped: {track.get('name')}"
+    elif result['status'] == 'cancelled':
+        msg = None
+    else:
+        result.setdefault('error_class', retry.classify_error(result.get('message') or ''))
+        msg = f"Error {track.get('name')} ({result['error_class']}): {result.get('message')}"
+        metrics.TRACK_ERRORS.inc(error_class=result['error_class'])
+
+    metrics.TRACKS.inc(status=result['status'])
+    playlist_done = jobqueue.complete_task(task['id'], result)
+    if msg:
+        print(msg)
+        jobqueue.add_event(user_id, "log", msg)
+    if result.get('filename'):
+        try:
+            library.record_track(user_id, task['playlist_name'], task['track_index'], track, result['filename'],
+                                 os.path.join(task['playlist_dir'], result['filename']))
+        except Exception as e:
+            print(f"Library error: {e}")
+        jobqueue.add_event(user_id, "file", {
+            "name": track.get('name'),
+            "path": completed_file_path(user_id, task['playlist_name'], result['filename']),
+        })
+
+    # Keep the M3U8 current while the playlist is in progress; final write when its last track is in
+    playlist_key = (task['job_id'], task['playlist_index'])
+    flush_due = result.get('filename') and time.monotonic() - _m3u_flushed.get(playlist_key, 0.0) >= M3U_FLUSH_SECONDS
+    if playlist_done or flush_due:
+        _m3u_flushed[playlist_key] = time.monotonic()
+        try:
+            playlist_file = write_m3u(task['playlist_dir'], task['playlist_name'],
+                                      jobqueue.playlist_entries(task['job_id'], task['playlist_index']))
+            if playlist_file and playlist_done:
+                jobqueue.add_event(user_id, "log", f"Created Playlist: {playlist_file}")
+        except Exception as e:
+            print(f"Error creating m3u: {e}")
+        if playlist_done:
+            _m3u_flushed.pop(playlist_key, None)
+
+    final_status = jobqueue.finalize_job(task['job_id'])
+    job = jobqueue.get_job(task['job_id'])
+    counts = jobqueue.job_counts(task['job_id'])
+    jobqueue.add_event(user_id, "progress", {
+        "status": final_status or "working",
+        "total": job['total'] if job else None,
+        "completed": sum(counts.get(s, 0) for s in ('success', 'skipped', 'error')),
+        "current_track": "",
+    })
+    if final_status:
+        print(f"Job {task['job_id']} for user {user_id} finished: {final_status}")
+
+
+def worker_loop(worker_id, stop):
+    while not stop.is_set():
+        try:
+            task = jobqueue.claim_task(worker_id)
+        except Exception as e:
+            print(f"[{worker_id}] Queue error: {e}")
+            stop.wait(POLL_INTERVAL)
+            continue
+        if task is None:
+            stop.wait(POLL_INTERVAL)
+            continue
+        with _in_flight_lock:
+            _in_flight[task['job_id']] = _in_flight.get(task['job_id'], 0) + 1
+        try:
+            handle_task(task)
+        except Exception as e:
+            print(f"[{worker_id}] Task {task['id']} failed: {e}")
+            jobqueue.complete_task(task['id'], retry.error_result(e))
+        finally:
+            with _in_flight_lock:
+                _in_flight[task['job_id']] -= 1
+                if not _in_flight[task['job_id']]:
+                    del _in_flight[task['job_id']]
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would drown the task log
+
+
+def serve_metrics(port):
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Metrics on http://0.0.0.0:{port}/metrics")
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offlineify queue worker")
+    parser.add_argument("--concurrency", type=int, default=int(os.environ.get("OFFLINEIFY_JOB_WORKERS", "4")),
+                        help="tracks processed in parallel by this process")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="serve Prometheus metrics for this process on this port (0 = off)")
+    parser.add_argument("--profile", action="store_true",
+                        help="sample the worker threads and write a profile on exit (see profiler.py)")
+    args = parser.parse_args()
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print("Stopping after in-flight tracks finish...")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    # Imports, cookies, extractors and ffmpeg loaded before the first task is claimed
+    warm_up(args.concurrency)
+
+    base_id = f"{socket.gethostname()}:{os.getpid()}"
+    threads = [threading.Thread(target=worker_loop, args=(f"{base_id}:{i}", stop), daemon=True)
+               for i in range(max(1, args.concurrency))]
+    print(f"Worker {base_id} started with {len(threads)} threads (queue: {jobqueue.QUEUE_DB})")
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    sampler = StackSampler(lambda: {t.ident for t in threads}).start() if args.profile else None
+    for t in threads:
+        t.start()
+    while any(t.is_alive() for t in threads):
+        for t in threads:
+            t.join(timeout=1.0)
+    print(f"YoutubeDL pool: {ydl_pool.stats()}")
+    if sampler is not None:
+        path = sampler.stop().write(profile_path(f"worker-{os.getpid()}"))
+        print(f"Profile written: {path} ({sampler.samples} samples)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Pool of warm YoutubeDL instances shared by every job in the process.
+# Building a YoutubeDL is expensive with cookiesfrombrowser set: Chrome's
+# cookie database is decrypted and loaded, extractors are instantiated and a
+# new HTTP session is opened. Pooled instances keep all of that between
+# tracks; only per-track options (output template, flat extraction) are
+# swapped in when an instance is checked out, and restored on check-in.
+#
+# A YoutubeDL isn't thread safe, so an instance is used by one worker at a
+# time. Instances are keyed by the rest of their options (cookies, format,
+# verbosity...), so jobs with different settings never share one.
+YDL_POOL_ENABLED = os.environ.get('OFFLINEIFY_YDL_POOL', '1') != '0'
+YDL_POOL_SIZE = int(os.environ.get('OFFLINEIFY_YDL_POOL_SIZE', '16'))
+
+# Applied per checkout, never part of the pool key. output_dir and
+# output_format are our own keys, postprocessors are handled by transcode_stage.
+PER_CALL_OPTIONS = ('outtmpl', 'extract_flat')
+IGNORED_OPTIONS = ('output_dir', 'output_format', 'postprocessors')
+
+# Builds the instances; swapped for a fake extractor by the offline benchmark (bench.py).
+# None means yt_dlp.YoutubeDL, imported on first use: yt-dlp loads hundreds of
+# extractor modules, which processes that never download shouldn't pay for.
+_factory = None
+
+_idle = {}  # key -> [YoutubeDL, ...]
+_lock = threading.Lock()
+_stats = {'created': 0, 'reused': 0, 'discarded': 0, 'setup_seconds': 0.0, 'checkout_seconds': 0.0}
+
+
+def pool_key(opts):
+    base = {k: v for k, v in opts.items() if k not in PER_CALL_OPTIONS and k not in IGNORED_OPTIONS}
+    return json.dumps(base, sort_keys=True, default=str)
+
+
+def _create(opts):
+    started = time.perf_counter()
+    params = {k: v for k, v in opts.items() if k not in PER_CALL_OPTIONS and k not in IGNORED_OPTIONS}
+    ydl = (_factory or _default_factory())(params)
+    try:
+        # Load (and decrypt) the cookie jar now rather than on the first request
+        ydl.cookiejar
+    except Exception as e:
+        print(f"Cookie load failed: {e}")
+    ydl._offlineify_defaults = {k: ydl.params.get(k) for k in PER_CALL_OPTIONS}
+    elapsed = time.perf_counter() - started
+    with _lock:
+        _stats['created'] += 1
+        _stats['setup_seconds'] += elapsed
+    return ydl
+
+
+def _default_factory():
+    import yt_dlp
+    return yt_dlp.YoutubeDL
+
+
+def _close(ydl):
+    try:
+        ydl.__exit__(None, None, None)
+    except Exception:
+        pass
+
+
+def _set_outtmpl(ydl, outtmpl):
+    # yt-dlp normalizes outtmpl to {'default': ..., 'chapter': ...} at init
+    current = ydl.params.get('outtmpl')
+    if isinstance(current, dict) and not isinstance(outtmpl, dict):
+        outtmpl = {**current, 'default': outtmpl}
+    ydl.params['outtmpl'] = outtmpl
+    if hasattr(ydl, 'outtmpl_dict') and isinstance(outtmpl, dict):
+        ydl.outtmpl_dict = dict(outtmpl)  # older yt-dlp releases cache it here
+
+
+def _apply(ydl, overrides):
+    for key, value in overrides.items():
+        if key == 'outtmpl':
+            _set_outtmpl(ydl, value)
+        else:
+            ydl.params[key] = value
+
+
+def _checkout(key, opts):
+    with _lock:
+        idle = _idle.get(key)
+        if idle:
+            _stats['reused'] += 1
+            return idle.pop()
+    return _create(opts)
+
+
+def _checkin(key, ydl):
+    _apply(ydl, ydl._offlineify_defaults)
+    with _lock:
+        idle = _idle.setdefault(key, [])
+        if sum(len(v) for v in _idle.values()) < YDL_POOL_SIZE:
+            idle.append(ydl)
+            return
+        _stats['discarded'] += 1
+    _close(ydl)
+
+
+@contextmanager
+def session(opts, **overrides):
+    """
+    A ready YoutubeDL for `opts`, with `overrides` (and opts' own outtmpl /
+    extract_flat) applied for this call only:
+
+        with ydl_pool.session(opts, extract_flat='in_playlist') as ydl:
+            ydl.extract_info(...)
+
+    An instance that raised is closed instead of going back to the pool.
+    """
+    started = time.perf_counter()
+    call_options = {k: opts[k] for k in PER_CALL_OPTIONS if k in opts}
+    call_options.update(overrides)
+
+    if not YDL_POOL_ENABLED:
+        ydl = _create({**opts, **call_options})
+        _apply(ydl, call_options)
+        with _lock:
+            _stats['checkout_seconds'] += time.perf_counter() - started
+        try:
+            yield ydl
+        finally:
+            _close(ydl)
+        return
+
+    key = pool_key(opts)
+    ydl = _checkout(key, opts)
+    _apply(ydl, call_options)
+    with _lock:
+        _stats['checkout_seconds'] += time.perf_counter() - started
+    try:
+        yield ydl
+    except BaseException:
+        _close(ydl)
+        raise
+    _checkin(key, ydl)
+
+
+def use_factory(factory):
+    """Build future instances with `factory(params)` instead of yt_dlp.YoutubeDL; idle ones are dropped."""
+    global _factory
+    with _lock:
+        _factory = factory
+        idle = [ydl for instances in _idle.values() for ydl in instances]
+        _idle.clear()
+    for ydl in idle:
+        _close(ydl)
+
+
+def prewarm(opts, count):
+    """Build up to `count` idle instances for `opts` ahead of the first track."""
+    key = pool_key(opts)
+    with _lock:
+        missing = min(count, YDL_POOL_SIZE) - len(_idle.get(key, []))
+    for _ in range(max(0, missing)):
+        _checkin(key, _create(opts))
+
+
+def stats():
+    """Counters for measuring per-track setup overhead (compare with OFFLINEIFY_YDL_POOL=0)."""
+    with _lock:
+        checkouts = _stats['created'] + _stats['reused']
+        return {
+            'enabled': YDL_POOL_ENABLED,
+            'idle': sum(len(v) for v in _idle.values()),
+            'created': _stats['created'],
+            'reused': _stats['reused'],
+            'discarded': _stats['discarded'],
+            'avg_setup_ms': round(1000 * _stats['setup_seconds'] / _stats['created'], 1) if _stats['created'] else 0.0,
+            'avg_checkout_ms': round(1000 * _stats['checkout_seconds'] / checkouts, 2) if checkouts else 0.0,
+        }
@@ -0,0 +1,237 @@
+import os
+import time
+import struct
+import hashlib
+import zlib
+
+# Streaming ZIP writer for /api/zip.
+# Entries are STORED (MP3s don't compress), so the size of every byte of the
+# archive is known up front from file sizes alone: we can send an exact
+# Content-Length, start streaming immediately, and serve Range requests by
+# skipping ahead. CRCs go into data descriptors after each file's data
+# (general purpose flag bit 3), so nothing has to be read twice when
+# streaming from the start. ZIP64 records are used only when needed.
+
+CHUNK_SIZE = 256 * 1024
+_MAX32 = 0xFFFFFFFF
+_MAX16 = 0xFFFF
+
+_FLAGS = 0x0008 | 0x0800  # data descriptor + UTF-8 names
+_VERSION = 20
+_VERSION_ZIP64 = 45
+
+
+class ZipEntry:
+    def __init__(self, arcname, path, size, mtime):
+        self.arcname = arcname
+        self.name = arcname.replace(os.sep, '/').encode('utf-8')
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.offset = 0
+        self.crc = None
+
+    @property
+    def zip64(self):
+        return self.size >= _MAX32
+
+    def dos_datetime(self):
+        t = time.localtime(self.mtime)
+        year = max(t.tm_year, 1980)
+        dos_date = ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+        dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+        return dos_time, dos_date
+
+    def local_header(self):
+        dos_time, dos_date = self.dos_datetime()
+        if self.zip64:
+            extra = struct.pack('<HHQQ', 0x0001, 16, self.size, self.size)
+            size32 = _MAX32
+            version = _VERSION_ZIP64
+        else:
+            extra = b''
+            size32 = self.size
+            version = _VERSION
+        return struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, version, _FLAGS, 0, dos_time, dos_date,
+            0, size32, size32, len(self.name), len(extra),
+        ) + self.name + extra
+
+    def local_header_size(self):
+        return 30 + len(self.name) + (20 if self.zip64 else 0)
+
+    def descriptor(self):
+        if self.zip64:
+            return struct.pack('<IIQQ', 0x08074b50, self.crc, self.size, self.size)
+        return struct.pack('<IIII', 0x08074b50, self.crc, self.size, self.size)
+
+    def descriptor_size(self):
+        return 24 if self.zip64 else 16
+
+    def _central_zip64_fields(self):
+        fields = []
+        if self.size >= _MAX32:
+            fields += [self.size, self.size]
+        if self.offset >= _MAX32:
+            fields.append(self.offset)
+        return fields
+
+    def central_record(self):
+        dos_time, dos_date = self.dos_datetime()
+        fields = self._central_zip64_fields()
+        extra = struct.pack('<HH', 0x0001, 8 * len(fields)) + struct.pack(f'<{len(fields)}Q', *fields) if fields else b''
+        size32 = _MAX32 if self.size >= _MAX32 else self.size
+        offset32 = _MAX32 if self.offset >= _MAX32 else self.offset
+        version = _VERSION_ZIP64 if fields else _VERSION
+        return struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, version, version, _FLAGS, 0, dos_time, dos_date,
+            self.crc, size32, size32, len(self.name), len(extra), 0, 0, 0, 0o100644 << 16, offset32,
+        ) + self.name + extra
+
+    def central_record_size(self):
+        fields = self._central_zip64_fields()
+        return 46 + len(self.name) + (4 + 8 * len(fields) if fields else 0)
+
+
+def collect_entries(root, subdir=None):
+    """
+    List the files to archive under `root` (optionally just `root/subdir`),
+    with names relative to `root`. Hidden and temporary files are skipped.
+    """
+    base = os.path.join(root, subdir) if subdir else root
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(base):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for filename in sorted(filenames):
+            if filename.startswith('.') or filename.endswith('.tmp'):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append(ZipEntry(os.path.relpath(path, root), path, st.st_size, st.st_mtime))
+    return entries
+
+
+def _layout(entries):
+    """Assign offsets; return (central_dir_offset, central_dir_size, total_size)."""
+    offset = 0
+    for entry in entries:
+        entry.offset = offset
+        offset += entry.local_header_size() + entry.size + entry.descriptor_size()
+    cd_offset = offset
+    cd_size = sum(e.central_record_size() for e in entries)
+    total = cd_offset + cd_size + _end_records_size(len(entries), cd_offset, cd_size)
+    return cd_offset, cd_size, total
+
+
+def _needs_zip64_end(count, cd_offset, cd_size):
+    return count >= _MAX16 or cd_offset >= _MAX32 or cd_size >= _MAX32
+
+
+def _end_records_size(count, cd_offset, cd_size):
+    return 22 + (56 + 20 if _needs_zip64_end(count, cd_offset, cd_size) else 0)
+
+
+def _end_records(count, cd_offset, cd_size):
+    out = b''
+    if _needs_zip64_end(count, cd_offset, cd_size):
+        zip64_eocd_offset = cd_offset + cd_size
+        out += struct.pack(
+            '<IQHHIIQQQQ', 0x06064b50, 44, _VERSION_ZIP64, _VERSION_ZIP64, 0, 0,
+            count, count, cd_size, cd_offset,
+        )
+        out += struct.pack('<IIQI', 0x07064b50, 0, zip64_eocd_offset, 1)
+    out += struct.pack(
+        '<IHHHHIIH', 0x06054b50, 0, 0, min(count, _MAX16), min(count, _MAX16),
+        min(cd_size, _MAX32), min(cd_offset, _MAX32), 0,
+    )
+    return out
+
+
+def file_crc(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc & 0xFFFFFFFF
+
+
+class ZipStream:
+    """An archive of `entries` that can be iterated whole or from a byte range."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.cd_offset, self.cd_size, self.size = _layout(entries)
+
+    def etag(self):
+        h = hashlib.sha1()
+        for e in self.entries:
+            h.update(f"{e.arcname}\0{e.size}\0{int(e.mtime)}\n".encode('utf-8'))
+        return f'"{h.hexdigest()}"'
+
+    def _pieces(self):
+        """
+        Yield (length, producer) for each consecutive region of the archive.
+        producer(skip, length) yields bytes for that slice of the region.
+        """
+        for entry in self.entries:
+            yield entry.local_header_size(), self._static(entry.local_header)
+            yield entry.size, self._file_data(entry)
+            yield entry.descriptor_size(), self._static(lambda e=entry: self._ensure_crc(e).descriptor())
+        yield self.cd_size, self._static(lambda: b''.join(self._ensure_crc(e).central_record() for e in self.entries))
+        yield (_end_records_size(len(self.entries), self.cd_offset, self.cd_size),
+               self._static(lambda: _end_records(len(self.entries), self.cd_offset, self.cd_size)))
+
+    @staticmethod
+    def _ensure_crc(entry):
+        # Only happens when a range request skipped (part of) the file's data
+        if entry.crc is None:
+            entry.crc = file_crc(entry.path)
+        return entry
+
+    @staticmethod
+    def _static(build):
+        def produce(skip, length):
+            yield build()[skip:skip + length]
+        return produce
+
+    @staticmethod
+    def _file_data(entry):
+        def produce(skip, length):
+            crc = 0
+            track_crc = skip == 0 and length == entry.size and entry.crc is None
+            with open(entry.path, 'rb') as f:
+                f.seek(skip)
+                remaining = length
+                while remaining > 0:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError(f"{entry.path} shrank while streaming")
+                    if track_crc:
+                        crc = zlib.crc32(chunk, crc)
+                    remaining -= len(chunk)
+                    yield chunk
+            if track_crc:
+                entry.crc = crc & 0xFFFFFFFF
+        return produce
+
+    def iter_range(self, start=0, end=None):
+        """Yield archive bytes [start, end] (inclusive, like HTTP Range)."""
+        if end is None or end >= self.size:
+            end = self.size - 1
+        position = 0
+        for length, produce in self._pieces():
+            piece_end = position + length  # exclusive
+            if piece_end > start and position <= end:
+                skip = max(0, start - position)
+                take = min(piece_end, end + 1) - position - skip
+                if take > 0:
+                    yield from produce(skip, take)
+            position = piece_end
+            if position > end:
+                return
+
+    def __iter__(self):
+        return self.iter_range(0, None)
@@ -27,6 +27,9 @@ interface Track {
     release_date?: string
     track_number?: number
     total_tracks?: number
+    disc_number?: number
+    duration_ms?: number
+    isrc?: string
     explicit?: boolean
 }
 
@@ -164,7 +167,7 @@ export default function Dashboard({ accessToken, userEmail }: DashboardProps) {
                     url = `https://api.spotify.com/v1/me/tracks?limit=50`
                 } else {
                     // Standard Playlist Endpoint
-                    url = `https://api.spotify.com/v1/playlists/${playlist.id}/tracks?fields=items(track(name,uri,artists,track_number,explicit,album(name,images,release_date,total_tracks))),next&limit=100`
+                    url = `https://api.spotify.com/v1/playlists/${playlist.id}/tracks?fields=items(track(name,uri,artists,track_number,disc_number,duration_ms,explicit,external_ids,album(name,images,release_date,total_tracks))),next&limit=100`
                 }
 
                 while (url) {
@@ -182,6 +185,9 @@ export default function Dashboard({ accessToken, userEmail }: DashboardProps) {
                                 release_date: item.track.album.release_date,
                                 track_number: item.track.track_number,
                                 total_tracks: item.track.album.total_tracks,
+                                disc_number: item.track.disc_number,
+                                duration_ms: item.track.duration_ms,
+                                isrc: item.track.external_ids?.isrc,
                                 explicit: item.track.explicit
                             })
                         }
@@ -236,7 +242,7 @@ export default function Dashboard({ accessToken, userEmail }: DashboardProps) {
                 if (playlistId === 'liked-songs') {
                     url = `https://api.spotify.com/v1/me/tracks?limit=50`
                 } else {
-                    url = `https://api.spotify.com/v1/playlists/${playlistId}/tracks?fields=items(track(name,uri,artists,track_number,explicit,album(name,images,release_date,total_tracks))),next&limit=100`
+                    url = `https://api.spotify.com/v1/playlists/${playlistId}/tracks?fields=items(track(name,uri,artists,track_number,disc_number,duration_ms,explicit,external_ids,album(name,images,release_date,total_tracks))),next&limit=100`
                 }
 
                 while (url) {
@@ -254,6 +260,9 @@ export default function Dashboard({ accessToken, userEmail }: DashboardProps) {
                                 release_date: item.track.album.release_date,
                                 track_number: item.track.track_number,
                                 total_tracks: item.track.album.total_tracks,
+                                disc_number: item.track.disc_number,
+                                duration_ms: item.track.duration_ms,
+                                isrc: item.track.external_ids?.isrc,
                                 explicit: item.track.explicit
                             })
                         }